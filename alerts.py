@@ -0,0 +1,241 @@
+from __future__ import annotations
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, asdict
+from typing import Callable, Deque, Dict, Any, List, Optional, Tuple
+import json, os, threading, time, warnings
+import rules
+from errors import ExecutionError, UnknownDrugError
+from locks import flock
+
+# Alert rules registered by ALERT commands, kept in a JSON file so they outlive the process.
+#
+# A rule is scoped to a drug, a patient, both, or neither (global). Rules are indexed by that
+# (drug, patient_id) scope, so evaluating a dose looks up the four scopes that can apply to it
+# and never walks unrelated rules. Each rule fires when the dose (or, for a rule with a window,
+# the total ordered in that window) exceeds its threshold: a fixed mg/day amount or a
+# percentage of the drug's safety limit. Fired events queue in a bounded buffer that
+# consumers take with drain().
+#
+# Changes from every thread and process go through an advisory lock on `<path>.lock` and
+# re-read the file under it before writing, so concurrent adds neither lose a rule nor hand
+# out the same id twice.
+
+ALERT_BUFFER = int(os.environ.get("ALERT_BUFFER", "10000"))
+FORMAT = 1
+
+Scope = Tuple[Optional[str], Optional[str]]
+
+@dataclass(frozen=True)
+class AlertRule:
+    id: int
+    drug: Optional[str] = None
+    patient_id: Optional[str] = None
+    threshold_mg: Optional[float] = None    # mg/day; None means percent of the safety limit
+    percent: float = 100.0
+    window_hours: Optional[float] = None    # compare the mg ordered over this window instead
+
+    def describe(self) -> str:
+        what = f"{self.threshold_mg:g} mg/day" if self.threshold_mg is not None else \
+            "SAFETY_LIMIT" if self.percent == 100.0 else f"{self.percent:g}% of SAFETY_LIMIT"
+        subject = f"{self.window_hours:g}h total" if self.window_hours is not None else "dose"
+        scope = [f"{k}={v}" for k, v in (("drug", self.drug), ("patient_id", self.patient_id)) if v is not None]
+        return f"#{self.id}: {subject} exceeds {what}" + (f" for {', '.join(scope)}" if scope else "")
+
+    def limit(self, safety_mg: Optional[float]) -> Optional[float]:
+        # a daily limit over a window covers the days in it (at least one)
+        base = self.threshold_mg if self.threshold_mg is not None else \
+            None if safety_mg is None else safety_mg * self.percent / 100
+        if base is None or self.window_hours is None:
+            return base
+        return base * max(self.window_hours, 24.0) / 24
+
+@dataclass
+class AlertEvent:
+    rule_id: int
+    rule: str
+    drug: str
+    patient_id: Optional[str]
+    value_mg: float
+    limit_mg: float
+    message: str
+    ts: float
+
+
+class AlertRegistry:
+    def __init__(self, path: Optional[str] = None, buffer: int = ALERT_BUFFER):
+        self.path = path
+        self.events: Deque[AlertEvent] = deque(maxlen=buffer)
+        self.dropped = 0
+        self._rules: Dict[int, AlertRule] = {}
+        self._index: Dict[Scope, Tuple[AlertRule, ...]] = {}
+        self._next_id = 1
+        self._key = None
+        self._lock = threading.Lock()
+        self._lockfh = None  # opened by the first change; reads only stat the rules file
+        self._refresh()
+
+    def _file_key(self):
+        try:
+            st = os.stat(self.path)
+        except (OSError, TypeError):
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def _lock_file(self):
+        if self._lockfh is None and self.path is not None:
+            self._lockfh = open(self.path + ".lock", "a+b")
+        return self._lockfh
+
+    def _refresh(self):
+        # Picks up rules another process wrote; one stat when nothing changed.
+        if self.path is None:
+            return
+        key = self._file_key()
+        if key == self._key:
+            return
+        with self._lock:
+            try:
+                self._reload()
+            except ExecutionError as e:
+                warnings.warn(str(e))
+
+    def _reload(self, force: bool = False):
+        # Caller holds self._lock. An unreadable file raises rather than being written over.
+        key = self._file_key()
+        if key == self._key and not force:
+            return
+        found, next_id = {}, 1
+        if key is not None:
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    spec = json.load(f)
+                for r in spec.get("rules", []):
+                    rule = AlertRule(**r)
+                    found[rule.id] = rule
+                next_id = max(int(spec.get("next_id", 1)), max(found, default=0) + 1)
+            except (OSError, ValueError, TypeError, AttributeError) as e:
+                raise ExecutionError(f"could not read alert rules {self.path}: {e}")
+        self._install(found, next_id)
+        self._key = key
+
+    @contextmanager
+    def _changing(self):
+        # The file as it is now, under the lock; a stat key can miss a same-size rewrite. A
+        # change that cannot be written is undone and reported as an ExecutionError.
+        with self._lock:
+            rules, next_id, key = self._rules, self._next_id, self._key
+            try:
+                with flock(self._lock_file()):
+                    if self.path is not None:
+                        self._reload(force=True)
+                    yield
+            except OSError as e:
+                self._install(rules, next_id)
+                self._key = key
+                raise ExecutionError(f"could not save alert rules {self.path}: {e}") from None
+
+    def _install(self, rules: Dict[int, AlertRule], next_id: int):
+        index: Dict[Scope, List[AlertRule]] = {}
+        for rule in rules.values():
+            index.setdefault((rule.drug, rule.patient_id), []).append(rule)
+        self._rules = rules
+        self._next_id = next_id
+        # rebinding is atomic: evaluate() never sees a half-built index
+        self._index = {scope: tuple(found) for scope, found in index.items()}
+
+    def _save(self):
+        if self.path is None:
+            return
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"format": FORMAT, "next_id": self._next_id,
+                       "rules": [asdict(r) for r in self._rules.values()]}, f, indent=1)
+        os.replace(tmp, self.path)
+        self._key = self._file_key()
+
+    def add(self, drug: Optional[str] = None, patient_id: Optional[str] = None, threshold_mg: Optional[float] = None,
+            percent: Optional[float] = None, window_hours: Optional[float] = None) -> AlertRule:
+        if threshold_mg is not None and percent is not None:
+            raise ExecutionError("An alert threshold is either an amount or a percent of SAFETY_LIMIT, not both")
+        if percent is not None and percent <= 0:
+            raise ExecutionError(f"percent must be above 0, got {percent:g}")
+        if threshold_mg is not None and threshold_mg < 0:
+            raise ExecutionError(f"Alert threshold must not be negative, got {threshold_mg:g} mg")
+        if window_hours is not None and window_hours <= 0:
+            raise ExecutionError(f"window must be a positive duration, got {window_hours:g}h")
+        if drug is not None and drug not in rules.DRUG_RULES:
+            raise UnknownDrugError(drug)
+        with self._changing():
+            rule = AlertRule(self._next_id, drug, patient_id, threshold_mg,
+                             100.0 if percent is None else float(percent), window_hours)
+            # registering the same rule twice keeps the first one
+            for same in self._index.get((drug, patient_id), ()):
+                if (same.threshold_mg, same.percent, same.window_hours) == (rule.threshold_mg, rule.percent, rule.window_hours):
+                    return same
+            self._install({**self._rules, rule.id: rule}, rule.id + 1)
+            self._save()
+        return rule
+
+    def remove(self, rule_id: int) -> bool:
+        with self._changing():
+            if rule_id not in self._rules:
+                return False
+            self._install({k: r for k, r in self._rules.items() if k != rule_id}, self._next_id)
+            self._save()
+        return True
+
+    def clear(self):
+        with self._changing():
+            self._install({}, self._next_id)
+            self._save()
+
+    def rules(self) -> List[AlertRule]:
+        self._refresh()
+        return sorted(self._rules.values(), key=lambda r: r.id)
+
+    def applicable(self, drug: str, patient_id: Optional[str] = None) -> List[AlertRule]:
+        self._refresh()
+        index = self._index
+        if not index:
+            return []
+        scopes = ((drug, patient_id), (drug, None), (None, patient_id), (None, None)) if patient_id is not None \
+            else ((drug, None), (None, None))
+        return [rule for scope in scopes for rule in index.get(scope, ())]
+
+    def evaluate(self, drug: str, patient_id: Optional[str], dose_mg: float, safety_mg: Optional[float],
+                 window_total: Optional[Callable[[float], float]] = None) -> List[AlertEvent]:
+        # window_total(hours) gives the mg ordered over a window of `hours` (executor.window_total,
+        # with this dose as the order being placed); rules with a window are skipped when it is
+        # not given (no patient to total over).
+        fired = []
+        for rule in self.applicable(drug, patient_id):
+            limit = rule.limit(safety_mg)
+            if limit is None:
+                continue
+            if rule.window_hours is None:
+                value = dose_mg
+            elif window_total is None:
+                continue
+            else:
+                value = window_total(rule.window_hours)
+            if value > limit:
+                subject = f"{value:.0f} mg of {drug} over a {rule.window_hours:g}h window" if rule.window_hours is not None \
+                    else f"dose {value:.0f} mg/day of {drug}"
+                fired.append(AlertEvent(rule.id, rule.describe(), drug, patient_id, round(value, 2), round(limit, 2),
+                                        f"alert #{rule.id}: {subject} exceeds {limit:.0f} mg", time.time()))
+        for event in fired:
+            if len(self.events) == self.events.maxlen:
+                self.dropped += 1
+            self.events.append(event)
+        return fired
+
+    def drain(self, max_events: Optional[int] = None) -> List[AlertEvent]:
+        # Oldest first; each event is handed to one caller.
+        out = []
+        while max_events is None or len(out) < max_events:
+            try:
+                out.append(self.events.popleft())
+            except IndexError:
+                break
+        return out
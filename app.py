@@ -4,7 +4,13 @@ import sys
 from datetime import datetime
 
 # Import the interpreter modules
-from interpreter import run, run_and_raise_on_alert
+import rules
+import executor
+from executor import REPORT_PAGE_SIZE
+import formulary
+from interpreter import run, run_and_raise_on_alert, run_script
+from incremental import IncrementalDocument
+from bulk import read_prescriptions, validate_frame
 from errors import (
     LexicalError, ParseError, ExecutionError, 
     UnknownDrugError, SafetyLimitExceeded
@@ -104,34 +110,95 @@ if 'active_section' not in st.session_state:
 if 'section_results' not in st.session_state:
     st.session_state.section_results = {'calc': None, 'interact': None, 'validate': None}
 
-# Cached data helpers (fix NameError)
+# FORMULARY_PATH is loaded by the executor; keep it in sync with the file while the app runs
+@st.cache_resource
+def watch_formulary(path):
+    return formulary.watch(path) if path else None
+
+watch_formulary(executor.FORMULARY_PATH)
+
+# Cached data helpers (fix NameError); keyed on the rule table version so a formulary reload shows up
 @st.cache_data
-def get_drugs():
-    return [
-        "amlodipine", "losartan", "metformin", "glimepiride",
-        "amoxicillin", "azithromycin", "paracetamol",
-        "ibuprofen", "salbutamol", "montelukast"
-    ]
+def get_drugs(version=None):
+    return list(rules.DRUG_RULES)
 
 @st.cache_data
-def get_condition_map():
-    return {
-        "amlodipine": ["hypertension"],
-        "losartan": ["hypertension"],
-        "metformin": ["diabetes"],
-        "glimepiride": ["diabetes"],
-        "amoxicillin": ["infection"],
-        "azithromycin": ["infection"],
-        "paracetamol": ["pain", "fever"],
-        "ibuprofen": ["pain", "fever"],
-        "salbutamol": ["asthma"],
-        "montelukast": ["asthma"],
-    }
+def get_condition_map(version=None):
+    return {name: list(rule.conditions) or ["general"] for name, rule in rules.DRUG_RULES.items()}
+
 
 # Helper: render result in original format
 # (defined before routing to avoid breaking if/elif chain)
 
-def render_original_output(result_dict: dict):
+REPORT_COLUMNS = ('ts', 'drug', 'condition', 'recommended_mg_per_day', 'per_dose_mg', 'doses_per_day', 'alert')
+
+def _step_report_page(page_key: str, step: int):
+    st.session_state[page_key]['page'] += step
+
+def render_report_page(result_dict: dict, key_prefix: str = ""):
+    # Shows one page of a paged REPORT as a table. The first page is the command's own
+    # result; later pages are fetched from the store one at a time by following next_cursor,
+    # so the store seeks to each page instead of counting an offset. The cursors seen so far
+    # are kept, which is what Previous goes back through.
+    pid = result_dict['patient_id']
+    size = result_dict.get('limit', REPORT_PAGE_SIZE)
+    total = result_dict.get('total')
+    origin = (size, result_dict.get('offset', 0), result_dict.get('since_hours'), result_dict.get('next_cursor'))
+    page_key = f"{key_prefix}report_page_{pid}"
+    nav = st.session_state.get(page_key)
+    if not isinstance(nav, dict) or nav['origin'] != origin:
+        nav = st.session_state[page_key] = {'origin': origin, 'page': 0, 'cursors': [None]}
+    page = nav['page']
+    if page == 0:
+        rows, next_cursor = result_dict['entries'], result_dict.get('next_cursor')
+    else:
+        since_hours = result_dict.get('since_hours')
+        since = None if since_hours is None else datetime.now().timestamp() - since_hours * 3600
+        found = executor.report_page(pid, since, limit=size, cursor=nav['cursors'][page])
+        rows, next_cursor = found['entries'], found['next_cursor']
+    # cursors[i] fetches page i; the one after this page is only known once it is read
+    del nav['cursors'][page + 1:]
+    if next_cursor is not None:
+        nav['cursors'].append(next_cursor)
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        st.button("◀ Previous", disabled=page == 0, key=f"{page_key}_prev",
+                  on_click=_step_report_page, args=(page_key, -1))
+    with col3:
+        st.button("Next ▶", disabled=next_cursor is None, key=f"{page_key}_next",
+                  on_click=_step_report_page, args=(page_key, 1))
+    with col2:
+        if total is None:  # a report started from a cursor has no count
+            st.write(f"**Page {page + 1}**")
+        else:
+            pages = max(1, -(-(total - result_dict.get('offset', 0)) // size))
+            st.write(f"**Total Entries:** {total} — page {page + 1} of {pages}")
+    table = [{c: (datetime.fromtimestamp(e[c]).strftime("%Y-%m-%d %H:%M:%S") if c == 'ts' and e.get(c) else e.get(c))
+              for c in REPORT_COLUMNS} for e in rows]
+    st.dataframe(table, use_container_width=True, hide_index=True)
+
+BULK_PREVIEW_ROWS = 10000
+
+def render_bulk_result(frame, file_name: str):
+    counts = frame['status'].value_counts()
+    cols = st.columns(5)
+    for col, (label, key) in zip(cols, (("Rows", None), ("OK", "OK"), ("Exceeds", "EXCEEDS"), ("Low", "LOW"), ("Errors", "ERROR"))):
+        col.metric(label, f"{len(frame) if key is None else int(counts.get(key, 0)):,}")
+    view = frame
+    if st.checkbox("Only rows needing review", value=True, key="bulk_flagged"):
+        view = frame[frame['status'] != 'OK']
+    if len(view) > BULK_PREVIEW_ROWS:
+        st.caption(f"Showing the first {BULK_PREVIEW_ROWS:,} of {len(view):,} rows; the download has all of them.")
+    st.dataframe(view.head(BULK_PREVIEW_ROWS), use_container_width=True, hide_index=True)
+    stem = file_name.rsplit('.', 1)[0]
+    st.download_button("⬇️ Download annotated CSV", data=frame.to_csv(index=False).encode("utf-8"),
+                       file_name=f"{stem}_validated.csv", mime="text/csv", key="bulk_download")
+
+def render_rule_alerts(result_dict: dict):
+    for a in result_dict.get('alerts', []):
+        st.warning(f"🚨 **RULE {a['rule_id']}:** {a['message']}")
+
+def render_original_output(result_dict: dict, key_prefix: str = ""):
     res_type = result_dict.get('type')
     if res_type in ('CALCULATE','ADJUST'):
         r = result_dict['result']
@@ -155,9 +222,28 @@ def render_original_output(result_dict: dict):
         st.info(f"**Rationale:** {r.get('rationale','')}")
         if r.get('alert'):
             st.warning(f"⚠️ **ALERT:** {r['alert']}")
+        cumulative = result_dict.get('cumulative') or {}
+        if cumulative.get('alert'):
+            st.warning(f"⚠️ **CUMULATIVE:** {cumulative['alert']}")
+        render_rule_alerts(result_dict)
+        for hit in result_dict.get('interactions', []):
+            line = f"**{hit['drug_a'].title()} + {hit['drug_b'].title()}** (already on this patient's regimen): {hit['interaction']}"
+            if hit['severity'] in ('caution', 'monitor'):
+                st.warning(f"⚠️ {line}")
+            else:
+                st.info(line)
     elif res_type == 'CHECK':
         st.success("✅ Interaction check completed!")
         st.info(f"**Interaction:** {result_dict['interaction']}")
+    elif res_type == 'CHECK_AMONG':
+        hits = result_dict.get('interactions', [])
+        st.success(f"✅ Screened {len(result_dict.get('drugs', []))} drugs: {len(hits)} interacting pair(s)")
+        for h in hits:
+            line = f"**{h['drug_a'].title()} + {h['drug_b'].title()}** ({h['severity']}): {h['interaction']}"
+            if h['severity'] == 'caution':
+                st.warning(f"⚠️ {line}")
+            else:
+                st.info(line)
     elif res_type == 'VALIDATE':
         r = result_dict['result']
         if r['status'] == 'OK':
@@ -173,21 +259,39 @@ def render_original_output(result_dict: dict):
             st.metric("Prescribed Dose", f"{r['dose_mg_per_day']} mg/day")
         with col3:
             st.metric("Status", r['status'])
+        render_rule_alerts(result_dict)
     elif res_type == 'REPORT':
         st.success(f"✅ Regimen report for Patient ID: {result_dict['patient_id']}")
         entries = result_dict.get('entries', [])
-        if entries:
-            st.write(f"**Total Entries:** {len(entries)}")
-            for i, entry in enumerate(entries, 1):
-                show = st.checkbox(f"Show Entry {i}: {entry.get('drug', 'N/A').title()}", key=f"report_show_{i}")
-                if show:
-                    st.json(entry)
+        if result_dict.get('since_hours') is not None:
+            st.caption(f"Entries recorded in the last {result_dict['since_hours']:g}h")
+            for t in result_dict.get('totals', []):
+                limit = '' if t['limit_mg'] is None else f" of {t['limit_mg']} mg allowed"
+                line = f"**{t['drug'].title()}:** {t['total_mg']} mg/day ordered in the window{limit}"
+                if t.get('alert'):
+                    st.warning(f"⚠️ {line}")
+                else:
+                    st.info(line)
+        if entries or result_dict.get('total') or result_dict.get('next_cursor'):
+            render_report_page(result_dict, key_prefix)
         else:
             st.info("No regimen entries found for this patient.")
     elif res_type == 'ALERT_RULE':
-        st.success("✅ Alert rule configured!")
+        st.success(f"✅ Alert rule #{result_dict['id']} configured!")
         st.info(f"**Rule:** {result_dict['rule']}")
         st.info(f"**Status:** {result_dict['status']}")
+    elif res_type == 'ERROR':
+        st.error(f"❌ {result_dict.get('error_type','Error')} — {result_dict.get('error','')}")
+        problems = result_dict.get('errors', [])
+        if len(problems) > 1:
+            for p in problems[1:]:
+                st.caption(f"{p['kind'].title()} error at position {p['position']}: {p['message']}")
+    elif res_type == 'SCRIPT':
+        results = result_dict.get('results', [])
+        st.success(f"✅ Executed {len(results)} commands")
+        for i, sub in enumerate(results, 1):
+            st.markdown(f"**Command {i}**")
+            render_original_output(sub, key_prefix=f"{key_prefix}script_{i}_")
 
 # Header
 st.markdown('<div class="main-header">💊 Medical Dosage Calculation Interpreter</div>', unsafe_allow_html=True)
@@ -209,6 +313,10 @@ with st.sidebar:
         st.session_state.active_tab = "Actions"
         st.session_state.active_section = "validate"
         st.rerun()
+    if st.button("📂 Bulk Validation", use_container_width=True):
+        st.session_state.active_tab = "Actions"
+        st.session_state.active_section = "bulk"
+        st.rerun()
     # Restore Manual Commands button in sidebar
     if st.button("⌨️ Manual Commands", use_container_width=True):
         st.session_state.active_tab = "Actions"
@@ -231,11 +339,17 @@ if active not in allowed_tabs:
     st.session_state.active_tab = 'Actions'
     active = 'Actions'
 
+# Manual commands may hold several newline/semicolon separated commands (e.g. an order set)
+def run_manual(command: str):
+    # REPORT always asks for a page; render_report_page fetches the rest by cursor
+    results = run_script(command, stop_on_error=False, report_limit=REPORT_PAGE_SIZE)
+    return results[0] if len(results) == 1 else {'type': 'SCRIPT', 'results': results}
+
 # Helper: consolidate execute + record to minimize duplication and overhead
-def execute_and_record(section_key: str, command: str):
+def execute_and_record(section_key: str, command: str, runner=run):
     ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     try:
-        result = run(command)
+        result = runner(command)
         st.session_state.command_history.append({'timestamp': ts,'command': command})
         st.session_state.result_history.append({'timestamp': ts,'command': command,'result': result,'status': 'success'})
         st.session_state.command_history = st.session_state.command_history[-200:]
@@ -249,12 +363,55 @@ def execute_and_record(section_key: str, command: str):
         st.session_state.result_history.append({'timestamp': ts,'command': command,'error': str(e),'error_type': 'Exception','status': 'error'})
         st.session_state.result_history = st.session_state.result_history[-200:]
 
+# Manual Commands editor. Runs as a fragment where Streamlit has them, so editing the text
+# only reruns this block; the document re-lexes just the edited statements for live checks.
+_fragment = getattr(st, "fragment", None) or getattr(st, "experimental_fragment", None) or (lambda fn: fn)
+
+@_fragment
+def manual_commands():
+    command = st.text_area(
+        "Command",
+        value="",
+        placeholder="e.g., CALCULATE DOSE FOR drug=metformin, condition=diabetes, weight=70kg, age=45, kidney_function=normal",
+        key="manual_command_input"
+    )
+    doc = st.session_state.get('manual_doc')
+    if doc is None:
+        doc = st.session_state.manual_doc = IncrementalDocument()
+    doc.update(command)
+    if command.strip():
+        problems = doc.diagnostics()
+        for p in problems[:5]:
+            st.caption(f"⚠️ {p.kind.title()} error at position {p.position}: {p.message}")
+        if len(problems) > 5:
+            st.caption(f"… and {len(problems) - 5} more")
+        if not problems:
+            st.caption("✅ No syntax errors")
+    _, suggestions = doc.completions(len(command))
+    if suggestions:
+        st.caption("Next: " + ", ".join(suggestions[:10]))
+    execute_btn = st.button("▶️ Execute", type="primary", key="manual_execute")
+    if execute_btn and command.strip():
+        execute_and_record('manual', command, runner=run_manual)
+    latest = st.session_state.section_results.get('manual')
+    if latest:
+        st.caption(f"Last executed at {latest['timestamp']}")
+        if latest.get('status') == 'error':
+            st.error(f"❌ Execution error: {latest.get('error_type','Error')} — {latest.get('error','')}")
+            st.code(latest.get('command',''), language='text')
+        else:
+            render_original_output(latest.get('result', {}))
+            show_raw = st.checkbox("Show Raw Output", key="manual_show_raw")
+            if show_raw:
+                st.json(latest.get('result', {}))
+            st.write(f"Command: `{latest.get('command','')}`")
+
 # Unified Actions page with three sections, results inline
 if active == 'Actions':
     # Precompute static lists once per rerun (functions are cached but avoid repeated calls)
-    drugs = get_drugs()
-    condition_map = get_condition_map()
-    sections = ['calc','interact','validate','manual']
+    drugs = get_drugs(rules.DRUG_RULES.version)
+    condition_map = get_condition_map(rules.DRUG_RULES.version)
+    sections = ['calc','interact','validate','bulk','manual']
     active_section = st.session_state.get('active_section','calc')
     # Keep original section order; emphasize selected via expanded expander
     for sec in sections:
@@ -264,7 +421,7 @@ if active == 'Actions':
                 # using precomputed 'drugs' and 'condition_map' from Actions page
                 col1, col2 = st.columns(2)
                 with col1:
-                    sel_drug = st.selectbox("Drug", options=drugs, index=2, key="calc_drug")
+                    sel_drug = st.selectbox("Drug", options=drugs, index=min(2, len(drugs) - 1), key="calc_drug")
                     cond_opts = condition_map.get(sel_drug, ["general"]) 
                     sel_condition = st.selectbox("Condition", options=cond_opts, index=0, key="calc_condition")
                 with col2:
@@ -292,14 +449,21 @@ if active == 'Actions':
             with st.expander("⚖️ Check Interaction", expanded=(active_section=='interact')):
                 st.header("Check Interaction")
                 # using precomputed 'drugs' from Actions page
-                col1, col2 = st.columns(2)
-                with col1:
-                    drug_a = st.selectbox("Drug A", options=drugs, index=1, key="interact_a")
-                with col2:
-                    drug_b = st.selectbox("Drug B", options=drugs, index=0, key="interact_b")
-                if drug_a == drug_b:
-                    st.warning("Select two different drugs to check interactions.")
-                command = f"CHECK INTERACTION BETWEEN {drug_a} AND {drug_b}"
+                screen_list = st.checkbox("Screen a full medication list", key="interact_among")
+                if screen_list:
+                    selected = st.multiselect("Medications", options=drugs, default=drugs[:3], key="interact_list")
+                    if len(selected) < 2:
+                        st.warning("Select at least two drugs to check interactions.")
+                    command = f"CHECK INTERACTION AMONG {', '.join(selected)}"
+                else:
+                    col1, col2 = st.columns(2)
+                    with col1:
+                        drug_a = st.selectbox("Drug A", options=drugs, index=min(1, len(drugs) - 1), key="interact_a")
+                    with col2:
+                        drug_b = st.selectbox("Drug B", options=drugs, index=0, key="interact_b")
+                    if drug_a == drug_b:
+                        st.warning("Select two different drugs to check interactions.")
+                    command = f"CHECK INTERACTION BETWEEN {drug_a} AND {drug_b}"
                 execute_btn = st.button("▶️ Execute", type="primary", key="interact_execute")
                 if execute_btn and command.strip():
                     execute_and_record('interact', command)
@@ -342,30 +506,37 @@ if active == 'Actions':
                             st.json(latest.get('result', {}))
                         st.write(f"Command: `{latest.get('command','')}`")
             st.markdown("<hr>", unsafe_allow_html=True)
-        elif sec == 'manual':
-            with st.expander("⌨️ Manual Commands", expanded=(active_section=='manual')):
-                st.header("Manual Commands")
-                command = st.text_area(
-                    "Command",
-                    value="",
-                    placeholder="e.g., CALCULATE DOSE FOR drug=metformin, condition=diabetes, weight=70kg, age=45, kidney_function=normal",
-                    key="manual_command_input"
-                )
-                execute_btn = st.button("▶️ Execute", type="primary", key="manual_execute")
-                if execute_btn and command.strip():
-                    execute_and_record('manual', command)
-                latest = st.session_state.section_results.get('manual')
+        elif sec == 'bulk':
+            with st.expander("📂 Bulk Validation", expanded=(active_section=='bulk')):
+                st.header("Bulk Validation")
+                st.caption("Upload a CSV or Excel (.xlsx) file with `drug` and `dose` columns (optional: `unit`, `weight`, `doses_per_day`). "
+                           "Every row is checked against the safety ranges in one vectorized pass.")
+                upload = st.file_uploader("Prescriptions file", type=["csv", "xlsx"], key="bulk_upload")
+                execute_btn = st.button("▶️ Validate All", type="primary", key="bulk_execute", disabled=upload is None)
+                if execute_btn and upload is not None:
+                    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                    try:
+                        frame = read_prescriptions(upload, upload.name)
+                        bar = st.progress(0.0, text=f"Validating {len(frame):,} rows...")
+                        checked = validate_frame(frame, progress=lambda done, total: bar.progress(
+                            done / total, text=f"Validated {done:,} of {total:,} rows"))
+                        st.session_state.section_results['bulk'] = {'timestamp': ts, 'file': upload.name, 'frame': checked, 'status': 'success'}
+                    except (ValueError, ImportError) as e:
+                        # missing columns, unreadable file, or no openpyxl for Excel
+                        st.session_state.section_results['bulk'] = {'timestamp': ts, 'file': upload.name, 'error': str(e), 'status': 'error'}
+                    st.session_state.active_section = 'bulk'
+                latest = st.session_state.section_results.get('bulk')
                 if latest:
-                    st.caption(f"Last executed at {latest['timestamp']}")
+                    st.caption(f"{latest['file']} — validated at {latest['timestamp']}")
                     if latest.get('status') == 'error':
-                        st.error(f"❌ Execution error: {latest.get('error_type','Error')} — {latest.get('error','')}")
-                        st.code(latest.get('command',''), language='text')
+                        st.error(f"❌ Could not validate file: {latest.get('error','')}")
                     else:
-                        render_original_output(latest.get('result', {}))
-                        show_raw = st.checkbox("Show Raw Output", key="manual_show_raw")
-                        if show_raw:
-                            st.json(latest.get('result', {}))
-                        st.write(f"Command: `{latest.get('command','')}`")
+                        render_bulk_result(latest['frame'], latest['file'])
+            st.markdown("<hr>", unsafe_allow_html=True)
+        elif sec == 'manual':
+            with st.expander("⌨️ Manual Commands", expanded=(active_section=='manual')):
+                st.header("Manual Commands")
+                manual_commands()
             st.markdown("<hr>", unsafe_allow_html=True)
 
 # Disable legacy individual tabs migrated into Actions page
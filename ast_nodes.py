@@ -1,5 +1,20 @@
 from dataclasses import dataclass, field
-from typing import Dict, Any
+from typing import Dict, Any, NamedTuple, Optional
+
+class Quantity(NamedTuple):
+    # A number and its unit as the parser saw them; str() gives back the source text.
+    value: float
+    unit: Optional[str] = None
+    text: str = ""
+
+    def __str__(self) -> str:
+        return self.text or f"{self.value:g}{self.unit or ''}"
+
+@dataclass(frozen=True)
+class Placeholder:
+    index: int
+    unit: Optional[str] = None
+    pos: int = 0
 
 @dataclass
 class Command:
@@ -14,6 +29,10 @@ class CalculateDose(Command):
 class CheckInteraction(Command):
     pass
 
+@dataclass
+class CheckInteractionAmong(Command):
+    pass
+
 @dataclass
 class AdjustDose(Command):
     pass
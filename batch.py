@@ -0,0 +1,278 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Dict, Any, Iterator, List, Optional, Sequence
+import numpy as np
+import rules
+from errors import InterpreterError, ExecutionError, UnknownDrugError
+from executor import RENAL_IMPAIRED, UNIT_TABLE
+
+def _text(values: Optional[Sequence], n: int) -> np.ndarray:
+    if values is None:
+        return np.full(n, "", dtype=str)
+    return np.char.lower(np.array(["" if v is None else str(v) for v in values], dtype=str))
+
+def _numeric(values: Optional[Sequence], n: int) -> np.ndarray:
+    if values is None:
+        return np.full(n, np.nan)
+    return np.array([np.nan if v is None else v for v in values], dtype=float)
+
+def _round(x: np.ndarray, ndigits: int = 2) -> np.ndarray:
+    # Python's round() is exact on the binary value; np.round is not, so round each distinct value once.
+    uniq, inv = np.unique(x, return_inverse=True)
+    return np.array([round(v, ndigits) for v in uniq.tolist()], dtype=float)[inv.reshape(-1)]
+
+def _groups(keys: np.ndarray):
+    uniq, inv = np.unique(keys, return_inverse=True)
+    inv = inv.reshape(-1)
+    order = np.argsort(inv, kind="stable")
+    bounds = np.concatenate(([0], np.cumsum(np.bincount(inv, minlength=len(uniq)))))
+    for k, key in enumerate(uniq.tolist()):
+        yield key, order[bounds[k]:bounds[k + 1]]
+
+def _base_mg_day(spec, weight: np.ndarray, condition: np.ndarray) -> np.ndarray:
+    kind, args = spec
+    if kind == "per_kg_mg_day":
+        val = np.minimum(args["mg_per_kg"] * weight, args["cap"])
+        return np.where(np.isnan(weight), 0.0, val)
+    if kind == "fixed_mg_day":
+        return np.full(len(weight), float(args["amount"]))
+    if kind == "condition_based":
+        out = np.empty(len(condition))
+        cap = args["cap"]
+        for cond, rows in _groups(condition):
+            base = args["by_condition"].get(cond, args["default"])
+            out[rows] = cap if cap is not None and base > cap else base
+        return out
+    raise ValueError(f"Calculator kind '{kind}' has no batch implementation")
+
+
+@dataclass
+class DoseBatch:
+    drug: np.ndarray
+    condition: np.ndarray
+    weight_kg: np.ndarray
+    adjust_factor: np.ndarray
+    adjusted_mg_per_day: np.ndarray
+    recommended_mg_per_day: np.ndarray
+    per_dose_mg: np.ndarray
+    doses_per_day: np.ndarray
+    safety_low: np.ndarray
+    safety_high: np.ndarray
+    exceeds_limit: np.ndarray
+    below_minimum: np.ndarray
+    error: np.ndarray
+    table: Dict[str, Any] = field(default=None, repr=False)  # the rule table the batch was computed with
+
+    def __len__(self) -> int:
+        return len(self.drug)
+
+    @property
+    def alert(self) -> np.ndarray:
+        return self.exceeds_limit | self.below_minimum
+
+    def result(self, i: int) -> Dict[str, Any]:
+        # Same dict compute_dose() returns for row i.
+        if self.error[i] is not None:
+            raise self.error[i]
+        drug, cond = str(self.drug[i]), str(self.condition[i])
+        w = self.weight_kg[i]
+        _, rationale = self.table[drug].calculator({"condition": cond, "weight_kg": None if np.isnan(w) else float(w)})
+        adjust = float(self.adjust_factor[i])
+        adjusted = float(self.adjusted_mg_per_day[i])
+        low, high = float(self.safety_low[i]), float(self.safety_high[i])
+        alert = None
+        if self.exceeds_limit[i]:
+            alert = f"computed {adjusted:.0f} mg/day exceeds safety limit {high:.0f} mg/day"
+        if self.below_minimum[i]:
+            alert = (alert or "") + ("" if alert is None else "; ") + f"computed {adjusted:.0f} mg/day below typical minimum {low:.0f} mg/day"
+        has_dose = not np.isnan(self.per_dose_mg[i])
+        return {
+            "drug": drug,
+            "condition": cond,
+            "recommended_mg_per_day": float(self.recommended_mg_per_day[i]),
+            "per_dose_mg": float(self.per_dose_mg[i]) if has_dose else None,
+            "doses_per_day": int(self.doses_per_day[i]) if has_dose else None,
+            "rationale": rationale + (f"; adjustments factor={adjust:.2f}" if adjust != 1.0 else ""),
+            "safety_range_mg_day": (low, high),
+            "alert": alert,
+        }
+
+    def results(self) -> Iterator[Dict[str, Any]]:
+        for i in range(len(self)):
+            yield self.result(i)
+
+
+def compute_doses(drug: Sequence[str], condition: Sequence[str], weight_kg: Optional[Sequence[float]] = None,
+                  age: Optional[Sequence[float]] = None, kidney_function: Optional[Sequence[str]] = None) -> DoseBatch:
+    table = rules.DRUG_RULES
+    n = len(drug)
+    drugs = _text(drug, n)
+    conds = _text(condition, n)
+    weight = _numeric(weight_kg, n)
+    ages = _numeric(age, n)
+    kidney = _text(kidney_function, n)
+
+    mg_day = np.zeros(n)
+    renal_f = np.ones(n)
+    elderly_f = np.ones(n)
+    low = np.full(n, np.nan)
+    high = np.full(n, np.nan)
+    max_single = np.full(n, np.nan)
+    error = np.full(n, None, dtype=object)
+
+    # compute_dose checks drug, then condition, then whether the drug is known.
+    for name, rows in _groups(drugs):
+        rule = table.get(name)
+        if not name:
+            error[rows] = [ExecutionError("Missing parameter: drug") for _ in rows]
+            continue
+        rows_missing = rows[conds[rows] == ""]
+        error[rows_missing] = [ExecutionError("Missing parameter: condition") for _ in rows_missing]
+        if rule is None:
+            rows_unknown = rows[conds[rows] != ""]
+            error[rows_unknown] = [UnknownDrugError(name) for _ in rows_unknown]
+            continue
+        mg_day[rows] = _base_mg_day(rule.calculator.spec, weight[rows], conds[rows])
+        renal_f[rows] = rule.renal_adjust_factor
+        elderly_f[rows] = rule.elderly_adjust_factor
+        low[rows], high[rows] = rule.safe_range
+        if rule.max_single_dose_mg:
+            max_single[rows] = rule.max_single_dose_mg
+
+    renal = np.isin(kidney, RENAL_IMPAIRED)
+    elderly = ages >= 65
+    adjust = np.where(renal, renal_f, 1.0)
+    adjust = np.where(elderly, adjust * elderly_f, adjust)
+    adjusted = mg_day * adjust
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        doses = np.maximum(1.0, np.rint(adjusted / max_single))
+        per_dose = np.minimum(max_single, adjusted / doses)
+        doses_per_day = np.maximum(1.0, np.rint(adjusted / per_dose))
+    zero = (per_dose == 0) & np.equal(error, None)
+    error[zero] = [ZeroDivisionError("float division by zero") for _ in range(int(zero.sum()))]
+
+    batch = DoseBatch(
+        drug=drugs,
+        condition=conds,
+        weight_kg=weight,
+        adjust_factor=adjust,
+        adjusted_mg_per_day=adjusted,
+        recommended_mg_per_day=_round(adjusted),
+        per_dose_mg=_round(per_dose),
+        doses_per_day=np.where(np.isnan(doses_per_day), 0, doses_per_day).astype(int),
+        safety_low=low,
+        safety_high=high,
+        exceeds_limit=adjusted > high,
+        below_minimum=(adjusted < low) & (low > 0),
+        error=error,
+        table=table,
+    )
+    return batch
+
+
+@dataclass
+class ValidationBatch:
+    drug: np.ndarray
+    dose_mg_per_day: np.ndarray
+    safety_low: np.ndarray
+    safety_high: np.ndarray
+    exceeds_limit: np.ndarray
+    below_minimum: np.ndarray
+    error: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.drug)
+
+    @property
+    def status(self) -> np.ndarray:
+        failed = np.not_equal(self.error, None)
+        return np.where(failed, "ERROR", np.where(self.exceeds_limit, "EXCEEDS", np.where(self.below_minimum, "LOW", "OK")))
+
+    def messages(self) -> List[str]:
+        # validate_prescription's message per row, or the error a VALIDATE of the row raises
+        return [_message(*row) for row in zip(self.status.tolist(), self.error.tolist(), self.dose_mg_per_day.tolist(),
+                                              self.safety_low.tolist(), self.safety_high.tolist())]
+
+    def result(self, i: int) -> Dict[str, Any]:
+        # Same dict validate_prescription() returns for row i.
+        if self.error[i] is not None:
+            raise self.error[i]
+        status = str(self.status[i])
+        message = _message(status, None, float(self.dose_mg_per_day[i]), float(self.safety_low[i]), float(self.safety_high[i]))
+        return {"drug": str(self.drug[i]), "dose_mg_per_day": float(self.dose_mg_per_day[i]), "status": status,
+                "message": message, "alert": message if status == "EXCEEDS" else None}
+
+    def results(self) -> Iterator[Dict[str, Any]]:
+        for i in range(len(self)):
+            yield self.result(i)
+
+
+def _message(status: str, error: Optional[Exception], dose: float, low: float, high: float) -> str:
+    if status == "ERROR":
+        return str(error)
+    if status == "EXCEEDS":
+        return f"dose {dose:.0f} mg/day exceeds safety limit {high:.0f} mg/day"
+    if status == "LOW":
+        return f"dose {dose:.0f} mg/day below typical minimum {low:.0f} mg/day"
+    return "within safety range"
+
+def daily_doses_mg(dose: Sequence[float], unit: Optional[Sequence[str]] = None, weight_kg: Optional[Sequence[float]] = None,
+                   doses_per_day: Optional[Sequence[float]] = None):
+    # executor._daily_dose_mg over columns: (mg/day, error per row). A blank unit means mg;
+    # rows without a dose stay NaN.
+    n = len(dose)
+    amount = _numeric(dose, n)
+    units = _text(unit, n)
+    weight = _numeric(weight_kg, n)
+    per_day = _numeric(doses_per_day, n)
+    mg = np.full(n, np.nan)
+    error = np.full(n, None, dtype=object)
+    given = ~np.isnan(amount)
+    for u, rows in _groups(units):
+        rows = rows[given[rows]]     # a missing dose is reported by the caller, whatever its unit
+        dim, factor = UNIT_TABLE.get(u or "mg", (None, 0.0))
+        if dim not in ("mass", "daily", "per_kg_daily", "per_dose", "per_kg_dose"):
+            error[rows] = [ExecutionError(f"Unsupported dose unit '{u}'") for _ in rows]
+            continue
+        val = amount[rows] * factor
+        if dim in ("per_kg_daily", "per_kg_dose"):
+            missing = rows[np.isnan(weight[rows])]
+            error[missing] = [ExecutionError(f"Dose in {u} needs weight=<kg>") for _ in missing]
+            val = val * weight[rows]
+        if dim in ("per_dose", "per_kg_dose"):
+            missing = rows[np.isnan(per_day[rows]) & np.equal(error[rows], None)]
+            error[missing] = [ExecutionError(f"Dose in {u} needs doses_per_day=<n>") for _ in missing]
+            val = val * per_day[rows]
+        mg[rows] = val
+    return mg, error
+
+def validate_prescriptions(drug: Sequence[str], dose: Sequence[float], unit: Optional[Sequence[str]] = None,
+                           weight_kg: Optional[Sequence[float]] = None,
+                           doses_per_day: Optional[Sequence[float]] = None) -> ValidationBatch:
+    # VALIDATE PRESCRIPTION for every row at once; row i matches what the command reports.
+    table = rules.DRUG_RULES
+    n = len(drug)
+    drugs = _text(drug, n)
+    mg, error = daily_doses_mg(dose, unit, weight_kg, doses_per_day)
+    low = np.full(n, np.nan)
+    high = np.full(n, np.nan)
+    # the interpreter converts the dose, then checks that drug and dose are given, then the drug
+    missing = np.flatnonzero(np.equal(error, None) & ((drugs == "") | np.isnan(mg)))
+    error[missing] = [InterpreterError("VALIDATE requires 'drug' and 'dose'") for _ in missing]
+    for name, rows in _groups(drugs):
+        rule = table.get(name)
+        if rule is None:
+            rows = rows[np.equal(error[rows], None)]
+            error[rows] = [UnknownDrugError(name) for _ in rows]
+            continue
+        low[rows], high[rows] = rule.safe_range
+    return ValidationBatch(
+        drug=drugs,
+        dose_mg_per_day=mg,
+        safety_low=low,
+        safety_high=high,
+        exceeds_limit=mg > high,
+        below_minimum=(mg < low) & (low > 0),
+        error=error,
+    )
@@ -0,0 +1,182 @@
+from __future__ import annotations
+from typing import Callable, Dict, Any, List
+import argparse, json, os, platform, random, statistics, sys, tempfile, time
+import executor
+from lexer import lex
+from parser import Parser
+from executor import normalize_ctx, compute_dose, check_interaction, record_regimen, report_regimen
+from rules import DRUG_RULES, INTERACTIONS
+
+CONDITIONS = ["hypertension", "diabetes", "infection", "pain", "fever", "asthma"]
+KIDNEY = ["normal", "impaired", "reduced", "ckd"]
+
+def make_patients(n: int, rng: random.Random) -> List[Dict[str, Any]]:
+    drugs = sorted(DRUG_RULES)
+    return [{"drug": rng.choice(drugs), "condition": rng.choice(CONDITIONS), "weight": f"{rng.uniform(3, 150):.1f}kg",
+             "age": str(rng.randint(0, 100)), "kidney_function": rng.choice(KIDNEY), "patient_id": f"P{i:06d}"}
+            for i in range(n)]
+
+def make_commands(patients: List[Dict[str, Any]], rng: random.Random) -> List[str]:
+    drugs = sorted(DRUG_RULES)
+    out = []
+    for p in patients:
+        kind = rng.random()
+        if kind < 0.6:
+            out.append("CALCULATE DOSE FOR " + ", ".join(f"{k}={p[k]}" for k in ("drug", "condition", "weight", "age", "kidney_function")))
+        elif kind < 0.8:
+            out.append(f"CHECK INTERACTION BETWEEN {rng.choice(drugs)} AND {rng.choice(drugs)}")
+        elif kind < 0.9:
+            out.append(f"VALIDATE PRESCRIPTION drug={p['drug']}, dose={rng.randint(1, 40) * 50}mg")
+        else:
+            out.append(f"ADJUST DOSE FOR drug={p['drug']}, condition={p['condition']}, age={p['age']}, kidney_function={p['kidney_function']}")
+    return out
+
+def measure(fn: Callable[[], int], repeat: int) -> Dict[str, Any]:
+    # fn runs one round and returns the number of operations it performed.
+    samples = []
+    ops = 0
+    for _ in range(repeat):
+        t0 = time.perf_counter_ns()
+        ops = fn()
+        samples.append((time.perf_counter_ns() - t0) / max(ops, 1))
+    return {"ns_per_op": statistics.median(samples), "min_ns_per_op": min(samples), "ops": ops, "repeat": repeat}
+
+def bench_pipeline(commands: List[str], patients: List[Dict[str, Any]], repeat: int) -> Dict[str, Any]:
+    token_lists = [lex(c) for c in commands]
+    ctx_params = [{k: p[k] for k in ("drug", "condition", "weight", "age", "kidney_function")} for p in patients]
+    ctxs = [normalize_ctx(p) for p in ctx_params]
+    pairs = [tuple(k) for k in INTERACTIONS] + [(a, b) for a in sorted(DRUG_RULES) for b in sorted(DRUG_RULES)]
+
+    def run_lex():
+        for c in commands:
+            lex(c)
+        return len(commands)
+
+    def run_parse():
+        for t in token_lists:
+            Parser(t).parse()
+        return len(token_lists)
+
+    def run_normalize():
+        for p in ctx_params:
+            normalize_ctx(p)
+        return len(ctx_params)
+
+    def run_interaction():
+        for a, b in pairs:
+            check_interaction(a, b)
+        return len(pairs)
+
+    results = {
+        "lexer.lex": measure(run_lex, repeat),
+        "Parser.parse": measure(run_parse, repeat),
+        "normalize_ctx": measure(run_normalize, repeat),
+        "compute_dose": bench_compute(ctxs, repeat),
+        "check_interaction": measure(run_interaction, repeat),
+        "compute_dose[cached]": bench_compute(ctxs, repeat, cache_size=len(ctxs)),
+    }
+    return results
+
+def bench_compute(ctxs: List[Dict[str, Any]], repeat: int, cache_size: int = 0) -> Dict[str, Any]:
+    # compute_dose over ctxs with a dose cache of cache_size entries (0: none); a cache is
+    # warmed by one round first, and the configured cache is put back afterwards.
+    def run_compute():
+        for c in ctxs:
+            compute_dose(c)
+        return len(ctxs)
+
+    cache = executor.dose_cache
+    executor.configure_dose_cache(cache_size)
+    try:
+        if cache_size:
+            run_compute()
+        return measure(run_compute, repeat)
+    finally:
+        executor.dose_cache = cache
+
+def bench_store(backend: str, sizes: List[int], writes: int, reads: int, repeat: int, rng: random.Random) -> Dict[str, Any]:
+    results = {}
+    entry = {"type": "dose", **compute_dose(normalize_ctx({"drug": "metformin", "condition": "diabetes", "weight": "70kg"}))}
+    for size in sizes:
+        census = max(1, size // 20)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "regimens." + ("db" if backend == "sqlite" else "jsonl"))
+            executor.configure_store(backend, path)
+            store = executor.get_store()
+            store.record_many((f"P{i % census:06d}", entry) for i in range(size))
+            pids = [f"P{rng.randrange(census):06d}" for _ in range(max(writes, reads))]
+
+            def run_record():
+                for pid in pids[:writes]:
+                    record_regimen(pid, entry)
+                return writes
+
+            def run_report():
+                for pid in pids[:reads]:
+                    report_regimen(pid)
+                return reads
+
+            results[f"record_regimen[{backend},{size}]"] = measure(run_record, repeat)
+            results[f"report_regimen[{backend},{size}]"] = measure(run_report, repeat)
+            store.close()
+    return results
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], threshold: float) -> List[str]:
+    regressions = []
+    for name, base in baseline.get("results", {}).items():
+        cur = current["results"].get(name)
+        if cur is None:
+            continue
+        ratio = cur["ns_per_op"] / base["ns_per_op"] if base["ns_per_op"] else 1.0
+        flag = "REGRESSION" if ratio > 1 + threshold else ""
+        print(f"{name:45s} {base['ns_per_op']:12.0f} -> {cur['ns_per_op']:12.0f} ns/op  x{ratio:5.2f} {flag}", file=sys.stderr)
+        if flag:
+            regressions.append(name)
+    return regressions
+
+def main(argv: List[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Benchmark the interpreter hot paths.")
+    ap.add_argument("-o", "--output", default="-", help="write results JSON here (default: stdout)")
+    ap.add_argument("--compare", metavar="BASELINE", help="compare against a previous results JSON")
+    ap.add_argument("--threshold", type=float, default=0.15, help="allowed slowdown before flagging (default 0.15 = 15%%)")
+    ap.add_argument("--commands", type=int, default=5000, help="synthetic commands/patients in the corpus")
+    ap.add_argument("--sizes", default="1000,10000,100000", help="regimen store sizes (entries) to benchmark")
+    ap.add_argument("--backends", default="jsonl,sqlite")
+    ap.add_argument("--writes", type=int, default=200)
+    ap.add_argument("--reads", type=int, default=200)
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--seed", type=int, default=1234)
+    args = ap.parse_args(argv)
+
+    rng = random.Random(args.seed)
+    patients = make_patients(args.commands, rng)
+    commands = make_commands(patients, rng)
+    results = bench_pipeline(commands, patients, args.repeat)
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    backend, path = executor.REGIMEN_BACKEND, executor.REGIMEN_PATH
+    try:
+        for name in [b for b in args.backends.split(",") if b]:
+            results.update(bench_store(name, sizes, args.writes, args.reads, args.repeat, rng))
+    finally:
+        executor.configure_store(backend, path)
+    report = {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(), "seed": args.seed,
+                 "commands": args.commands, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output == "-":
+        print(text)
+    else:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print(f"{len(regressions)} benchmark(s) slower than baseline by more than {args.threshold:.0%}", file=sys.stderr)
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+from __future__ import annotations
+from typing import Callable, Optional
+import os
+import numpy as np
+import pandas as pd
+from batch import validate_prescriptions
+
+# Prescription files (CSV or Excel) validated in one DataFrame pass per chunk: the columns are
+# parsed with pandas string methods and checked by batch.validate_prescriptions, so no row
+# goes through the interpreter. Each row gets the status and message VALIDATE PRESCRIPTION
+# would report for it.
+#
+# Columns (case-insensitive): drug and dose are required; dose is a number or "500mg",
+# "10mg/kg/day" etc. Optional: unit (for plain-number doses), weight (kg or "70kg") and
+# doses_per_day.
+
+REQUIRED = ("drug", "dose")
+RESULT_COLUMNS = ("dose_mg_per_day", "safety_low_mg_day", "safety_high_mg_day", "status", "message")
+CHUNK_SIZE = 10000
+
+_NUMBER_UNIT = r"^\s*(\d+(?:\.\d+)?)\s*([A-Za-z/]+)?\s*$"
+
+def read_prescriptions(file, name: str = "") -> pd.DataFrame:
+    # Excel by extension (needs openpyxl), CSV otherwise; every column is read as text.
+    # Legacy .xls would need xlrd, which is not a dependency.
+    ext = os.path.splitext(name or getattr(file, "name", ""))[1].lower()
+    if ext == ".xls":
+        raise ValueError("legacy .xls files are not supported; save the sheet as .xlsx or CSV")
+    if ext in (".xlsx", ".xlsm"):
+        return pd.read_excel(file, dtype=str)
+    return pd.read_csv(file, dtype=str, skipinitialspace=True)
+
+def _split(col: pd.Series):
+    # (number, unit, given, invalid): "500mg" -> 500.0, "mg"; blank cells are not given.
+    # Order files repeat the same few values, so only distinct cells are parsed.
+    codes, uniques = pd.factorize(col)
+    text = pd.Series(uniques, dtype="string").str.strip()
+    parts = text.str.extract(_NUMBER_UNIT)
+    # code -1 (a missing cell) picks the appended blank entry
+    given = np.append((text.notna() & (text != "")).to_numpy(dtype=bool), False)
+    number = np.append(pd.to_numeric(parts[0], errors="coerce").to_numpy(dtype=float, na_value=np.nan), np.nan)
+    unit = np.append(parts[1].str.lower().fillna("").to_numpy(dtype=object), "")
+    invalid = given & np.append(parts[0].isna().to_numpy(dtype=bool), False)
+    return number[codes], unit[codes], given[codes], invalid[codes]
+
+def _text(col: pd.Series) -> np.ndarray:
+    codes, uniques = pd.factorize(col)
+    return np.append(pd.Series(uniques, dtype="string").str.strip().str.lower().fillna("").to_numpy(dtype=object), "")[codes]
+
+def _invalid(col: pd.Series, rows: np.ndarray) -> np.ndarray:
+    values = col.to_numpy(dtype=object)[rows]
+    return np.array([f"Invalid numeric value '{str(v).strip()}'" for v in values], dtype=object)
+
+def validate_chunk(df: pd.DataFrame) -> pd.DataFrame:
+    cols = {str(c).strip().lower(): c for c in df.columns}
+    missing = [c for c in REQUIRED if c not in cols]
+    if missing:
+        raise ValueError(f"missing column(s): {', '.join(missing)}")
+    n = len(df)
+    blank = pd.Series([None] * n, index=df.index, dtype=object)
+    column = lambda key: df[cols[key]] if key in cols else blank
+    problem = np.full(n, None, dtype=object)
+
+    # the interpreter normalizes weight first, then the dose; the first problem is reported
+    w, w_unit, w_given, w_invalid = _split(column("weight"))
+    problem[w_invalid] = _invalid(column("weight"), w_invalid)
+    not_kg = w_given & ~w_invalid & (w_unit != "") & (w_unit != "kg")
+    problem[not_kg] = [f"Expected weight in kg, got '{u}'" for u in w_unit[not_kg]]
+    weight_kg = np.where(w_given & ~w_invalid & ~not_kg, w, np.nan)
+
+    dose, unit, _, d_invalid = _split(column("dose"))
+    d_invalid &= np.equal(problem, None)
+    problem[d_invalid] = _invalid(column("dose"), d_invalid)
+    if "unit" in cols:
+        unit = np.where(unit == "", _text(column("unit")), unit)
+    per_day, _, _, _ = _split(column("doses_per_day"))
+
+    checked = validate_prescriptions(_text(column("drug")), dose, unit, weight_kg, per_day)
+    status = checked.status.astype(object)
+    message = np.array(checked.messages(), dtype=object)
+    failed = np.not_equal(problem, None)
+    status[failed] = "ERROR"
+    message[failed] = problem[failed]
+    out = pd.DataFrame({
+        "dose_mg_per_day": np.round(checked.dose_mg_per_day, 2),
+        "safety_low_mg_day": checked.safety_low,
+        "safety_high_mg_day": checked.safety_high,
+        "status": status,
+        "message": message,
+    }, index=df.index)
+    out.loc[status == "ERROR", list(RESULT_COLUMNS[:3])] = np.nan
+    return pd.concat([df.drop(columns=[c for c in RESULT_COLUMNS if c in df.columns]), out], axis=1)
+
+def validate_frame(df: pd.DataFrame, chunk_size: int = CHUNK_SIZE,
+                   progress: Optional[Callable[[int, int], None]] = None) -> pd.DataFrame:
+    # The annotated frame, validated chunk by chunk; progress(done, total) is called after each.
+    total = len(df)
+    parts = []
+    for start in range(0, total, chunk_size):
+        parts.append(validate_chunk(df.iloc[start:start + chunk_size]))
+        if progress is not None:
+            progress(min(start + chunk_size, total), total)
+    if not parts:
+        return validate_chunk(df)
+    return pd.concat(parts)
@@ -0,0 +1,66 @@
+from __future__ import annotations
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+import threading, time
+
+_MISSING = object()
+
+class LRUCache:
+    # With a ttl (seconds), entries older than ttl count as misses and are dropped when looked up.
+    def __init__(self, maxsize: int = 256, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            value = self._data.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            if self.ttl is not None:
+                value, expires = value
+                if time.monotonic() >= expires:
+                    del self._data[key]
+                    self.misses += 1
+                    return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Hashable, value: Any):
+        if self.maxsize <= 0:
+            return
+        if self.ttl is not None:
+            value = (value, time.monotonic() + self.ttl)
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Optional[Hashable] = None):
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def resize(self, maxsize: int):
+        with self._lock:
+            self.maxsize = maxsize
+            while len(self._data) > max(maxsize, 0):
+                self._data.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "size": len(self._data), "maxsize": self.maxsize,
+                    "ttl": self.ttl,
+                    "hit_rate": (self.hits / total) if total else 0.0}
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -0,0 +1,99 @@
+from __future__ import annotations
+from typing import Dict, Any, Iterable, Iterator, List
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+from itertools import islice
+import argparse, csv, json, os, sys
+from executor import get_store
+from interpreter import run
+
+ROW_FIELDS = ("drug", "condition", "weight", "age", "kidney_function", "patient_id", "dose")
+
+def row_to_command(row: Dict[str, Any]) -> str:
+    if row.get("command"):
+        return str(row["command"])
+    params = ", ".join(f"{k}={row[k]}" for k in ROW_FIELDS if row.get(k) not in (None, ""))
+    verb = "VALIDATE PRESCRIPTION" if row.get("dose") not in (None, "") else "CALCULATE DOSE FOR"
+    return f"{verb} {params}"
+
+def read_commands(stream, fmt: str) -> Iterator[str]:
+    if fmt == "csv":
+        for row in csv.DictReader(stream):
+            yield row_to_command({k.strip().lower(): (v or "").strip() for k, v in row.items() if k})
+    elif fmt == "jsonl":
+        for line in stream:
+            if line.strip():
+                yield row_to_command({str(k).lower(): v for k, v in json.loads(line).items()})
+    else:
+        for line in stream:
+            if line.strip():
+                yield line.strip()
+
+def run_chunk(commands: List[str]) -> List[Dict[str, Any]]:
+    out = []
+    # One store batch per chunk, so a chunk's regimen writes share a single fsync.
+    with ExitStack() as stack:
+        if any("patient_id" in c.lower() for c in commands):
+            stack.enter_context(get_store().batch())
+        for command in commands:
+            try:
+                out.append({"command": command, "status": "success", "result": run(command)})
+            except Exception as e:
+                # a bad row (e.g. weight=0) gets its error record; the rest of the chunk still runs
+                out.append({"command": command, "status": "error", "error": str(e), "error_type": type(e).__name__})
+    return out
+
+def _chunks(items: Iterable[str], size: int) -> Iterator[List[str]]:
+    it = iter(items)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+def run_stream(commands: Iterable[str], workers: int = 0, chunk_size: int = 256) -> Iterator[Dict[str, Any]]:
+    # Results come back in input order; at most 2 chunks per worker are in flight at once.
+    if workers <= 1:
+        for chunk in _chunks(commands, chunk_size):
+            yield from run_chunk(chunk)
+        return
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk in _chunks(commands, chunk_size):
+            pending.append(pool.submit(run_chunk, chunk))
+            if len(pending) >= workers * 2:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+def main(argv: List[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Run medical prescription commands in bulk and write JSONL results.")
+    ap.add_argument("input", nargs="?", default="-", help="input file (default: stdin)")
+    ap.add_argument("-f", "--format", choices=("commands", "csv", "jsonl"),
+                    help="input format (default: from the file extension, else one command per line)")
+    ap.add_argument("-o", "--output", default="-", help="output JSONL file (default: stdout)")
+    ap.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 1, help="worker processes (default: all cores)")
+    ap.add_argument("--chunk-size", type=int, default=256, help="commands per worker task")
+    args = ap.parse_args(argv)
+
+    fmt = args.format
+    if fmt is None:
+        ext = os.path.splitext(args.input)[1].lower()
+        fmt = {".csv": "csv", ".jsonl": "jsonl", ".ndjson": "jsonl"}.get(ext, "commands")
+    src = sys.stdin if args.input == "-" else open(args.input, "r", newline="")
+    dst = sys.stdout if args.output == "-" else open(args.output, "w")
+    failed = 0
+    try:
+        for record in run_stream(read_commands(src, fmt), workers=args.workers, chunk_size=args.chunk_size):
+            failed += record["status"] == "error"
+            dst.write(json.dumps(record) + "\n")
+    finally:
+        if src is not sys.stdin:
+            src.close()
+        if dst is not sys.stdout:
+            dst.close()
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
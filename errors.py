@@ -22,6 +22,9 @@ class UnknownConditionError(ExecutionError):
         super().__init__(f"Unknown condition: {condition}")
         self.condition = condition
 
+class FormularyError(InterpreterError):
+    pass
+
 class SafetyLimitExceeded(ExecutionError):
     def __init__(self, message: str, computed: float, limit: float):
         super().__init__(message)
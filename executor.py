@@ -1,37 +1,142 @@
 from __future__ import annotations
-from typing import Dict, Any, Tuple
-import json, os
+from typing import Dict, Any, Iterator, List, Tuple
+from dataclasses import asdict
+import os, re, threading, time
 from errors import ExecutionError, UnknownDrugError, UnknownConditionError, SafetyLimitExceeded
-from rules import DRUG_RULES, INTERACTIONS
+import rules
+from rules import INTERACTIONS
+from lexer import UNITS, DURATION_UNITS
+from store import open_store
+from alerts import AlertRegistry
+from instrument import timed
+from cache import LRUCache
+import metrics
+import formulary
 
 STATE_FILE = os.path.join(os.getcwd(), "regimens.json")
+STORE_FILES = {
+    "jsonl": os.path.join(os.getcwd(), "regimens.jsonl"),
+    "sqlite": os.path.join(os.getcwd(), "regimens.db"),
+}
+REGIMEN_BACKEND = os.environ.get("REGIMEN_BACKEND", "jsonl")
+REGIMEN_PATH = os.environ.get("REGIMEN_PATH")
+INTERACTION_DB = os.environ.get("INTERACTION_DB")
+FORMULARY_PATH = os.environ.get("FORMULARY_PATH")
+ALERT_RULES_PATH = os.environ.get("ALERT_RULES_PATH", os.path.join(os.getcwd(), "alert_rules.json"))
+DOSE_CACHE_SIZE = int(os.environ.get("DOSE_CACHE_SIZE", "0"))
+DOSE_CACHE_TTL = float(os.environ.get("DOSE_CACHE_TTL", "0")) or None
 
-def _load_state():
-    if os.path.exists(STATE_FILE):
-        with open(STATE_FILE, "r") as f:
-            return json.load(f)
+RENAL_IMPAIRED = ("impaired", "reduced", "ckd")
+NO_INTERACTION = "no known interaction in demo database"
 
-    return {"patients": {}}
+_store = None
+_alerts = None
+_store_lock = threading.Lock()
+_interaction_db = None
 
-def _save_state(state):
-    with open(STATE_FILE, "w") as f:
-        json.dump(state, f, indent=2)
+# Opt-in memo of compute_dose results, keyed on the rule table version and the context fields
+# compute_dose reads. Off (maxsize 0) unless DOSE_CACHE_SIZE or configure_dose_cache() sets a size.
+dose_cache = LRUCache(DOSE_CACHE_SIZE, ttl=DOSE_CACHE_TTL)
+_dose_cache_version = None
 
-def parse_number_unit(value: str) -> tuple[float, str | None]:
-    import re
-    m = re.match(r"^(\d+(?:\.\d+)?)([A-Za-z/]+)?$", value)
+if FORMULARY_PATH:
+    formulary.reload(FORMULARY_PATH)
+
+def configure_store(backend: str | None = None, path: str | None = None):
+    global _store, REGIMEN_BACKEND, REGIMEN_PATH
+    with _store_lock:
+        if _store is not None:
+            _store.close()
+            _store = None
+        if backend is not None:
+            REGIMEN_BACKEND = backend
+        REGIMEN_PATH = path
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                path = REGIMEN_PATH or STORE_FILES.get(REGIMEN_BACKEND, "")
+                _store = open_store(REGIMEN_BACKEND, path, legacy_path=STATE_FILE)
+    return _store
+
+def configure_alerts(path: str | None = None):
+    # Keep alert rules in another file; None keeps them in memory only.
+    global _alerts, ALERT_RULES_PATH
+    with _store_lock:
+        ALERT_RULES_PATH = path
+        _alerts = None
+
+def get_alerts() -> AlertRegistry:
+    global _alerts
+    if _alerts is None:
+        with _store_lock:
+            if _alerts is None:
+                _alerts = AlertRegistry(ALERT_RULES_PATH)
+    return _alerts
+
+def configure_dose_cache(maxsize: int, ttl: float | None = None):
+    global dose_cache
+    dose_cache = LRUCache(maxsize, ttl=ttl)
+
+def configure_interactions(path: str | None = None):
+    # Point check_interaction at a database compiled by interaction_db.py; None goes back to rules.INTERACTIONS.
+    global _interaction_db, INTERACTION_DB
+    with _store_lock:
+        if _interaction_db is not None:
+            _interaction_db.close()
+            _interaction_db = None
+        INTERACTION_DB = path
+
+def get_interaction_db():
+    global _interaction_db
+    if _interaction_db is None and INTERACTION_DB:
+        with _store_lock:
+            if _interaction_db is None:
+                from interaction_db import InteractionDB
+                _interaction_db = InteractionDB(INTERACTION_DB)
+    return _interaction_db
+
+# unit -> (dimension, factor to the dimension's base unit); covers every unit the lexer knows.
+# Bases: mass mg, volume ml, daily mg/day, weight-based mg/kg/day, per-dose mg/dose and mg/kg/dose.
+UNIT_TABLE: Dict[str, Tuple[str, float]] = {
+    "mcg": ("mass", 0.001), "mg": ("mass", 1.0), "g": ("mass", 1000.0), "kg": ("mass", 1000000.0),
+    "ml": ("volume", 1.0),
+    "mcg/day": ("daily", 0.001), "mg/day": ("daily", 1.0),
+    "mg/kg/day": ("per_kg_daily", 1.0),
+    "mg/dose": ("per_dose", 1.0),
+    "mg/kg/dose": ("per_kg_dose", 1.0),
+    "h": ("time", 1.0),
+    "d": ("time", 24.0),
+}
+# checked on import, and not with assert, which -O strips
+if not UNITS | DURATION_UNITS <= UNIT_TABLE.keys():
+    raise RuntimeError(f"no conversion for units {sorted((UNITS | DURATION_UNITS) - UNIT_TABLE.keys())}")
+
+_NUMBER_UNIT = re.compile(r"^(\d+(?:\.\d+)?)([A-Za-z/]+)?$")
+
+def parse_number_unit(value) -> tuple[float, str | None]:
+    # Parsed commands carry Quantity tuples; the regex is only for raw strings (JSON/CSV input).
+    if isinstance(value, tuple):
+        return float(value[0]), value[1]
+    if isinstance(value, (int, float)):
+        return float(value), None
+    m = _NUMBER_UNIT.match(str(value).strip())
     if not m:
         raise ExecutionError(f"Invalid numeric value '{value}'")
     n = float(m.group(1))
     unit = m.group(2)
-    return n, unit
+    return n, unit and unit.lower()
 
+@timed("normalize")
 def normalize_ctx(params):
     ctx = {}
     p = {str(k).lower(): v for k, v in params.items()}
     if "weight" in p:
+        # kg or a plain number; other mass units are drug amounts (70mg would be 0.00007 kg)
         n, u = parse_number_unit(p["weight"])
-        if u and u.lower() != "kg":
+        if u not in (None, "kg"):
             raise ExecutionError(f"Expected weight in kg, got '{u}'")
         ctx["weight_kg"] = n
     if "age" in p:
@@ -39,31 +144,89 @@ def normalize_ctx(params):
         ctx["age"] = int(n)
         ctx["elderly"] = ctx["age"] >= 65
     if "kidney_function" in p:
-        ctx["kidney_function"] = p["kidney_function"].lower()
-        ctx["renal_impaired"] = ctx["kidney_function"] in ("impaired", "reduced", "ckd")
+        ctx["kidney_function"] = str(p["kidney_function"]).lower()
+        ctx["renal_impaired"] = ctx["kidney_function"] in RENAL_IMPAIRED
     if "condition" in p:
-        ctx["condition"] = p["condition"].lower()
+        ctx["condition"] = str(p["condition"]).lower()
     if "patient_id" in p:
         ctx["patient_id"] = str(p["patient_id"])
     if "drug" in p:
-        ctx["drug"] = p["drug"].lower()
+        ctx["drug"] = str(p["drug"]).lower()
     if "dose" in p:
-        n, u = parse_number_unit(p["dose"])
-        if u and u.lower() not in ("mg", "mcg", "g"):
-            raise ExecutionError(f"Unsupported dose unit '{u}'")
-        factor = {"mg": 1.0, "mcg": 0.001, "g": 1000.0}.get((u or "mg").lower(), 1.0)
-        ctx["dose_mg_input"] = n * factor
+        ctx["dose_mg_input"] = _daily_dose_mg(*parse_number_unit(p["dose"]), ctx, p)
+    for key in ("limit", "offset"):
+        if key in p:
+            n, u = parse_number_unit(p[key])
+            if u is not None or n != int(n) or (key == "limit" and n < 1):
+                raise ExecutionError(f"{key} must be a whole number{' of at least 1' if key == 'limit' else ''}, got '{p[key]}'")
+            ctx[key] = int(n)
+    if "cursor" in p:
+        ctx["cursor"] = str(p["cursor"])
+    for key, label in (("since", "SINCE"), ("window", "window")):
+        if key in p:
+            n, u = parse_number_unit(p[key])
+            dim, factor = UNIT_TABLE.get(u or "h", (None, 0.0))
+            if dim != "time":
+                raise ExecutionError(f"Expected {label} as a duration such as 24h or 7d, got '{p[key]}'")
+            ctx[key + "_hours"] = n * factor
+    if "threshold" in p:
+        n, u = parse_number_unit(p["threshold"])
+        dim, factor = UNIT_TABLE.get(u or "mg", (None, 0.0))
+        if dim not in ("mass", "daily"):
+            raise ExecutionError(f"Alert threshold must be a daily amount such as 2000mg, got '{u}'")
+        ctx["threshold_mg"] = n * factor
+    if "percent" in p:
+        n, u = parse_number_unit(p["percent"])
+        if u is not None:
+            raise ExecutionError(f"percent must be a number, got '{p['percent']}'")
+        ctx["percent"] = n
     return ctx
 
 
+def _daily_dose_mg(n: float, unit: str | None, ctx: Dict[str, Any], p: Dict[str, Any]) -> float:
+    # VALIDATE compares a daily amount; weight-based and per-dose units need weight / doses_per_day.
+    dim, factor = UNIT_TABLE.get(unit or "mg", (None, 0.0))
+    if dim in ("mass", "daily"):
+        return n * factor
+    if dim is None or dim in ("volume", "time"):
+        raise ExecutionError(f"Unsupported dose unit '{unit}'")
+    if dim in ("per_kg_daily", "per_kg_dose"):
+        if ctx.get("weight_kg") is None:
+            raise ExecutionError(f"Dose in {unit} needs weight=<kg>")
+        n *= ctx["weight_kg"]
+    if dim in ("per_dose", "per_kg_dose"):
+        if "doses_per_day" not in p:
+            raise ExecutionError(f"Dose in {unit} needs doses_per_day=<n>")
+        n *= parse_number_unit(p["doses_per_day"])[0]
+    return n * factor
+
+
+@timed("calculate")
 def compute_dose(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    global _dose_cache_version
     drug = ctx.get("drug")
     condition = ctx.get("condition")
     if not drug:
         raise ExecutionError("Missing parameter: drug")
     if condition is None:
         raise ExecutionError("Missing parameter: condition")
-    rule = DRUG_RULES.get(drug)
+    table = rules.DRUG_RULES
+    cache = dose_cache
+    if cache.maxsize <= 0:
+        return _compute_dose(ctx, table, drug, condition)
+    if table.version != _dose_cache_version:
+        # entries for the old table can never hit again; free them now
+        cache.invalidate()
+        _dose_cache_version = table.version
+    key = (table.version, drug, condition, ctx.get("weight_kg"), bool(ctx.get("renal_impaired")), bool(ctx.get("elderly")))
+    result = cache.get(key)
+    if result is None:
+        result = _compute_dose(ctx, table, drug, condition)
+        cache.put(key, result)
+    return dict(result)
+
+def _compute_dose(ctx: Dict[str, Any], table, drug: str, condition: str) -> Dict[str, Any]:
+    rule = table.get(drug)
     if not rule:
         raise UnknownDrugError(drug)
     mg_day, rationale = rule.calculator(ctx)
@@ -95,13 +258,71 @@ def compute_dose(ctx: Dict[str, Any]) -> Dict[str, Any]:
         "alert": alert,
     }
 
+@timed("interaction")
 def check_interaction(drug_a: str, drug_b: str) -> str:
     a, b = drug_a.lower(), drug_b.lower()
+    db = get_interaction_db()
+    if db is not None:
+        return db.get(a, b, NO_INTERACTION)
     key = frozenset([a,b])
-    return INTERACTIONS.get(key, "no known interaction in demo database")
+    return INTERACTIONS.get(key, NO_INTERACTION)
+
+SEVERITIES = ("caution", "monitor", "safe")
 
+def interaction_severity(message: str) -> str:
+    # Messages in rules.INTERACTIONS lead with their severity ("caution: ...", "safe in most cases ...").
+    word = message.split(":", 1)[0].split(" ", 1)[0].lower()
+    return word if word in SEVERITIES else "none"
+
+def build_interaction_index(interactions: Dict[frozenset, str]) -> Dict[str, Dict[str, str]]:
+    # drug -> {other drug -> message}; both directions, so any drug in a list finds its partners.
+    index: Dict[str, Dict[str, str]] = {}
+    for key, msg in interactions.items():
+        if len(key) != 2:
+            continue
+        a, b = sorted(key)
+        index.setdefault(a, {})[b] = msg
+        index.setdefault(b, {})[a] = msg
+    return index
+
+INTERACTION_INDEX = build_interaction_index(INTERACTIONS)
+
+@timed("interaction")
+def check_interactions(drugs) -> List[Dict[str, str]]:
+    # Every interacting pair in the list, in list order. Each drug only visits its own
+    # neighbours in the index, so the cost follows the list length and the hits, not n^2.
+    db = get_interaction_db()
+    if db is not None:
+        return [{"drug_a": a, "drug_b": b, "severity": interaction_severity(msg), "interaction": msg}
+                for a, b, msg in db.among(drugs)]
+    position: Dict[str, int] = {}
+    for d in drugs:
+        position.setdefault(str(d).lower(), len(position))
+    hits = []
+    for a, i in position.items():
+        for b, msg in INTERACTION_INDEX.get(a, {}).items():
+            if position.get(b, -1) > i:
+                hits.append((i, position[b], {"drug_a": a, "drug_b": b, "severity": interaction_severity(msg), "interaction": msg}))
+    hits.sort(key=lambda h: (h[0], h[1]))
+    return [h[2] for h in hits]
+
+def screen_interactions(drug: str, others) -> List[Dict[str, str]]:
+    # One drug against a set of others (e.g. a patient's regimen): one lookup per other drug.
+    drug = drug.lower()
+    db = get_interaction_db()
+    partners = INTERACTION_INDEX.get(drug, {}) if db is None else None
+    hits = []
+    for other in sorted(others):
+        if other == drug:
+            continue
+        msg = partners.get(other) if db is None else db.get(drug, other)
+        if msg:
+            hits.append({"drug_a": drug, "drug_b": other, "severity": interaction_severity(msg), "interaction": msg})
+    return hits
+
+@timed("validate")
 def validate_prescription(drug: str, dose_mg: float) -> Dict[str, Any]:
-    rule = DRUG_RULES.get(drug)
+    rule = rules.DRUG_RULES.get(drug)
     if not rule:
         raise UnknownDrugError(drug)
     low, high = rule.safe_range
@@ -117,15 +338,78 @@ def validate_prescription(drug: str, dose_mg: float) -> Dict[str, Any]:
         message = f"dose {dose_mg:.0f} mg/day below typical minimum {low:.0f} mg/day"
     return {"drug": drug, "dose_mg_per_day": dose_mg, "status": status, "message": message, "alert": alert}
 
-def record_regimen(patient_id: str, entry: Dict[str, Any]):
-    state = _load_state()
-    state["patients"].setdefault(patient_id, []).append(entry)
-    _save_state(state)
+@timed("store")
+def record_regimen(patient_id: str, entry: Dict[str, Any]) -> List[Dict[str, str]]:
+    # Appends the entry and returns its drug's interactions with the drugs already on record
+    # for the patient; the store keeps that set current, so nothing is re-read.
+    store = get_store()
+    drug = entry.get("drug")
+    warnings = screen_interactions(drug, store.drugs(patient_id)) if drug else []
+    store.record(patient_id, entry)
+    return warnings
+
+@timed("store")
+def report_regimen(patient_id: str, since: float | None = None):
+    return get_store().report(patient_id, since)
+
+REPORT_PAGE_SIZE = 50
+
+@timed("store")
+def report_page(patient_id: str, since: float | None = None, limit: int = REPORT_PAGE_SIZE, offset: int = 0,
+                cursor: str | None = None) -> Dict[str, Any]:
+    # One page of a patient's regimen; pass next_cursor back as cursor= for the following page.
+    # total counts the window's entries (None on SQLite cursor pages, which skip the count).
+    entries, next_cursor, total = get_store().page(patient_id, since, cursor, offset, limit)
+    return {"entries": entries, "next_cursor": next_cursor, "total": total}
+
+def iter_regimen(patient_id: str, since: float | None = None, chunk: int = 500) -> Iterator[Dict[str, Any]]:
+    # Streams a regimen a page at a time, so a long stay is never held in memory at once.
+    cursor = None
+    while True:
+        entries, cursor, _ = get_store().page(patient_id, since, cursor, 0, chunk)
+        yield from entries
+        if cursor is None:
+            return
+
+CUMULATIVE_WINDOW_HOURS = 24.0
+
+def window_total(patient_id: str, drug: str, hours: float, now: float, pending_mg: float | None = None) -> float:
+    # mg of the drug ordered over the `hours` up to now: every order's mg/day counts once, plus
+    # pending_mg (an order about to be recorded). An order repeating the drug's last mg/day
+    # within a day of it is a recalculation and counts once (store.repeats). The stores keep
+    # running sums: a couple of lookups.
+    return get_store().cumulative(patient_id, drug, now - hours * 3600, now, pending_mg)
+
+@timed("store")
+def cumulative_dose(patient_id: str, drug: str, hours: float = CUMULATIVE_WINDOW_HOURS, now: float | None = None,
+                    pending_mg: float | None = None) -> Dict[str, Any]:
+    # window_total against the rule's daily limit times the days in the window (at least one).
+    now = time.time() if now is None else now
+    total = window_total(patient_id, drug, hours, now, pending_mg)
+    rule = rules.DRUG_RULES.get(drug)
+    limit = None if rule is None else rule.safe_range[1] * max(hours, 24.0) / 24
+    alert = None
+    if limit is not None and total > limit:
+        alert = f"{total:.0f} mg of {drug} over a {hours:g}h window exceeds {limit:.0f} mg"
+    return {"drug": drug, "window_hours": hours, "total_mg": round(total, 2),
+            "limit_mg": None if limit is None else round(limit, 2), "alert": alert}
 
-def report_regimen(patient_id: str):
-    state = _load_state()
-    return state["patients"].get(patient_id, [])
+def check_alert_rules(drug: str, patient_id: str | None, dose_mg: float, pending: bool = True) -> List[Dict[str, Any]]:
+    # Registered ALERT rules that apply to this drug and patient; window rules use
+    # window_total with dose_mg as the order being placed (pending=False: already recorded).
+    rule = rules.DRUG_RULES.get(drug)
+    safety = None if rule is None else rule.safe_range[1]
+    window = None
+    if patient_id is not None:
+        now = time.time()
+        window = lambda hours: window_total(patient_id, drug, hours, now, dose_mg if pending else None)
+    fired = get_alerts().evaluate(drug, patient_id, dose_mg, safety, window)
+    if fired and metrics.ENABLED:
+        metrics.rule_alerts_total.inc(metrics.drug_label(drug), amount=len(fired))
+    return [asdict(e) for e in fired]
 
 def enforce_alerts(result: Dict[str, Any]) -> None:
     if result.get("alert"):
+        if metrics.ENABLED:
+            metrics.safety_limit_exceeded_total.inc(metrics.drug_label(result.get("drug")))
         raise SafetyLimitExceeded(result["alert"], computed=result["recommended_mg_per_day"], limit=result["safety_range_mg_day"][1])
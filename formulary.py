@@ -0,0 +1,223 @@
+from __future__ import annotations
+from typing import Dict, Any, List, Optional
+import argparse, hashlib, json, os, sys, threading, warnings
+import rules
+from rules import DrugRule, RuleTable, per_kg_mg_day, fixed_mg_day, condition_based
+from errors import FormularyError
+
+# A formulary file describes DrugRules declaratively (JSON):
+#   {"version": "2024-06",
+#    "drugs": {"metformin": {"calculator": {"kind": "per_kg_mg_day", "mg_per_kg": 20, "cap": 2000},
+#                            "safe_range": [500, 2000], "max_single_dose_mg": 1000,
+#                            "renal_adjust_factor": 0.5, "elderly_adjust_factor": 0.8,
+#                            "conditions": ["diabetes"]}}}
+# Calculator kinds are the rules.py factories, with the same parameters as their `spec`.
+CALCULATORS = {"per_kg_mg_day": per_kg_mg_day, "fixed_mg_day": fixed_mg_day, "condition_based": condition_based}
+CALCULATOR_PARAMS = {
+    "per_kg_mg_day": {"mg_per_kg": True, "cap": True},
+    "fixed_mg_day": {"amount": True},
+    "condition_based": {"default": True, "by_condition": True, "cap": False},
+}
+SNAPSHOT_FORMAT = 2
+
+def _number(value: Any, where: str) -> float:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise FormularyError(f"{where}: expected a number, got {value!r}")
+    return float(value)
+
+def _calculator(calc: Any, where: str) -> Dict[str, Any]:
+    if not isinstance(calc, dict) or calc.get("kind") not in CALCULATORS:
+        raise FormularyError(f"{where}: calculator.kind must be one of {', '.join(CALCULATORS)}")
+    kind = calc["kind"]
+    params = CALCULATOR_PARAMS[kind]
+    unknown = set(calc) - set(params) - {"kind"}
+    if unknown:
+        raise FormularyError(f"{where}: unknown calculator parameter(s) {', '.join(sorted(unknown))}")
+    out: Dict[str, Any] = {"kind": kind}
+    for name, required in params.items():
+        value = calc.get(name)
+        if value is None:
+            if required:
+                raise FormularyError(f"{where}: {kind} requires '{name}'")
+            out[name] = None
+        elif name == "by_condition":
+            if not isinstance(value, dict):
+                raise FormularyError(f"{where}: by_condition must map condition -> mg/day")
+            out[name] = {str(c).lower(): _number(v, f"{where}.by_condition.{c}") for c, v in value.items()}
+        else:
+            out[name] = _number(value, f"{where}.{name}")
+    return out
+
+def _entry(name: str, entry: Any) -> Dict[str, Any]:
+    where = f"drugs.{name}"
+    if not isinstance(entry, dict):
+        raise FormularyError(f"{where}: expected an object")
+    sr = entry.get("safe_range")
+    if not isinstance(sr, (list, tuple)) or len(sr) != 2:
+        raise FormularyError(f"{where}: safe_range must be [low, high]")
+    low, high = _number(sr[0], f"{where}.safe_range"), _number(sr[1], f"{where}.safe_range")
+    if low > high:
+        raise FormularyError(f"{where}: safe_range low {low} exceeds high {high}")
+    msd = entry.get("max_single_dose_mg")
+    return {
+        "calculator": _calculator(entry.get("calculator"), f"{where}.calculator"),
+        "safe_range": (low, high),
+        "max_single_dose_mg": None if msd is None else _number(msd, f"{where}.max_single_dose_mg"),
+        "renal_adjust_factor": _number(entry.get("renal_adjust_factor", 1.0), f"{where}.renal_adjust_factor"),
+        "elderly_adjust_factor": _number(entry.get("elderly_adjust_factor", 1.0), f"{where}.elderly_adjust_factor"),
+        "conditions": tuple(str(c).lower() for c in entry.get("conditions", ())),
+    }
+
+def normalize(data: Any) -> Dict[str, Any]:
+    # Validated, plain-data form of a formulary; this is what snapshots store.
+    if not isinstance(data, dict) or not isinstance(data.get("drugs"), dict) or not data["drugs"]:
+        raise FormularyError("formulary must be an object with a non-empty 'drugs' object")
+    drugs = {str(name).lower(): _entry(str(name).lower(), entry) for name, entry in data["drugs"].items()}
+    digest = hashlib.sha256(json.dumps(drugs, sort_keys=True).encode()).hexdigest()[:12]
+    label = data.get("version")
+    return {"version": f"{label}@{digest}" if label else digest, "drugs": drugs}
+
+def build(spec: Dict[str, Any]) -> RuleTable:
+    table = RuleTable(version=spec["version"])
+    for name, e in spec["drugs"].items():
+        calc = dict(e["calculator"])
+        kind = calc.pop("kind")
+        table[name] = DrugRule(
+            calculator=CALCULATORS[kind](**calc),
+            safe_range=tuple(e["safe_range"]),
+            max_single_dose_mg=e["max_single_dose_mg"],
+            renal_adjust_factor=e["renal_adjust_factor"],
+            elderly_adjust_factor=e["elderly_adjust_factor"],
+            conditions=tuple(e["conditions"]),
+        )
+    return table
+
+def export(table: Optional[RuleTable] = None) -> Dict[str, Any]:
+    # Formulary document for a table, e.g. to start a formulary file from the built-in rules.
+    table = rules.DRUG_RULES if table is None else table
+    drugs = {}
+    for name, rule in table.items():
+        spec = getattr(rule.calculator, "spec", None)
+        if spec is None:
+            raise FormularyError(f"{name}: calculator has no spec and cannot be exported")
+        kind, params = spec
+        drugs[name] = {
+            "calculator": {"kind": kind, **params},
+            "safe_range": list(rule.safe_range),
+            "max_single_dose_mg": rule.max_single_dose_mg,
+            "renal_adjust_factor": rule.renal_adjust_factor,
+            "elderly_adjust_factor": rule.elderly_adjust_factor,
+            "conditions": list(rule.conditions),
+        }
+    return {"version": getattr(table, "version", None), "drugs": drugs}
+
+def _source_key(path: str):
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+def load(path: str, snapshot_path: Optional[str] = None) -> RuleTable:
+    # The validated formulary is kept as JSON next to the source, under the source's sha256;
+    # later loads of an unchanged file skip validation. The snapshot is plain data, so a
+    # stale or hand-edited one can at worst fail to build and fall back to a full parse.
+    snapshot_path = snapshot_path or path + ".snapshot"
+    with open(path, "rb") as f:
+        raw = f.read()
+    digest = hashlib.sha256(raw).hexdigest()
+    try:
+        with open(snapshot_path, "r", encoding="utf-8") as f:
+            snap = json.load(f)
+        if snap.get("format") == SNAPSHOT_FORMAT and snap.get("source") == digest:
+            return build(snap["spec"])
+    except (OSError, ValueError, AttributeError, TypeError, KeyError):
+        # any unreadable or stale-shaped snapshot (e.g. one missing "spec") means a full parse
+        pass
+    try:
+        spec = normalize(json.loads(raw))
+    except ValueError as e:
+        raise FormularyError(f"{path}: invalid JSON: {e}") from None
+    table = build(spec)
+    tmp = f"{snapshot_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"format": SNAPSHOT_FORMAT, "source": digest, "spec": spec}, f, separators=(",", ":"))
+        os.replace(tmp, snapshot_path)
+    except OSError as e:
+        warnings.warn(f"could not write formulary snapshot {snapshot_path}: {e}")
+    return table
+
+def install(table: RuleTable) -> RuleTable:
+    # Rebinding the module attribute is atomic; compute_dose calls already running keep
+    # the DrugRule they looked up, new calls see the new table.
+    old = rules.DRUG_RULES
+    rules.DRUG_RULES = table
+    return old
+
+def reload(path: str, snapshot_path: Optional[str] = None) -> RuleTable:
+    table = load(path, snapshot_path)
+    install(table)
+    return table
+
+
+class Watcher:
+    # Polls a formulary file and installs it whenever it changes. A file that fails to
+    # load is reported and the current table stays in place.
+
+    def __init__(self, path: str, interval: float = 2.0, snapshot_path: Optional[str] = None):
+        self.path = path
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+        self.error: Optional[Exception] = None
+        self._stop = threading.Event()
+        self._seen = self._key()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="formulary-watch")
+        self._thread.start()
+
+    def _key(self):
+        try:
+            return _source_key(self.path)
+        except OSError:
+            return None
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            key = self._key()
+            if key is None or key == self._seen:
+                continue
+            self._seen = key
+            try:
+                reload(self.path, self.snapshot_path)
+                self.error = None
+            except (OSError, FormularyError) as e:
+                self.error = e
+                warnings.warn(f"formulary reload of {self.path} failed, keeping version {rules.DRUG_RULES.version}: {e}")
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+def watch(path: str, interval: float = 2.0, snapshot_path: Optional[str] = None) -> Watcher:
+    return Watcher(path, interval, snapshot_path)
+
+def main(argv: List[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Check a formulary file, or export the built-in rules as one.")
+    ap.add_argument("command", choices=("check", "export"))
+    ap.add_argument("path", nargs="?", default="-", help="formulary to check, or file to export to (default: stdout)")
+    args = ap.parse_args(argv)
+    if args.command == "export":
+        text = json.dumps(export(), indent=2)
+        if args.path == "-":
+            print(text)
+        else:
+            with open(args.path, "w") as f:
+                f.write(text + "\n")
+        return 0
+    try:
+        table = load(args.path)
+    except (OSError, FormularyError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    print(f"{len(table)} drugs, version {table.version}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
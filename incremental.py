@@ -0,0 +1,239 @@
+from __future__ import annotations
+from bisect import bisect_right
+from typing import Dict, List, Optional, Tuple
+import rules
+from tokens import Token, TokenType
+from errors import ErrorReport
+from lexer import lex_iter, unexpected_character
+from parser import Parser
+from executor import RENAL_IMPAIRED
+
+# Editor-side view of a command script that is kept up to date edit by edit.
+#
+# The text is held as segments, one per statement: each ends just after its ';'/newline
+# (the last one at the end of the text). Lexing after a separator does not depend on what
+# came before it, so an edit re-lexes from the start of the segment it touches and stops at
+# the first separator past the edit that lines up with an old segment boundary; every other
+# segment keeps its tokens. Segment tokens are stored relative to the segment start, so an
+# edit only moves the starts of later segments. Parse diagnostics are cached per segment
+# and redone only for segments that were re-lexed or moved.
+
+PHRASES = (
+    ("CALCULATE", "DOSE", "FOR"),
+    ("CHECK", "INTERACTION", "BETWEEN"),
+    ("CHECK", "INTERACTION", "AMONG"),
+    ("ADJUST", "DOSE", "FOR"),
+    ("VALIDATE", "PRESCRIPTION"),
+    ("REPORT", "REGIMEN"),
+    ("ALERT", "WHEN", "DOSE", "EXCEEDS"),
+)
+PARAMS = {
+    "CALCULATE": ("drug", "condition", "weight", "age", "kidney_function", "patient_id"),
+    "ADJUST": ("drug", "condition", "weight", "age", "kidney_function", "patient_id"),
+    "VALIDATE": ("drug", "dose", "weight", "doses_per_day"),
+    "REPORT": ("patient_id", "limit", "offset", "cursor"),
+    "ALERT": ("drug", "patient_id", "percent", "window"),
+}
+_WORDS = (TokenType.IDENT, TokenType.KEYWORD, TokenType.UNIT, TokenType.AND)
+
+
+class Segment:
+    __slots__ = ("text", "tokens", "bad", "diagnostics")
+
+    def __init__(self, text: str, tokens: List[Token], bad: List[int]):
+        self.text = text
+        self.tokens = tokens          # positions relative to the segment start
+        self.bad = bad                # relative positions of unexpected characters
+        self.diagnostics: Optional[Tuple[int, List[ErrorReport]]] = None   # (start, problems)
+
+
+class IncrementalDocument:
+    def __init__(self, text: str = ""):
+        self.text = ""
+        self.segments = [Segment("", [], [])]
+        self.relexed = 0    # characters re-lexed by the last edit
+        if text:
+            self.edit(0, 0, text)
+
+    def starts(self) -> List[int]:
+        out, pos = [], 0
+        for seg in self.segments:
+            out.append(pos)
+            pos += len(seg.text)
+        return out
+
+    def edit(self, start: int, end: int, new_text: str) -> None:
+        # Replace text[start:end] with new_text.
+        if not 0 <= start <= end <= len(self.text):
+            raise ValueError(f"edit range {start}:{end} outside document of length {len(self.text)}")
+        old_len = len(self.text)
+        text = self.text[:start] + new_text + self.text[end:]
+        delta = len(text) - old_len
+        starts = self.starts()
+        first = max(bisect_right(starts, start) - 1, 0)
+        # old segment ends at or after the edit, by position, for resynchronising
+        old_ends: Dict[int, int] = {}
+        for i in range(first, len(self.segments) - 1):
+            old_ends[starts[i + 1]] = i
+        edited_end = start + len(new_text)
+        segs: List[Segment] = []
+        errors: List[ErrorReport] = []
+        seg_start = starts[first]
+        toks: List[Token] = []
+        resume = len(self.segments)
+        for tok in lex_iter(text, errors, seg_start):
+            if tok.type is TokenType.EOF:
+                segs.append(self._segment(text, seg_start, tok.pos, toks, errors))
+                break
+            toks.append(Token(tok.type, tok.lexeme, tok.pos - seg_start))
+            if tok.type is TokenType.SEMI:
+                seg_end = tok.pos + len(tok.lexeme)
+                segs.append(self._segment(text, seg_start, seg_end, toks, errors))
+                seg_start, toks = seg_end, []
+                i = old_ends.get(seg_end - delta) if seg_end >= edited_end else None
+                if i is not None:
+                    resume = i + 1
+                    break
+        self.relexed = seg_start - starts[first] if resume < len(self.segments) else len(text) - starts[first]
+        self.segments[first:resume] = segs
+        self.text = text
+
+    def _segment(self, text: str, start: int, end: int, toks: List[Token], errors: List[ErrorReport]) -> Segment:
+        bad = [e.position - start for e in errors]
+        errors.clear()
+        return Segment(text[start:end], toks, bad)
+
+    def update(self, text: str) -> None:
+        # Bring the document to `text` as one edit spanning whatever changed, for editors
+        # that hand over the whole value rather than the edit.
+        old = self.text
+        if text == old:
+            return
+        prefix = _common_prefix(old, text)
+        limit = min(len(old), len(text)) - prefix
+        lo, hi = 0, limit
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if old[len(old) - mid:] == text[len(text) - mid:]:
+                lo = mid
+            else:
+                hi = mid - 1
+        self.edit(prefix, len(old) - lo, text[prefix:len(text) - lo])
+
+    def tokens(self) -> List[Token]:
+        out = []
+        for start, seg in zip(self.starts(), self.segments):
+            out.extend(Token(t.type, t.lexeme, start + t.pos) for t in seg.tokens)
+        out.append(Token(TokenType.EOF, "", len(self.text)))
+        return out
+
+    def diagnostics(self) -> List[ErrorReport]:
+        # Lexical and parse problems of the whole text, as the recovering parser reports them.
+        out = []
+        # A segment with no problems has none wherever it moves, so only segments that were
+        # re-lexed, or that moved while holding problems (messages carry positions), are parsed.
+        for start, seg in zip(self.starts(), self.segments):
+            cached = seg.diagnostics
+            if cached is None or (cached[0] != start and cached[1]):
+                seg.diagnostics = (start, self._check(start, seg))
+            out.extend(seg.diagnostics[1])
+        return out
+
+    def _check(self, start: int, seg: Segment) -> List[ErrorReport]:
+        errors = [ErrorReport("lexical", unexpected_character(seg.text[b], start + b), start + b) for b in seg.bad]
+        if not seg.tokens:
+            return errors
+        toks = [Token(t.type, t.lexeme, start + t.pos) for t in seg.tokens]
+        toks.append(Token(TokenType.EOF, "", start + len(seg.text)))
+        problems = []
+        for _, found in Parser(toks, errors).parse_statements():
+            problems.extend(found)
+        return problems
+
+    def completions(self, offset: int) -> Tuple[int, List[str]]:
+        # (start, candidates): keywords, parameter names, drugs or conditions that fit at
+        # `offset`; a candidate replaces text[start:offset], the word typed so far.
+        offset = max(0, min(offset, len(self.text)))
+        starts = self.starts()
+        i = max(bisect_right(starts, offset) - 1, 0)
+        base, seg = starts[i], self.segments[i]
+        before = [t for t in seg.tokens if base + t.pos < offset and t.type is not TokenType.SEMI]
+        replace = offset
+        if before:
+            end = base + before[-1].pos + len(before[-1].lexeme)
+            if before[-1].type in _WORDS and end >= offset:
+                replace = base + before.pop().pos
+            elif end > offset:
+                return offset, []
+        prefix = self.text[replace:offset].lower()
+        return replace, [c for c in _candidates(before) if c.lower().startswith(prefix)]
+
+
+def _candidates(before: List[Token]) -> List[str]:
+    words = [t.lexeme if t.type in (TokenType.KEYWORD, TokenType.AND) else None for t in before]
+    for phrase in PHRASES:
+        if tuple(words[:len(phrase)]) == phrase:
+            return _after_phrase(phrase, before[len(phrase):])
+    seen, out = set(), []
+    for phrase in PHRASES:
+        n = len(words)
+        if n < len(phrase) and tuple(words) == phrase[:n] and phrase[n] not in seen:
+            seen.add(phrase[n])
+            out.append(phrase[n])
+    return out
+
+def _after_phrase(phrase: Tuple[str, ...], rest: List[Token]) -> List[str]:
+    drugs = sorted(rules.DRUG_RULES)
+    last = rest[-1].type if rest else None
+    if phrase[-1] == "BETWEEN":
+        if len(rest) == 1:
+            return ["AND"]
+        return drugs if not rest or (len(rest) == 2 and last is TokenType.AND) else []
+    if phrase[-1] == "AMONG":
+        if rest and last not in (TokenType.COMMA, TokenType.AND):
+            return []
+        listed = {t.lexeme for t in rest}
+        return [d for d in drugs if d not in listed]
+    if phrase[0] == "ALERT":
+        # SAFETY_LIMIT or an amount, then FOR and the pairs
+        if not rest:
+            return ["SAFETY_LIMIT"]
+        after = [i for i, t in enumerate(rest) if t.type is TokenType.KEYWORD and t.lexeme == "FOR"]
+        if not after:
+            return ["FOR"] if rest[-1].type in (TokenType.KEYWORD, TokenType.UNIT, TokenType.NUMBER) else []
+        rest = rest[after[0] + 1:]
+        last = rest[-1].type if rest else None
+    params = PARAMS.get(phrase[0])
+    if params is None or any(t.lexeme == "SINCE" for t in rest if t.type is TokenType.KEYWORD):
+        return []
+    pairs: Dict[str, str] = {}
+    for k, eq, v in zip(rest, rest[1:], rest[2:]):
+        if eq.type is TokenType.EQUALS:
+            pairs[k.lexeme.lower()] = v.lexeme.lower()
+    if last is TokenType.EQUALS and len(rest) >= 2:
+        key = rest[-2].lexeme.lower()
+        if key == "drug":
+            return drugs
+        if key == "condition":
+            rule = rules.DRUG_RULES.get(pairs.get("drug", ""))
+            if rule is not None:
+                return list(rule.conditions)
+            return sorted({c for r in rules.DRUG_RULES.values() for c in r.conditions})
+        if key == "kidney_function":
+            return ["normal", *RENAL_IMPAIRED]
+        return []
+    if last is None or last is TokenType.COMMA:
+        used = {t.lexeme.lower() for t, nxt in zip(rest, rest[1:]) if nxt.type is TokenType.EQUALS}
+        return [p for p in params if p not in used]
+    return ["SINCE"] if phrase[0] == "REPORT" else []
+
+def _common_prefix(a: str, b: str) -> int:
+    # binary search on slice equality: each comparison runs in C
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
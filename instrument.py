@@ -0,0 +1,98 @@
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Any, List, Optional
+import functools, threading, time, warnings
+
+# ENABLED times every interpreter run and reports it to the hooks; run(source, timing=True)
+# times a single run. ACTIVE counts runs being timed right now: while it is 0 the stage
+# wrappers below cost one global lookup.
+ENABLED = False
+ACTIVE = 0
+
+_hooks: List[Callable[["RunEvent"], None]] = []
+_local = threading.local()
+_active_lock = threading.Lock()
+
+@dataclass
+class RunEvent:
+    source: str
+    command: Optional[str] = None
+    total: float = 0.0
+    stages: Dict[str, List[float]] = field(default_factory=dict)
+    result: Optional[Dict[str, Any]] = None
+    error: Optional[BaseException] = None
+    started: float = 0.0
+    outer: Optional["RunEvent"] = field(default=None, repr=False)
+
+    def timing(self) -> Dict[str, Any]:
+        return {"total_ms": round(self.total * 1000, 4),
+                "stages": {name: {"ms": round(s * 1000, 4), "calls": int(n)} for name, (s, n) in self.stages.items()}}
+
+def enable():
+    global ENABLED
+    ENABLED = True
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+def add_hook(fn: Callable[[RunEvent], None]):
+    if fn not in _hooks:
+        _hooks.append(fn)
+
+def remove_hook(fn: Callable[[RunEvent], None]):
+    if fn in _hooks:
+        _hooks.remove(fn)
+
+def has_hooks() -> bool:
+    return bool(_hooks)
+
+def _add_active(n: int):
+    global ACTIVE
+    with _active_lock:
+        ACTIVE += n
+
+def begin(source: str) -> RunEvent:
+    event = RunEvent(source, outer=getattr(_local, "event", None))
+    _local.event = event
+    _add_active(1)
+    event.started = time.perf_counter()
+    return event
+
+def end(event: RunEvent, result: Optional[Dict[str, Any]] = None, error: Optional[BaseException] = None):
+    event.total = time.perf_counter() - event.started
+    event.result = result
+    event.error = error
+    _local.event = event.outer
+    if event.outer is not None:
+        for name, (secs, calls) in event.stages.items():
+            slot = event.outer.stages.setdefault(name, [0.0, 0])
+            slot[0] += secs
+            slot[1] += calls
+    _add_active(-1)
+    for hook in list(_hooks):
+        try:
+            hook(event)
+        except Exception as e:
+            warnings.warn(f"instrumentation hook {hook!r} failed: {e}")
+
+def timed(stage: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ACTIVE:
+                return fn(*args, **kwargs)
+            event = getattr(_local, "event", None)
+            if event is None:
+                return fn(*args, **kwargs)
+            t0 = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                slot = event.stages.get(stage)
+                if slot is None:
+                    slot = event.stages[stage] = [0.0, 0]
+                slot[0] += time.perf_counter() - t0
+                slot[1] += 1
+        return wrapper
+    return deco
@@ -0,0 +1,207 @@
+from __future__ import annotations
+from array import array
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import argparse, csv, mmap, os, struct, sys
+from errors import ExecutionError
+
+# Compiled interaction table, read in place through mmap so every worker process shares
+# the same page-cache copy and opening it costs one header read.
+#
+# Layout (little-endian):
+#   header   MAGIC, version, n_drugs, n_pairs, n_messages, then 5 u64 section offsets
+#   names    u32[n_drugs + 1] offsets into the name blob; names are sorted, so the index is the drug id
+#   pairs    u32[n_pairs * 3] (a, b, message id) triples with a < b, sorted by (a, b)
+#   messages u32[n_messages + 1] offsets into the message blob; each distinct message is stored once
+MAGIC = b"DDIX"
+VERSION = 1
+_HEADER = struct.Struct("<4sIIII5Q")
+
+def _pairs_from(source) -> Iterator[Tuple[str, str, str]]:
+    items = source.items() if isinstance(source, dict) else source
+    for key, *rest in items:
+        if rest and isinstance(key, frozenset):
+            if len(key) != 2:
+                continue
+            a, b = sorted(key)
+            yield a, b, rest[0]
+        else:
+            yield key, *rest
+
+def compile_db(source, path: str) -> int:
+    # source: a {frozenset([a, b]): message} dict like rules.INTERACTIONS, or (a, b, message) rows.
+    # Later rows for the same pair win. Returns the number of pairs written.
+    table: Dict[Tuple[str, str], str] = {}
+    for a, b, msg in _pairs_from(source):
+        a, b = str(a).strip().lower(), str(b).strip().lower()
+        if a == b:
+            continue
+        table[(a, b) if a < b else (b, a)] = str(msg)
+    names = sorted({d for pair in table for d in pair})
+    ids = {n: i for i, n in enumerate(names)}
+    messages: Dict[str, int] = {}
+    pairs = sorted((ids[a], ids[b], messages.setdefault(msg, len(messages))) for (a, b), msg in table.items())
+
+    def pool(strings: List[str]) -> Tuple[bytes, bytes]:
+        offsets, blob, pos = array("I", [0]), bytearray(), 0
+        for s in strings:
+            data = s.encode("utf-8")
+            blob += data
+            pos += len(data)
+            offsets.append(pos)
+        return _le(offsets), bytes(blob)
+
+    name_offsets, name_blob = pool(names)
+    msg_offsets, msg_blob = pool(list(messages))
+    pair_data = _le(array("I", [v for p in pairs for v in p]))
+    sections = [name_offsets, name_blob, pair_data, msg_offsets, msg_blob]
+    offsets, pos = [], _HEADER.size
+    for data in sections:
+        pos += -pos % 4
+        offsets.append(pos)
+        pos += len(data)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, VERSION, len(names), len(pairs), len(messages), *offsets))
+        for off, data in zip(offsets, sections):
+            f.write(b"\0" * (off - f.tell()))
+            f.write(data)
+    os.replace(tmp, path)
+    return len(pairs)
+
+def _le(a: array) -> bytes:
+    if sys.byteorder != "little":
+        a = array(a.typecode, a)
+        a.byteswap()
+    return a.tobytes()
+
+
+class InteractionDB:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, self.n_drugs, self.n_pairs, self.n_messages, *offs = _HEADER.unpack_from(self._mm, 0)
+        except struct.error:
+            magic, version = b"", 0
+        if magic != MAGIC or version != VERSION:
+            self._mm.close()
+            raise ExecutionError(f"{path} is not a compiled interaction database (version {VERSION})")
+        if sys.byteorder != "little":
+            self._mm.close()
+            raise ExecutionError("compiled interaction databases are little-endian only")
+        view = memoryview(self._mm)
+        self._name_off = view[offs[0]:offs[0] + 4 * (self.n_drugs + 1)].cast("I")
+        self._names = offs[1]
+        self._pairs = view[offs[2]:offs[2] + 12 * self.n_pairs].cast("I")
+        self._msg_off = view[offs[3]:offs[3] + 4 * (self.n_messages + 1)].cast("I")
+        self._msgs = offs[4]
+
+    def __len__(self) -> int:
+        return self.n_pairs
+
+    def close(self):
+        for v in (self._name_off, self._pairs, self._msg_off):
+            v.release()
+        self._mm.close()
+
+    def name(self, drug_id: int) -> str:
+        off = self._names
+        return self._mm[off + self._name_off[drug_id]:off + self._name_off[drug_id + 1]].decode("utf-8")
+
+    def message(self, msg_id: int) -> str:
+        off = self._msgs
+        return self._mm[off + self._msg_off[msg_id]:off + self._msg_off[msg_id + 1]].decode("utf-8")
+
+    def drug_id(self, drug: str) -> Optional[int]:
+        key = drug.lower().encode("utf-8")
+        mm, base, offs = self._mm, self._names, self._name_off
+        lo, hi = 0, self.n_drugs
+        while lo < hi:
+            mid = (lo + hi) // 2
+            name = mm[base + offs[mid]:base + offs[mid + 1]]
+            if name < key:
+                lo = mid + 1
+            elif name > key:
+                hi = mid
+            else:
+                return mid
+        return None
+
+    def _lower_bound(self, a: int, b: int) -> int:
+        pairs = self._pairs
+        lo, hi = 0, self.n_pairs
+        while lo < hi:
+            mid = (lo + hi) // 2
+            x = pairs[3 * mid]
+            if x < a or (x == a and pairs[3 * mid + 1] < b):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def get(self, drug_a: str, drug_b: str, default: Optional[str] = None) -> Optional[str]:
+        a, b = self.drug_id(drug_a), self.drug_id(drug_b)
+        if a is None or b is None or a == b:
+            return default
+        if a > b:
+            a, b = b, a
+        i = self._lower_bound(a, b)
+        pairs = self._pairs
+        if i < self.n_pairs and pairs[3 * i] == a and pairs[3 * i + 1] == b:
+            return self.message(pairs[3 * i + 2])
+        return default
+
+    def partners(self, drug_id: int) -> Iterator[Tuple[int, int]]:
+        # (partner id, message id) for partners with a larger id; pairs are stored once, a < b.
+        pairs = self._pairs
+        i = self._lower_bound(drug_id, 0)
+        while i < self.n_pairs and pairs[3 * i] == drug_id:
+            yield pairs[3 * i + 1], pairs[3 * i + 2]
+            i += 1
+
+    def among(self, drugs: Iterable[str]) -> List[Tuple[str, str, str]]:
+        # (drug_a, drug_b, message) for every interacting pair in the list, in list order.
+        position: Dict[str, int] = {}
+        for d in drugs:
+            position.setdefault(str(d).lower(), len(position))
+        ids = {}
+        for name in position:
+            i = self.drug_id(name)
+            if i is not None:
+                ids[i] = name
+        hits = []
+        for a, name_a in ids.items():
+            for b, msg in self.partners(a):
+                name_b = ids.get(b)
+                if name_b is not None:
+                    x, y = sorted((name_a, name_b), key=position.__getitem__)
+                    hits.append((position[x], position[y], x, y, msg))
+        hits.sort()
+        return [(x, y, self.message(msg)) for _, _, x, y, msg in hits]
+
+
+def read_csv(path: str) -> Iterator[Tuple[str, str, str]]:
+    # Columns drug_a, drug_b, message (header required).
+    with open(path, newline="", encoding="utf-8") as f:
+        for row in csv.DictReader(f):
+            row = {k.strip().lower(): (v or "").strip() for k, v in row.items() if k}
+            if row.get("drug_a") and row.get("drug_b"):
+                yield row["drug_a"], row["drug_b"], row.get("message", "")
+
+def main(argv: List[str] | None = None) -> int:
+    ap = argparse.ArgumentParser(description="Compile an interaction table into a memory-mappable database.")
+    ap.add_argument("output", help="database file to write")
+    ap.add_argument("input", nargs="?", help="CSV with drug_a, drug_b, message columns (default: rules.INTERACTIONS)")
+    args = ap.parse_args(argv)
+    if args.input:
+        source = read_csv(args.input)
+    else:
+        from rules import INTERACTIONS
+        source = INTERACTIONS
+    n = compile_db(source, args.output)
+    print(f"wrote {n} interaction pairs to {args.output}", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,53 +1,246 @@
 from __future__ import annotations
-from typing import Dict, Any
+from typing import Callable, Dict, Any, List, Optional, Tuple
+from contextlib import ExitStack
+from dataclasses import asdict
+import os
+import time
+import instrument
+from cache import LRUCache
 from lexer import lex
 from parser import Parser
-from errors import InterpreterError, SafetyLimitExceeded
+from errors import InterpreterError, SafetyLimitExceeded, ErrorReport
 from ast_nodes import *
 from executor import (
-    normalize_ctx, compute_dose, check_interaction, validate_prescription,
-    record_regimen, report_regimen, enforce_alerts
+    normalize_ctx, compute_dose, check_interaction, check_interactions, validate_prescription,
+    record_regimen, report_regimen, report_page, cumulative_dose, enforce_alerts, get_store, REPORT_PAGE_SIZE,
+    check_alert_rules, get_alerts
 )
 
+command_cache = LRUCache(int(os.environ.get("COMMAND_CACHE_SIZE", "1024")))
 
-def run(source: str) -> Dict[str, Any]:
-    tokens = lex(source)
-    node = Parser(tokens).parse()
-    if isinstance(node, CalculateDose):
-        ctx = normalize_ctx(node.params)
-        result = compute_dose(ctx)
-        if "patient_id" in ctx:
-            rec = {"type": "dose", **result}
-            record_regimen(ctx["patient_id"], rec)
-        return {"type": "CALCULATE", "result": result}
+def compile_command(source: str) -> Command:
+    node = command_cache.get(source)
+    if node is None:
+        parser = Parser(lex(source))
+        node = parser.parse_one()
+        if parser.placeholders:
+            raise InterpreterError("Command contains '?' placeholders; use prepare() and bind values")
+        command_cache.put(source, node)
+    return node
+
+def _observed(source: str, work: Callable[[instrument.RunEvent], Dict[str, Any]], timing: bool = False) -> Dict[str, Any]:
+    # Runs work(event) as one instrumented run, so the hooks (metrics) see every entry point:
+    # run(), prepared commands and script statements. work sets event.command.
+    event = instrument.begin(source)
+    try:
+        out = work(event)
+    except BaseException as e:
+        instrument.end(event, error=e)
+        raise
+    instrument.end(event, result=out)
+    if timing:
+        out["timing"] = event.timing()
+    return out
+
+def _execute_as(event: instrument.RunEvent, node: Command) -> Dict[str, Any]:
+    event.command = node.name
+    return execute(node)
+
+def execute_observed(node: Command, source: str = "") -> Dict[str, Any]:
+    # execute() for callers that build the node themselves, still seen by the hooks
+    if not instrument.ENABLED:
+        return execute(node)
+    return _observed(source or node.name, lambda event: _execute_as(event, node))
+
+def run(source: str, timing: bool = False) -> Dict[str, Any]:
+    if not (timing or instrument.ENABLED):
+        return execute(compile_command(source))
+    return _observed(source, lambda event: _execute_as(event, compile_command(source)), timing)
+
+def _calculate(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    result = compute_dose(ctx)
+    pid, mg = ctx.get("patient_id"), result["recommended_mg_per_day"]
+    # window totals are read before this entry is recorded and take it as the order being
+    # placed, so the store does not have to flush the entry first
+    fired = check_alert_rules(result["drug"], pid, mg)
+    if pid is not None:
+        rec = {"type": "dose", **result}
+        cumulative = cumulative_dose(pid, result["drug"], pending_mg=mg)
+        interactions = record_regimen(pid, rec)
+        return _with_alerts({"type": "CALCULATE", "result": result, "interactions": interactions, "cumulative": cumulative}, fired)
+    return _with_alerts({"type": "CALCULATE", "result": result}, fired)
+
+def _with_alerts(out: Dict[str, Any], fired: List[Dict[str, Any]]) -> Dict[str, Any]:
+    if fired:
+        out["alerts"] = fired
+    return out
+
+def _adjust(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    if "drug" not in ctx or "condition" not in ctx:
+        raise InterpreterError("ADJUST requires at least 'drug' and 'condition' plus modifiers like age or kidney_function")
+    result = compute_dose(ctx)
+    # nothing is recorded; window rules take this dose as the order that would be placed
+    mg = result["recommended_mg_per_day"]
+    return _with_alerts({"type": "ADJUST", "result": result}, check_alert_rules(result["drug"], ctx.get("patient_id"), mg))
+
+def _validate(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    drug = ctx.get("drug")
+    total = ctx.get("dose_mg_input")
+    if drug is None or total is None:
+        raise InterpreterError("VALIDATE requires 'drug' and 'dose'")
+    res = validate_prescription(drug, total)
+    return _with_alerts({"type": "VALIDATE", "result": res}, check_alert_rules(drug, ctx.get("patient_id"), total))
+
+def _report(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    pid = ctx.get("patient_id")
+    if not pid:
+        raise InterpreterError("REPORT requires patient_id=<id>")
+    hours = ctx.get("since_hours")
+    now = time.time()
+    since = None if hours is None else now - hours * 3600
+    # limit/offset/cursor ask for one page (limit defaults to REPORT_PAGE_SIZE); without them
+    # the whole regimen is returned as before
+    if any(k in ctx for k in ("limit", "offset", "cursor")):
+        limit, offset = ctx.get("limit", REPORT_PAGE_SIZE), ctx.get("offset", 0)
+        out = {"type": "REPORT", "patient_id": pid, "offset": offset, "limit": limit,
+               **report_page(pid, since, limit, offset, ctx.get("cursor"))}
+    else:
+        out = {"type": "REPORT", "patient_id": pid, "entries": report_regimen(pid, since)}
+    if hours is not None:
+        totals = (cumulative_dose(pid, d, hours, now) for d in sorted(get_store().drugs(pid)))
+        out.update(since_hours=hours, totals=[t for t in totals if t["total_mg"]])
+    return out
+
+def _alert(ctx: Dict[str, Any]) -> Dict[str, Any]:
+    # Registers the rule (kept across restarts) and reports it; an identical rule is not added twice.
+    rule = get_alerts().add(ctx.get("drug"), ctx.get("patient_id"), ctx.get("threshold_mg"),
+                            ctx.get("percent"), ctx.get("window_hours"))
+    return {"type": "ALERT_RULE", "id": rule.id, "rule": rule.describe(), "status": "armed"}
+
+_CTX_HANDLERS = {
+    CalculateDose: _calculate,
+    AdjustDose: _adjust,
+    ValidatePrescription: _validate,
+    ReportRegimen: _report,
+    AlertThreshold: _alert,
+}
+
+def execute(node: Command) -> Dict[str, Any]:
+    handler = _CTX_HANDLERS.get(type(node))
+    if handler is not None:
+        return handler(normalize_ctx(node.params))
     if isinstance(node, CheckInteraction):
         msg = check_interaction(node.params["drug_a"], node.params["drug_b"])
         return {"type": "CHECK", "interaction": msg}
-    if isinstance(node, AdjustDose):
-        ctx = normalize_ctx(node.params)
-        if "drug" not in ctx or "condition" not in ctx:
-            raise InterpreterError("ADJUST requires at least 'drug' and 'condition' plus modifiers like age or kidney_function")
-        result = compute_dose(ctx)
-        return {"type": "ADJUST", "result": result}
-    if isinstance(node, ValidatePrescription):
-        ctx = normalize_ctx(node.params)
-        drug = ctx.get("drug")
-        total = ctx.get("dose_mg_input")
-        if drug is None or total is None:
-            raise InterpreterError("VALIDATE requires 'drug' and 'dose'")
-        res = validate_prescription(drug, total)
-        return {"type": "VALIDATE", "result": res}
-    if isinstance(node, ReportRegimen):
-        ctx = normalize_ctx(node.params)
-        pid = ctx.get("patient_id")
-        if not pid:
-            raise InterpreterError("REPORT requires patient_id=<id>")
-        data = report_regimen(pid)
-        return {"type": "REPORT", "patient_id": pid, "entries": data}
-    if isinstance(node, AlertThreshold):
-        return {"type": "ALERT_RULE", "rule": "dose_exceeds_safety_limit", "status": "armed (demo)"}
+    if isinstance(node, CheckInteractionAmong):
+        drugs = [str(d).lower() for d in node.params["drugs"]]
+        return {"type": "CHECK_AMONG", "drugs": drugs, "interactions": check_interactions(drugs)}
     raise InterpreterError("Unsupported command type")
 
+_REPORT_ERROR_TYPES = {"lexical": "LexicalError", "parse": "ParseError"}
+
+def parse_batch(source: str) -> List[Tuple[Optional[Command], List[ErrorReport]]]:
+    # Every command in a script with all of its lexical and parse problems, in one pass and
+    # without raising; the node is None for commands that have problems.
+    errors: List[ErrorReport] = []
+    return list(Parser(lex(source, errors), errors).parse_statements())
+
+def _error_result(problems: List[ErrorReport]) -> Dict[str, Any]:
+    first = problems[0]
+    return {"type": "ERROR", "error": first.message, "error_type": _REPORT_ERROR_TYPES.get(first.kind, "InterpreterError"),
+            "errors": [asdict(p) for p in problems]}
+
+def run_script(source: str, stop_on_error: bool = True, report_limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    # Newline- or ';'-separated commands: one lex pass, parsed lazily, executed in order.
+    # Regimen writes share a single store batch, committed when the script ends; statements
+    # that ran before a failing one keep their effects. With stop_on_error=False the parser
+    # recovers, so a malformed command becomes an ERROR result listing all of its problems.
+    # With report_limit, a REPORT without limit/offset/cursor returns its first page of that
+    # size instead of the whole regimen.
+    results: List[Dict[str, Any]] = []
+    if stop_on_error:
+        parser = Parser(lex(source))
+        statements = ((node, None) for node in parser.parse_script())
+    else:
+        errors: List[ErrorReport] = []
+        parser = Parser(lex(source, errors), errors)
+        statements = parser.parse_statements()
+    failure = None
+    seen = 0
+    with ExitStack() as stack:
+        batched = False
+        try:
+            for node, problems in statements:
+                if problems:
+                    results.append(_error_result(problems))
+                    continue
+                try:
+                    if parser.placeholders != seen:
+                        seen = parser.placeholders
+                        raise InterpreterError("Command contains '?' placeholders; use prepare() and bind values")
+                    if report_limit is not None and isinstance(node, ReportRegimen) and \
+                            not {"limit", "offset", "cursor"} & {k.lower() for k in node.params}:
+                        node = ReportRegimen(node.name, {**node.params, "limit": report_limit})
+                    if not batched and isinstance(node, (CalculateDose, ReportRegimen)):
+                        stack.enter_context(get_store().batch())
+                        batched = True
+                    results.append(execute_observed(node, source))
+                except InterpreterError as e:
+                    if stop_on_error:
+                        raise
+                    results.append({"type": "ERROR", "error": str(e), "error_type": type(e).__name__})
+        except InterpreterError as e:
+            failure = e
+    if failure is not None:
+        raise failure
+    return results
+
+
+class PreparedCommand:
+    # A command parsed once with '?' placeholders. Literal parameters are normalized at
+    # prepare time; each bind only normalizes the bound values, which are already typed.
+
+    def __init__(self, source: str):
+        parser = Parser(lex(source))
+        self.source = source
+        self.node = parser.parse_one()
+        self.arity = parser.placeholders
+        self.slots = sorted(((v.index, k, v.unit) for k, v in self.node.params.items() if isinstance(v, Placeholder)))
+        self.static = {k: v for k, v in self.node.params.items() if not isinstance(v, Placeholder)}
+        self.handler = _CTX_HANDLERS.get(type(self.node))
+        # a dose in weight-based or per-dose units is normalized together with weight/doses_per_day
+        keys = {str(k).lower() for k in self.node.params}
+        self.joint = "dose" in keys and bool(keys & {"weight", "doses_per_day"}) and bool(self.slots)
+        self.static_ctx = normalize_ctx(self.static) if self.handler is not None and not self.joint else None
+
+    def bind(self, *args: Any) -> Dict[str, Any]:
+        if len(args) != self.arity:
+            raise InterpreterError(f"Prepared command expects {self.arity} parameters, got {len(args)}")
+        return {key: Quantity(float(args[i]), unit) if unit else args[i] for i, key, unit in self.slots}
+
+    def run(self, *args: Any) -> Dict[str, Any]:
+        if instrument.ENABLED:
+            return _observed(self.source, lambda event: self._run_as(event, args))
+        return self._run(args)
+
+    def _run_as(self, event: instrument.RunEvent, args) -> Dict[str, Any]:
+        event.command = self.node.name
+        return self._run(args)
+
+    def _run(self, args) -> Dict[str, Any]:
+        bound = self.bind(*args)
+        if self.handler is not None:
+            if self.joint:
+                return self.handler(normalize_ctx({**self.static, **bound}))
+            return self.handler({**self.static_ctx, **normalize_ctx(bound)})
+        return execute(type(self.node)(self.node.name, {**self.static, **bound}))
+
+    def run_many(self, rows) -> List[Dict[str, Any]]:
+        return [self.run(*row) for row in rows]
+
+def prepare(source: str) -> PreparedCommand:
+    return PreparedCommand(source)
+
 def run_and_raise_on_alert(source: str) -> Dict[str, Any]:
     out = run(source)
     if out.get("type") in ("CALCULATE","ADJUST"):
@@ -55,4 +248,7 @@ def run_and_raise_on_alert(source: str) -> Dict[str, Any]:
             enforce_alerts(out["result"])
         except SafetyLimitExceeded as e:
             raise
+    if out.get("alerts"):
+        first = out["alerts"][0]
+        raise SafetyLimitExceeded(first["message"], computed=first["value_mg"], limit=first["limit_mg"])
     return out
@@ -1,57 +1,145 @@
 import re
+from typing import Iterator, List, Optional, Tuple
 from tokens import Token, TokenType
-from errors import LexicalError
+from errors import LexicalError, ErrorReport
+from instrument import timed
 
 KEYWORDS = {
     "CALCULATE","DOSE","FOR","PATIENT","DRUG","CONDITION","WEIGHT","AGE","KIDNEY_FUNCTION",
-    "CHECK","INTERACTION","BETWEEN","AND",
+    "CHECK","INTERACTION","BETWEEN","AND","AMONG",
     "ADJUST",
     "VALIDATE","PRESCRIPTION",
-    "REPORT","REGIMEN","PATIENT_ID",
+    "REPORT","REGIMEN","PATIENT_ID","SINCE",
     "ALERT","WHEN","EXCEEDS","SAFETY_LIMIT",
 }
 
 UNITS = {"kg","mg","mcg","g","ml","mg/kg/day","mg/kg/dose","mg/day","mcg/day","mg/dose"}
+# Duration suffixes lex as ordinary identifiers (d-12 is a valid id); the parser reads
+# NUMBER + one of these as a duration where one is expected (SINCE, since=, window=).
+DURATION_UNITS = {"h","d"}
 
-_token_spec = [
-    ("SKIP",   r"[ \t]+"),
-    ("COMMA",  r","),
-    ("EQUALS", r"="),
-    ("NUMBER", r"\d+(?:\.\d+)?"),
-    ("UNIT",   r"(?:mg/kg/day|mg/kg/dose|mg/day|mcg/day|mg/dose|kg|mg|mcg|g|ml)\b"),
-    ("WORD",   r"[A-Za-z_][A-Za-z0-9_\-]*"),
-    ("MISMATCH", r"."),
-]
-_tok_re = re.compile("|".join(f"(?P<{n}>{r})" for n,r in _token_spec))
+# Each match is one token with the spaces/tabs before it, and the matches tile the source up
+# to any trailing blanks (the last class takes any other character but a blank), so a token's
+# position is the running length of the pieces before it. Pieces repeat a lot across commands
+# ("CALCULATE", " drug", "=", " 70" ...), so each distinct piece is classified once and kept.
+_units_alt = "|".join(re.escape(u) for u in sorted(UNITS, key=len, reverse=True))
+_piece_re = re.compile(rf"[ \t]*(?:;|\r?\n|,|=|\?|(?:{_units_alt})\b|[A-Za-z_][A-Za-z0-9_\-]*|\d+(?:\.\d+)?|[^ \t\n])")
+
+# lex() scans coarser chunks: a run of non-blank characters with the blanks before it. No
+# token spans a blank, so a chunk's pieces are the ones the whole source has there. Commands
+# repeat the same chunks at the same places (" DOSE", " drug=metformin,"), and Tokens are
+# immutable, so the tuple of Tokens for a chunk at a position is built once and reused.
+_chunk_re = re.compile(r"[ \t]*[^ \t]+")
+
+_PUNCT = {";": TokenType.SEMI, "\n": TokenType.SEMI, "\r\n": TokenType.SEMI, ",": TokenType.COMMA,
+          "=": TokenType.EQUALS, "?": TokenType.PARAM}
+_WORD_START = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_")
+_KEYWORD_TYPES = {kw: TokenType.AND if kw == "AND" else TokenType.KEYWORD for kw in KEYWORDS}
+_MAX_PIECES = 1 << 16
+# A newline ends a command unless the line stops where the command plainly goes on, as in
+# "drug=metformin,<newline>  condition=diabetes"; such a newline is skipped like a blank.
+_GOES_ON = (TokenType.COMMA, TokenType.EQUALS, TokenType.AND)
+
+# piece -> (token type, lexeme, offset of the token in the piece), or None for a character
+# the language does not have
+_pieces: dict = {}
+# (chunk, position) -> the chunk's Tokens; chunks with a bad character are never kept
+_chunks: dict = {}
 
 def is_keyword(word: str) -> bool:
     return word in KEYWORDS
 
-def lex(source: str):
+def _classify(piece: str) -> Optional[Tuple[TokenType, str, int]]:
+    text = piece.lstrip(" \t")
+    offset = len(piece) - len(text)
+    ttype = _PUNCT.get(text)
+    if ttype is not None:
+        return (ttype, text, offset)
+    if text[0] in _WORD_START:
+        if text in UNITS:
+            return (TokenType.UNIT, text, offset)
+        up = text.upper()
+        ttype = _KEYWORD_TYPES.get(up)
+        return (TokenType.IDENT, text.lower(), offset) if ttype is None else (ttype, up, offset)
+    if text[0].isdecimal():
+        return (TokenType.NUMBER, text, offset)
+    return None
+
+_BAD = (None, "", 0)
+
+def unexpected_character(char: str, at: int) -> str:
+    return f"Unexpected character {char!r} at {at}"
+
+def _entry(piece: str, pos: int, errors: Optional[List[ErrorReport]]) -> Tuple[Optional[TokenType], str, int]:
+    entry = _classify(piece)
+    if entry is None:
+        text = piece.lstrip(" \t")
+        at = pos + len(piece) - len(text)
+        message = unexpected_character(text, at)
+        if errors is None:
+            raise LexicalError(message)
+        errors.append(ErrorReport("lexical", message, at))
+        return _BAD
+    if len(_pieces) >= _MAX_PIECES:
+        _pieces.clear()
+    _pieces[piece] = entry
+    return entry
+
+def _lex_chunk(chunk: str, start: int, errors: Optional[List[ErrorReport]]) -> Tuple[Token, ...]:
+    toks = []
+    pos = start
+    clean = True
+    for piece in _piece_re.findall(chunk):
+        entry = _pieces.get(piece) or _entry(piece, pos, errors)
+        if entry is _BAD:
+            clean = False
+        else:
+            toks.append(Token(entry[0], entry[1], pos + entry[2]))
+        pos += len(piece)
+    toks = tuple(toks)
+    # a bad character is reported on every lex, so its chunk is lexed every time
+    if clean:
+        if len(_chunks) >= _MAX_PIECES:
+            _chunks.clear()
+        _chunks[(chunk, start)] = toks
+    return toks
+
+@timed("lex")
+def lex(source: str, errors: Optional[List[ErrorReport]] = None) -> List[Token]:
+    # With an errors list, bad characters are reported there and skipped instead of raising.
     tokens = []
-    for m in _tok_re.finditer(source):
-        kind = m.lastgroup
-        lexeme = m.group()
-        pos = m.start()
-        if kind == "SKIP":
-            continue
-        if kind == "COMMA":
-            tokens.append(Token(TokenType.COMMA, lexeme, pos))
-        elif kind == "EQUALS":
-            tokens.append(Token(TokenType.EQUALS, lexeme, pos))
-        elif kind == "NUMBER":
-            tokens.append(Token(TokenType.NUMBER, lexeme, pos))
-        elif kind == "UNIT":
-            tokens.append(Token(TokenType.UNIT, lexeme, pos))
-        elif kind == "WORD":
-            if lexeme.upper() in KEYWORDS:
-                t = Token(TokenType.KEYWORD, lexeme.upper(), pos)
-                if lexeme.upper() == "AND":
-                    t = Token(TokenType.AND, lexeme.upper(), pos)
-                tokens.append(t)
-            else:
-                tokens.append(Token(TokenType.IDENT, lexeme.lower(), pos))
-        elif kind == "MISMATCH":
-            raise LexicalError(f"Unexpected character {lexeme!r} at {pos}")
+    extend = tokens.extend
+    known = _chunks.get
+    pos = 0
+    for chunk in _chunk_re.findall(source):
+        extend(known((chunk, pos)) or _lex_chunk(chunk, pos, errors))
+        pos += len(chunk)
+    if "\n" in source:
+        tokens = _join_lines(tokens)
     tokens.append(Token(TokenType.EOF, "", len(source)))
     return tokens
+
+def _join_lines(tokens: List[Token]) -> List[Token]:
+    out = []
+    for t in tokens:
+        if t.type is TokenType.SEMI and t.lexeme != ";" and out and out[-1].type in _GOES_ON:
+            continue
+        out.append(t)
+    return out
+
+def lex_iter(source: str, errors: Optional[List[ErrorReport]] = None, start: int = 0) -> Iterator[Token]:
+    # Same tokens as lex(), produced a piece at a time as the scan goes, so a bad character
+    # raises (or is reported) only once the tokens before it are taken. Scanning can start at
+    # the start of any command, e.g. just after a ';' or a newline that ends one.
+    pieces = _pieces
+    pos = start
+    last = None
+    for m in _piece_re.finditer(source, start):
+        piece = m.group()
+        entry = pieces.get(piece) or _entry(piece, pos, errors)
+        ttype = entry[0]
+        if ttype is not None and not (ttype is TokenType.SEMI and entry[1] != ";" and last in _GOES_ON):
+            yield Token(ttype, entry[1], pos + entry[2])
+            last = ttype
+        pos += len(piece)
+    yield Token(TokenType.EOF, "", len(source))
@@ -0,0 +1,23 @@
+from __future__ import annotations
+from contextlib import contextmanager
+from typing import IO, Optional
+
+try:
+    import fcntl
+except ImportError:  # non-POSIX: writers are only serialized within this process
+    fcntl = None
+
+# Advisory lock shared by the regimen store and the alert rules, which each keep a
+# `<path>.lock` next to their data and hold it across a read-modify-write.
+
+@contextmanager
+def flock(fh: Optional[IO]):
+    # Exclusive lock on an open lock file for the block; without fcntl or a file, a no-op.
+    if fcntl is None or fh is None:
+        yield
+        return
+    fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+    try:
+        yield
+    finally:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
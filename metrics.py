@@ -0,0 +1,235 @@
+from __future__ import annotations
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Optional, Sequence, Tuple
+import os, threading
+import instrument
+import rules
+
+# Each metric keeps one dict per writing thread, so inc()/observe() never take a lock;
+# render() merges the shards when scraped. Shards of threads that have ended are folded
+# into one base dict, so a server that starts a thread per request does not pile them up.
+ENABLED = False
+
+DEFAULT_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _fmt_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+def _fmt_value(v: float) -> str:
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+class _Metric:
+    # A plain sum per label set; Counter is exactly this, Histogram merges bucket slots.
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards: Dict[threading.Thread, Dict[Tuple[str, ...], Any]] = {}
+        self._base: Dict[Tuple[str, ...], Any] = {}
+        self._lock = threading.Lock()
+
+    def _shard(self) -> Dict[Tuple[str, ...], Any]:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._fold()
+                self._shards[threading.current_thread()] = shard
+        return shard
+
+    def _fold(self):
+        # under _lock: an ended thread writes no more, so its shard can be merged and dropped
+        for thread in [t for t in self._shards if not t.is_alive()]:
+            self._merge(self._base, self._shards.pop(thread))
+
+    def _merge(self, into: Dict[Tuple[str, ...], Any], shard: Dict[Tuple[str, ...], Any]):
+        for key, v in list(shard.items()):
+            into[key] = into.get(key, 0.0) + v
+
+    def collect(self) -> Dict[Tuple[str, ...], Any]:
+        totals: Dict[Tuple[str, ...], Any] = {}
+        with self._lock:
+            self._fold()
+            self._merge(totals, self._base)
+            shards = list(self._shards.values())
+        for shard in shards:
+            self._merge(totals, shard)
+        return totals
+
+    def reset(self):
+        with self._lock:
+            self._base.clear()
+            for shard in self._shards.values():
+                shard.clear()
+
+    def render(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"] + self._samples()
+
+    def _samples(self) -> List[str]:
+        return [f"{self.name}{_fmt_labels(self.labels, k)} {_fmt_value(v)}" for k, v in sorted(self.collect().items())]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0.0) + amount
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, *labels: str, value: float):
+        shard = self._shard()
+        slot = shard.get(labels)
+        if slot is None:
+            # per-bucket counts (last one is +Inf), then sum, then count
+            slot = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        slot[bisect_left(self.buckets, value)] += 1
+        slot[-2] += value
+        slot[-1] += 1
+
+    def _merge(self, into: Dict[Tuple[str, ...], Any], shard: Dict[Tuple[str, ...], Any]):
+        for key, slot in list(shard.items()):
+            acc = into.get(key)
+            if acc is None:
+                into[key] = list(slot)
+            else:
+                for i, v in enumerate(slot):
+                    acc[i] += v
+
+    def _samples(self) -> List[str]:
+        out = []
+        for key, slot in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), slot):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                labels = _fmt_labels(self.labels, key, 'le="%s"' % le)
+                out.append(f"{self.name}_bucket{labels} {cumulative}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {_fmt_value(slot[-2])}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {int(slot[-1])}")
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        for metric in self.metrics:
+            metric.reset()
+
+
+REGISTRY = Registry()
+commands_total = REGISTRY.register(Counter(
+    "dosage_commands_total", "Interpreter commands run, by command type, drug and outcome.", ("command", "drug", "status")))
+command_seconds = REGISTRY.register(Histogram(
+    "dosage_command_duration_seconds", "Wall time of interpreter.run by command type and drug.", ("command", "drug")))
+stage_seconds = REGISTRY.register(Counter(
+    "dosage_stage_seconds_total", "Time spent per interpreter stage.", ("stage",)))
+stage_calls = REGISTRY.register(Counter(
+    "dosage_stage_calls_total", "Calls per interpreter stage.", ("stage",)))
+errors_total = REGISTRY.register(Counter(
+    "dosage_errors_total", "Commands that raised, by command type and error class.", ("command", "error")))
+alerts_total = REGISTRY.register(Counter(
+    "dosage_alerts_total", "Safety alerts set by compute_dose or validate_prescription.", ("command", "drug")))
+safety_limit_exceeded_total = REGISTRY.register(Counter(
+    "dosage_safety_limit_exceeded_total", "SafetyLimitExceeded raised by enforce_alerts.", ("drug",)))
+rule_alerts_total = REGISTRY.register(Counter(
+    "dosage_rule_alerts_total", "Events fired by registered ALERT rules.", ("drug",)))
+
+def drug_label(drug: Optional[str]) -> str:
+    # Unrecognised drug names come from user input; fold them so label cardinality stays bounded.
+    if not drug:
+        return ""
+    return drug if drug in rules.DRUG_RULES else "other"
+
+def count(command: str, drug: str, result: Optional[Dict[str, Any]] = None, error: Optional[BaseException] = None):
+    commands_total.inc(command, drug, "error" if error is not None else "ok")
+    if error is not None:
+        errors_total.inc(command, type(error).__name__)
+    elif result and result.get("alert"):
+        alerts_total.inc(command, drug)
+
+def _on_run(event: instrument.RunEvent):
+    command = event.command or "UNKNOWN"
+    inner = (event.result or {}).get("result")
+    if not isinstance(inner, dict):
+        inner = None
+    drug = drug_label(inner.get("drug") if inner else getattr(event.error, "drug", None))
+    count(command, drug, inner, event.error)
+    command_seconds.observe(command, drug, value=event.total)
+    for stage, (secs, calls) in event.stages.items():
+        stage_seconds.inc(stage, amount=secs)
+        stage_calls.inc(stage, amount=calls)
+
+def enable():
+    global ENABLED
+    ENABLED = True
+    instrument.add_hook(_on_run)
+    instrument.enable()
+
+def disable():
+    global ENABLED
+    ENABLED = False
+    instrument.remove_hook(_on_run)
+    # other hooks may still want every run timed
+    if not instrument.has_hooks():
+        instrument.disable()
+
+def render() -> str:
+    return REGISTRY.render()
+
+def write_textfile(path: str):
+    # For node_exporter's textfile collector: write to a temp file, then rename into place.
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(port: int = 9464, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    httpd = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=httpd.serve_forever, daemon=True, name="metrics-http").start()
+    return httpd
@@ -1,13 +1,22 @@
 from __future__ import annotations
-from typing import List, Dict
+from typing import List, Dict, Any, Iterator, Optional, Tuple
 from tokens import Token, TokenType
-from errors import ParseError
+from errors import ParseError, ErrorReport
 from ast_nodes import *
+from lexer import DURATION_UNITS
+from instrument import timed
+
+DURATION_KEYS = ("since", "window")
 
 class Parser:
-    def __init__(self, tokens: List[Token]):
+    # With an errors list the parser recovers instead of raising: each problem becomes an
+    # ErrorReport, a bad key=value pair is skipped up to the next comma and a bad command up
+    # to the next ';'/newline. parse() then returns None (or a partial node) for bad input.
+    def __init__(self, tokens: List[Token], errors: Optional[List[ErrorReport]] = None):
         self.tokens = tokens
         self.i = 0
+        self.placeholders = 0
+        self.errors = errors
 
     def peek(self) -> Token:
         return self.tokens[self.i]
@@ -17,85 +26,220 @@ class Parser:
         self.i += 1
         return t
 
+    def fail(self, message: str, pos: int) -> None:
+        if self.errors is None:
+            raise ParseError(message)
+        self.errors.append(ErrorReport("parse", message, pos))
+
+    def sync(self, *stops: TokenType):
+        # skip to the next stop token, or to the end of the command
+        while self.peek().type not in stops and self.peek().type not in (TokenType.SEMI, TokenType.EOF):
+            self.advance()
+
     def match_keyword(self, *keys: str) -> bool:
         if self.peek().type == TokenType.KEYWORD and self.peek().lexeme in keys:
             self.advance()
             return True
         return False
 
-    def require_keyword(self, key: str):
-        if not self.match_keyword(key):
-            t = self.peek()
-            raise ParseError(f"Expected keyword '{key}' at {t.pos} but found '{t.lexeme}'")
+    def require_keyword(self, key: str) -> bool:
+        if self.match_keyword(key):
+            return True
+        t = self.peek()
+        self.fail(f"Expected keyword '{key}' at {t.pos} but found '{t.lexeme}'", t.pos)
+        return False
 
-    def expect(self, ttype: TokenType) -> Token:
+    def expect(self, ttype: TokenType) -> Optional[Token]:
         t = self.peek()
         if t.type != ttype:
-            raise ParseError(f"Expected {ttype.name} at {t.pos} but found {t.lexeme!r}")
+            return self.fail(f"Expected {ttype.name} at {t.pos} but found {t.lexeme!r}", t.pos)
         return self.advance()
 
-    def parse(self) -> Command:
+    @timed("parse")
+    def parse(self) -> Optional[Command]:
         if self.match_keyword("CALCULATE"):
-            self.require_keyword("DOSE")
-            self.require_keyword("FOR")
-            params = self.parse_kv_list()
-            return CalculateDose("CALCULATE", params)
+            if self.require_keyword("DOSE") and self.require_keyword("FOR"):
+                return CalculateDose("CALCULATE", self.parse_kv_list())
+            return None
         if self.match_keyword("CHECK"):
-            self.require_keyword("INTERACTION")
-            self.require_keyword("BETWEEN")
-            a = self.expect_ident_value()
-            self.expect(TokenType.AND)
-            b = self.expect_ident_value()
-            return CheckInteraction("CHECK", {"drug_a": a, "drug_b": b})
+            if not self.require_keyword("INTERACTION"):
+                return None
+            if self.match_keyword("AMONG"):
+                drugs = self.parse_drug_list()
+                return None if drugs is None else CheckInteractionAmong("CHECK_AMONG", {"drugs": drugs})
+            if not self.require_keyword("BETWEEN"):
+                return None
+            a = self.expect_drug_value()
+            if a is None or self.expect(TokenType.AND) is None:
+                return None
+            b = self.expect_drug_value()
+            return None if b is None else CheckInteraction("CHECK", {"drug_a": a, "drug_b": b})
         if self.match_keyword("ADJUST"):
-            self.require_keyword("DOSE")
-            self.require_keyword("FOR")
-            params = self.parse_kv_list()
-            return AdjustDose("ADJUST", params)
+            if self.require_keyword("DOSE") and self.require_keyword("FOR"):
+                return AdjustDose("ADJUST", self.parse_kv_list())
+            return None
         if self.match_keyword("VALIDATE"):
-            self.require_keyword("PRESCRIPTION")
-            params = self.parse_kv_list()
-            return ValidatePrescription("VALIDATE", params)
+            if self.require_keyword("PRESCRIPTION"):
+                return ValidatePrescription("VALIDATE", self.parse_kv_list())
+            return None
         if self.match_keyword("REPORT"):
-            self.require_keyword("REGIMEN")
-            params = self.parse_kv_list()
+            if not self.require_keyword("REGIMEN"):
+                return None
+            # SINCE <duration> may come anywhere among the pairs; since=24h works too
+            params = self.parse_kv_list("SINCE")
+            while self.match_keyword("SINCE"):
+                if self.peek().type == TokenType.EQUALS:
+                    self.advance()
+                since = self.expect_value_with_optional_unit(duration=True)
+                if since is None:
+                    return None
+                params["since"] = since
+                if self.peek().type == TokenType.COMMA:
+                    self.advance()
+                params.update(self.parse_kv_list("SINCE"))
             return ReportRegimen("REPORT", params)
         if self.match_keyword("ALERT"):
-            self.require_keyword("WHEN")
-            self.require_keyword("DOSE")
-            self.require_keyword("EXCEEDS")
-            self.require_keyword("SAFETY_LIMIT")
-            return AlertThreshold("ALERT", {"rule": "dose_exceeds_safety_limit"})
+            # EXCEEDS SAFETY_LIMIT or a daily amount, then FOR drug=, patient_id=, percent=, window=
+            if not all(self.require_keyword(k) for k in ("WHEN", "DOSE", "EXCEEDS")):
+                return None
+            if self.match_keyword("SAFETY_LIMIT"):
+                params = {"rule": "dose_exceeds_safety_limit"}
+            else:
+                threshold = self.expect_value_with_optional_unit()
+                if threshold is None:
+                    return None
+                params = {"rule": "dose_exceeds_threshold", "threshold": threshold}
+            if self.match_keyword("FOR"):
+                params.update(self.parse_kv_list())
+            return AlertThreshold("ALERT", params)
         t = self.peek()
-        raise ParseError(f"Unknown command starting at {t.pos}: {t.lexeme!r}")
+        return self.fail(f"Unknown command starting at {t.pos}: {t.lexeme!r}", t.pos)
+
+    def parse_one(self) -> Optional[Command]:
+        # Exactly one command: blank lines and a trailing ';' are fine, a second command is not.
+        # A single command may span lines however it likes, so newlines are only blanks here.
+        self.tokens = [t for t in self.tokens if t.type is not TokenType.SEMI or t.lexeme == ";"]
+        while self.peek().type == TokenType.SEMI:
+            self.advance()
+        node = self.parse()
+        while self.peek().type == TokenType.SEMI:
+            self.advance()
+        t = self.peek()
+        if t.type != TokenType.EOF:
+            return self.fail(f"Expected end of command at {t.pos} but found {t.lexeme!r}; "
+                             f"use run_script() for several commands", t.pos)
+        return node
+
+    def parse_script(self) -> Iterator[Command]:
+        while True:
+            while self.peek().type == TokenType.SEMI:
+                self.advance()
+            if self.peek().type == TokenType.EOF:
+                return
+            node = self.parse()
+            t = self.peek()
+            if t.type not in (TokenType.SEMI, TokenType.EOF):
+                raise ParseError(f"Expected end of command at {t.pos} but found {t.lexeme!r}")
+            yield node
+
+    def parse_statements(self) -> Iterator[Tuple[Optional[Command], List[ErrorReport]]]:
+        # Recovering parse_script: (node, problems) per command, node None when it has problems.
+        # Errors already in the list (from lex(source, errors)) go with the command they fall in.
+        if self.errors is None:
+            self.errors = []
+        pending = sorted(self.errors, key=lambda e: e.position or 0)
+        errors = self.errors
+        while True:
+            while self.peek().type == TokenType.SEMI:
+                self.advance()
+            if self.peek().type == TokenType.EOF:
+                break
+            mark = len(errors)
+            node = self.parse()
+            t = self.peek()
+            if t.type not in (TokenType.SEMI, TokenType.EOF):
+                if len(errors) == mark:
+                    self.fail(f"Expected end of command at {t.pos} but found {t.lexeme!r}", t.pos)
+                self.sync()
+            end = self.peek().pos
+            problems = []
+            while pending and (pending[0].position or 0) <= end:
+                problems.append(pending.pop(0))
+            problems += errors[mark:]
+            yield (None if problems else node), problems
+        if pending:
+            yield None, pending
 
-    def parse_kv_list(self) -> Dict[str, str]:
-        params: Dict[str, str] = {}
-        while self.peek().type != TokenType.EOF:
+    def at_keyword(self, keys) -> bool:
+        return self.peek().type == TokenType.KEYWORD and self.peek().lexeme in keys
+
+    def parse_kv_list(self, *stops: str) -> Dict[str, Any]:
+        # key=value pairs up to the end of the command, or up to one of the `stops` keywords
+        params: Dict[str, Any] = {}
+        while self.peek().type not in (TokenType.EOF, TokenType.SEMI) and not self.at_keyword(stops):
             key = self.expect_ident_value()
-            self.expect(TokenType.EQUALS)
-            val = self.expect_value_with_optional_unit()
-            params[key] = val
+            val = None
+            if key is not None and self.expect(TokenType.EQUALS) is not None:
+                val = self.expect_value_with_optional_unit(duration=key.lower() in DURATION_KEYS)
+            if val is None:
+                self.sync(TokenType.COMMA)
+            else:
+                params[key] = val
             if self.peek().type == TokenType.COMMA:
                 self.advance()
-            if self.peek().type == TokenType.EOF:
+            if self.peek().type in (TokenType.EOF, TokenType.SEMI):
                 break
         return params
 
-    def expect_ident_value(self) -> str:
+    def parse_drug_list(self):
+        # a, b, c (AND also separates); a lone '?' binds the whole list in a prepared command
+        if self.peek().type == TokenType.PARAM:
+            return self.expect_placeholder(with_unit=False)
+        drugs = [self.expect_ident_value()]
+        while drugs[-1] is not None and self.peek().type in (TokenType.COMMA, TokenType.AND):
+            self.advance()
+            drugs.append(self.expect_ident_value())
+        if drugs[-1] is None:
+            return None
+        if len(drugs) < 2:
+            t = self.peek()
+            return self.fail(f"CHECK INTERACTION AMONG needs at least two drugs (at {t.pos})", t.pos)
+        return drugs
+
+    def expect_placeholder(self, with_unit: bool, duration: bool = False) -> Placeholder:
+        t = self.advance()
+        unit = None
+        if with_unit and (self.peek().type == TokenType.UNIT or duration and self._at_duration_unit()):
+            unit = self.advance().lexeme
+        self.placeholders += 1
+        return Placeholder(self.placeholders - 1, unit, t.pos)
+
+    def _at_duration_unit(self) -> bool:
+        t = self.peek()
+        return t.type == TokenType.IDENT and t.lexeme in DURATION_UNITS
+
+    def expect_ident_value(self) -> Optional[str]:
         t = self.peek()
         if t.type in (TokenType.IDENT, TokenType.KEYWORD):
             return self.advance().lexeme
-        raise ParseError(f"Expected identifier at {t.pos} but found {t.lexeme!r}")
+        return self.fail(f"Expected identifier at {t.pos} but found {t.lexeme!r}", t.pos)
+
+    def expect_drug_value(self):
+        if self.peek().type == TokenType.PARAM:
+            return self.expect_placeholder(with_unit=False)
+        return self.expect_ident_value()
 
-    def expect_value_with_optional_unit(self) -> str:
+    def expect_value_with_optional_unit(self, duration: bool = False):
+        # duration: a number may also carry an h/d suffix (24h, 7d)
         t = self.peek()
+        if t.type == TokenType.PARAM:
+            return self.expect_placeholder(with_unit=True, duration=duration)
         if t.type == TokenType.NUMBER:
             num = self.advance().lexeme
-            if self.peek().type == TokenType.UNIT:
+            if self.peek().type == TokenType.UNIT or duration and self._at_duration_unit():
                 unit = self.advance().lexeme
-                return f"{num}{unit}"
-            return num
+                return Quantity(float(num), unit, f"{num}{unit}")
+            return Quantity(float(num), None, num)
         if t.type in (TokenType.IDENT,):
             return self.advance().lexeme
         if t.type == TokenType.KEYWORD:
@@ -103,4 +247,4 @@ class Parser:
         if t.type == TokenType.UNIT:
             u = self.advance().lexeme
             return u
-        raise ParseError(f"Expected value at {t.pos} but found {t.lexeme!r}")
+        return self.fail(f"Expected value at {t.pos} but found {t.lexeme!r}", t.pos)
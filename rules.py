@@ -8,6 +8,14 @@ class DrugRule:
     max_single_dose_mg: Optional[float] = None
     renal_adjust_factor: float = 1.0
     elderly_adjust_factor: float = 1.0
+    conditions: Tuple[str, ...] = ()
+
+class RuleTable(dict):
+    # A drug -> DrugRule table. Tables are never mutated once installed: formulary reloads
+    # build a new one and rebind rules.DRUG_RULES, and `version` tells caches which table they saw.
+    def __init__(self, rules=(), version: str = "builtin"):
+        super().__init__(rules)
+        self.version = version
 
 def per_kg_mg_day(mg_per_kg: float, cap: float):
     def calc(ctx):
@@ -16,11 +24,13 @@ def per_kg_mg_day(mg_per_kg: float, cap: float):
             return (0.0, "No weight provided; cannot compute per-kg dose.")
         val = mg_per_kg * wt
         return (min(val, cap), f"{mg_per_kg} mg/kg/day capped at {cap} mg/day")
+    calc.spec = ("per_kg_mg_day", {"mg_per_kg": mg_per_kg, "cap": cap})
     return calc
 
 def fixed_mg_day(amount: float):
     def calc(ctx):
         return (amount, f"Fixed {amount} mg/day")
+    calc.spec = ("fixed_mg_day", {"amount": amount})
     return calc
 
 def condition_based(default: float, by_condition: Dict[str, float], cap: float | None = None):
@@ -30,66 +40,77 @@ def condition_based(default: float, by_condition: Dict[str, float], cap: float |
         if cap is not None and base > cap:
             return (cap, f"Condition-based {base} mg/day capped at {cap}")
         return (base, f"Condition-based {base} mg/day for {cond}")
+    calc.spec = ("condition_based", {"default": default, "by_condition": dict(by_condition), "cap": cap})
     return calc
 
-DRUG_RULES: Dict[str, DrugRule] = {
+DRUG_RULES: RuleTable = RuleTable({
     "amlodipine": DrugRule(
         calculator=condition_based(5.0, {"hypertension": 5.0}, cap=10.0),
         safe_range=(2.5, 10.0),
         max_single_dose_mg=10.0,
-        elderly_adjust_factor=0.8
+        elderly_adjust_factor=0.8,
+        conditions=("hypertension",)
     ),
     "losartan": DrugRule(
         calculator=condition_based(50.0, {"hypertension": 50.0}, cap=100.0),
         safe_range=(25.0, 100.0),
         max_single_dose_mg=100.0,
         renal_adjust_factor=0.8,
-        elderly_adjust_factor=0.9
+        elderly_adjust_factor=0.9,
+        conditions=("hypertension",)
     ),
     "metformin": DrugRule(
         calculator=per_kg_mg_day(20.0, cap=2000.0),
         safe_range=(500.0, 2000.0),
         max_single_dose_mg=1000.0,
         renal_adjust_factor=0.5,
-        elderly_adjust_factor=0.8
+        elderly_adjust_factor=0.8,
+        conditions=("diabetes",)
     ),
     "glimepiride": DrugRule(
         calculator=condition_based(2.0, {"diabetes": 2.0}, cap=8.0),
         safe_range=(1.0, 8.0),
-        max_single_dose_mg=4.0
+        max_single_dose_mg=4.0,
+        conditions=("diabetes",)
     ),
     "amoxicillin": DrugRule(
         calculator=per_kg_mg_day(30.0, cap=1500.0),
         safe_range=(500.0, 1500.0),
         max_single_dose_mg=1000.0,
-        renal_adjust_factor=0.5
+        renal_adjust_factor=0.5,
+        conditions=("infection",)
     ),
     "azithromycin": DrugRule(
         calculator=per_kg_mg_day(10.0, cap=500.0),
         safe_range=(250.0, 500.0),
-        max_single_dose_mg=500.0
+        max_single_dose_mg=500.0,
+        conditions=("infection",)
     ),
     "paracetamol": DrugRule(
         calculator=per_kg_mg_day(60.0, cap=4000.0),
         safe_range=(0.0, 4000.0),
-        max_single_dose_mg=1000.0
+        max_single_dose_mg=1000.0,
+        conditions=("pain", "fever")
     ),
     "ibuprofen": DrugRule(
         calculator=per_kg_mg_day(20.0, cap=1200.0),
         safe_range=(0.0, 1200.0),
-        max_single_dose_mg=400.0
+        max_single_dose_mg=400.0,
+        conditions=("pain", "fever")
     ),
     "salbutamol": DrugRule(
         calculator=per_kg_mg_day(0.3, cap=12.0),
         safe_range=(2.0, 12.0),
-        max_single_dose_mg=4.0
+        max_single_dose_mg=4.0,
+        conditions=("asthma",)
     ),
     "montelukast": DrugRule(
         calculator=fixed_mg_day(10.0),
         safe_range=(5.0, 10.0),
-        max_single_dose_mg=10.0
+        max_single_dose_mg=10.0,
+        conditions=("asthma",)
     ),
-}
+})
 
 INTERACTIONS: Dict[frozenset[str], str] = {
     frozenset(["losartan", "ibuprofen"]): "caution: NSAIDs may blunt antihypertensive effect",
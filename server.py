@@ -0,0 +1,243 @@
+from __future__ import annotations
+from typing import Dict, Any, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from urllib.parse import urlsplit, parse_qs
+import argparse, asyncio, json
+import metrics
+from errors import InterpreterError
+from ast_nodes import CalculateDose, AdjustDose, ValidatePrescription, ReportRegimen, AlertThreshold, Command
+from executor import normalize_ctx, compute_dose, check_alert_rules, get_alerts
+from interpreter import compile_command, execute_observed, run
+
+try:
+    from batch import compute_doses
+except ImportError:  # numpy missing: dose requests are still batched, but computed one by one
+    compute_doses = None
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large",
+            500: "Internal Server Error"}
+MAX_BODY = 8 * 1024 * 1024
+
+def _touches_store(node: Command) -> bool:
+    # ALERT writes the rule file; alert rules with a window read the patient's regimen
+    if isinstance(node, (ReportRegimen, AlertThreshold)):
+        return True
+    return isinstance(node, (CalculateDose, AdjustDose, ValidatePrescription)) and \
+        any(str(k).lower() == "patient_id" for k in node.params)
+
+def _error(e: Exception) -> Dict[str, Any]:
+    return {"status": "error", "error": str(e), "error_type": type(e).__name__}
+
+
+class DoseBatcher:
+    # Dose requests arriving within `max_delay` seconds (or until `max_batch` are queued)
+    # are computed together in one vectorized pass. With max_delay=0 a batch is whatever
+    # arrived during the current event-loop iteration, so a lone request is not delayed.
+    # Batches smaller than `min_vector` are cheaper to compute with compute_dose directly.
+
+    def __init__(self, max_batch: int = 512, max_delay: float = 0.0, min_vector: int = 16):
+        self.max_batch = max_batch
+        self.min_vector = min_vector
+        self.max_delay = max_delay
+        self._queue: List[Tuple[Dict[str, Any], asyncio.Future]] = []
+        self._timer: Optional[asyncio.Handle] = None
+
+    async def submit(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        loop = asyncio.get_running_loop()
+        if not isinstance(params, dict):
+            raise InterpreterError("expected a JSON object of dose parameters")
+        if any(str(k).lower() == "patient_id" for k in params):
+            # /dose never reads or records a regimen; a patient's dose needs the full CALCULATE
+            raise InterpreterError("/dose does not take patient_id; use POST /run with CALCULATE DOSE FOR ... patient_id=<id>")
+        ctx = normalize_ctx(params)
+        fut = loop.create_future()
+        self._queue.append((ctx, fut))
+        if len(self._queue) >= self.max_batch:
+            self.flush()
+        elif self._timer is None:
+            if self.max_delay > 0:
+                self._timer = loop.call_later(self.max_delay, self.flush)
+            else:
+                self._timer = loop.call_soon(self.flush)
+        return await fut
+
+    def flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        items, self._queue = self._queue, []
+        if not items:
+            return
+        if compute_doses is None or len(items) < self.min_vector:
+            for ctx, fut in items:
+                try:
+                    self._resolve(ctx, fut, compute_dose(ctx))
+                except Exception as e:
+                    self._resolve(ctx, fut, error=e)
+            return
+        ctxs = [ctx for ctx, _ in items]
+        try:
+            batch = compute_doses(
+                [c.get("drug") for c in ctxs], [c.get("condition") for c in ctxs], [c.get("weight_kg") for c in ctxs],
+                [c.get("age") for c in ctxs], [c.get("kidney_function") for c in ctxs])
+        except Exception as e:
+            # every request in the batch gets the error rather than waiting forever
+            for ctx, fut in items:
+                self._resolve(ctx, fut, error=e)
+            return
+        for i, (ctx, fut) in enumerate(items):
+            try:
+                self._resolve(ctx, fut, batch.result(i))
+            except Exception as e:
+                self._resolve(ctx, fut, error=e)
+
+    def _resolve(self, ctx: Dict[str, Any], fut: asyncio.Future, result: Optional[Dict[str, Any]] = None,
+                 error: Optional[Exception] = None):
+        # /dose bypasses interpreter.run, so its traffic is counted here rather than by the run hook.
+        if metrics.ENABLED:
+            metrics.count("CALCULATE", metrics.drug_label(ctx.get("drug")), result, error)
+        if error is None:
+            # no patient here, so only dose rules apply and nothing reads the store
+            fired = check_alert_rules(result["drug"], None, result["recommended_mg_per_day"])
+            if fired:
+                result = {**result, "alerts": fired}
+        if fut.cancelled():
+            return
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
+
+
+class InterpreterServer:
+    def __init__(self, io_workers: int = 4, max_batch: int = 512, max_delay: float = 0.0):
+        self.pool = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="regimen-io")
+        self.doses = DoseBatcher(max_batch, max_delay)
+
+    async def run_command(self, source: str) -> Dict[str, Any]:
+        # through run(), so the instrument hooks (metrics) see it; the node is cached, so
+        # compiling it here to pick a thread costs a lookup
+        if _touches_store(compile_command(source)):
+            return await asyncio.get_running_loop().run_in_executor(self.pool, run, source)
+        return run(source)
+
+    async def route(self, method: str, path: str, query: Dict[str, List[str]], body: Any) -> Tuple[int, Any]:
+        if path in ("/run", "/batch", "/report") and not isinstance(body, dict):
+            return 400, {"status": "error", "error": "expected a JSON object body"}
+        if path == "/health":
+            return 200, {"status": "ok"}
+        if path == "/metrics" and method == "GET":
+            return 200, metrics.render()
+        if path == "/run" and method == "POST":
+            return 200, await self.run_command(str(body.get("command", "")))
+        if path == "/batch" and method == "POST":
+            if not isinstance(body.get("commands", []), list):
+                return 400, {"status": "error", "error": "commands must be a list of command strings"}
+            results = []
+            for source in body.get("commands", []):
+                try:
+                    results.append({"status": "success", "result": await self.run_command(str(source))})
+                except InterpreterError as e:
+                    results.append(_error(e))
+            return 200, {"results": results}
+        if path == "/dose" and method == "POST":
+            if isinstance(body, list):
+                outs = await asyncio.gather(*(self.doses.submit(p) for p in body), return_exceptions=True)
+                return 200, {"results": [_error(o) if isinstance(o, Exception) else {"status": "success", "result": o}
+                                         for o in outs]}
+            return 200, {"type": "CALCULATE", "result": await self.doses.submit(body)}
+        if path == "/report" and method in ("GET", "POST"):
+            pid = (query.get("patient_id") or [None])[0] or (body or {}).get("patient_id")
+            if not pid:
+                raise InterpreterError("REPORT requires patient_id=<id>")
+            params = {"patient_id": str(pid)}
+            for key in ("since", "limit", "offset", "cursor"):
+                value = (query.get(key) or [None])[0] or (body or {}).get(key)
+                if value:
+                    params[key] = value
+            return 200, await asyncio.get_running_loop().run_in_executor(self.pool, execute_observed, ReportRegimen("REPORT", params))
+        if path == "/alerts" and method == "GET":
+            # fired alert events, oldest first; each is returned once
+            n = (query.get("max") or [None])[0]
+            if n and not n.isdecimal():
+                return 400, {"status": "error", "error": f"max must be a whole number, got {n!r}"}
+            events = get_alerts().drain(int(n) if n else None)
+            return 200, {"events": [asdict(e) for e in events], "dropped": get_alerts().dropped}
+        if path in ("/run", "/batch", "/dose", "/report", "/alerts"):
+            return 405, {"status": "error", "error": f"{method} not allowed on {path}"}
+        return 404, {"status": "error", "error": f"no route for {path}"}
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                lines = head.decode("latin-1").split("\r\n")
+                method, target, version = (lines[0].split(" ") + ["", ""])[:3]
+                headers = {}
+                for line in lines[1:]:
+                    if ":" in line:
+                        k, v = line.split(":", 1)
+                        headers[k.strip().lower()] = v.strip()
+                length = int(headers.get("content-length") or 0)
+                keep_alive = headers.get("connection", "").lower() != "close" and version != "HTTP/1.0"
+                if length > MAX_BODY:
+                    status, payload, keep_alive = 413, {"status": "error", "error": "request body too large"}, False
+                else:
+                    raw = await reader.readexactly(length) if length else b""
+                    status, payload = await self._dispatch(method, target, raw)
+                if isinstance(payload, str):
+                    data, ctype = payload.encode(), "text/plain; version=0.0.4; charset=utf-8"
+                else:
+                    data, ctype = json.dumps(payload).encode(), "application/json"
+                writer.write(f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+                             f"Content-Type: {ctype}\r\nContent-Length: {len(data)}\r\n"
+                             f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode() + data)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method: str, target: str, raw: bytes) -> Tuple[int, Any]:
+        url = urlsplit(target)
+        try:
+            body = json.loads(raw) if raw else {}
+        except ValueError as e:
+            return 400, {"status": "error", "error": f"invalid JSON body: {e}"}
+        try:
+            return await self.route(method.upper(), url.path, parse_qs(url.query), body)
+        except InterpreterError as e:
+            return 400, _error(e)
+        except Exception as e:
+            return 500, _error(e)
+
+    async def serve(self, host: str = "127.0.0.1", port: int = 8765):
+        server = await asyncio.start_server(self.handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv: List[str] | None = None):
+    ap = argparse.ArgumentParser(description="Serve the prescription interpreter over HTTP/JSON.")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--io-workers", type=int, default=4, help="threads for regimen store I/O")
+    ap.add_argument("--max-batch", type=int, default=512, help="largest dose micro-batch")
+    ap.add_argument("--max-delay-ms", type=float, default=0.0,
+                    help="longest wait to fill a dose micro-batch (0: batch what arrives in one loop iteration)")
+    ap.add_argument("--metrics", action="store_true", help="collect Prometheus metrics, served on GET /metrics")
+    args = ap.parse_args(argv)
+    if args.metrics:
+        metrics.enable()
+    srv = InterpreterServer(args.io_workers, args.max_batch, args.max_delay_ms / 1000.0)
+    try:
+        asyncio.run(srv.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,592 @@
+from __future__ import annotations
+from typing import Dict, Any, List, Tuple, Optional, Iterable, Callable
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+import json, os, re, sqlite3, threading, time
+from errors import ExecutionError
+from locks import flock
+
+Span = Tuple[int, int]
+
+def _coalesce(spans: List[Span]) -> List[Span]:
+    out: List[Span] = []
+    for off, n in spans:
+        if out and out[-1][0] + out[-1][1] == off:
+            out[-1] = (out[-1][0], out[-1][1] + n)
+        else:
+            out.append((off, n))
+    return out
+
+def _frame(patient_id: str, entry: Dict[str, Any], ts: Optional[float] = None):
+    # The record line around its timestamp: (head, tail) to join with the ts at flush time.
+    head = b'{"patient_id":%s,"ts":' % json.dumps(patient_id).encode()
+    tail = b',"entry":%s}\n' % json.dumps(entry, separators=(",", ":")).encode()
+    return (head, tail) if ts is None else head + repr(float(ts)).encode() + tail
+
+# Page cursors are opaque to callers: "c" + hex, so they survive the command lexer as an
+# identifier. JSONL stores put the patient's next entry number in it, SQLite the last row id.
+_CURSOR = re.compile(r"c[0-9a-f]+")
+
+def _cursor(n: int) -> str:
+    return f"c{n:x}"
+
+def _uncursor(cursor: Optional[str]) -> Optional[int]:
+    if cursor is None:
+        return None
+    if not _CURSOR.fullmatch(str(cursor)):
+        raise ExecutionError(f"Invalid report cursor '{cursor}'")
+    return int(str(cursor)[1:], 16)
+
+Page = Tuple[List[Dict[str, Any]], Optional[str], Optional[int]]
+
+def dose_mg(entry: Dict[str, Any]) -> Optional[float]:
+    # mg/day an entry orders, for window totals: a CALCULATE result or a validated dose
+    mg = entry.get("recommended_mg_per_day", entry.get("dose_mg_per_day"))
+    return float(mg) if isinstance(mg, (int, float)) else None
+
+DAY = 86400.0
+
+def repeats(last: Optional[Tuple[float, float]], ts: float, mg: float) -> bool:
+    # An order of the same mg/day as the drug's last counted order (ts, mg), within the day
+    # that order covers, is that order recalculated and not counted again.
+    return last is not None and last[1] == mg and ts - last[0] < DAY
+
+class _Totals:
+    # Per-patient timestamps (aligned with the span index) and, per (patient, drug), the
+    # counted orders: their times, mg/day and running sum. Records are timestamped in file
+    # order, so everything stays sorted and every window query is a bisect.
+    __slots__ = ("times", "orders", "drugs", "last_ts")
+
+    def __init__(self):
+        self.times: Dict[str, List[float]] = {}
+        self.orders: Dict[Tuple[str, str], Tuple[List[float], List[float], List[float]]] = {}
+        self.drugs: Dict[str, set] = {}
+        self.last_ts = 0.0
+
+    def add(self, pid: str, ts: float, entry: Dict[str, Any]):
+        self.times.setdefault(pid, []).append(ts)
+        self.last_ts = max(self.last_ts, ts)
+        drug = entry.get("drug")
+        if not drug:
+            return
+        self.drugs.setdefault(pid, set()).add(drug)
+        mg = dose_mg(entry)
+        if mg is None:
+            return
+        times, mgs, sums = self.orders.setdefault((pid, drug), ([], [], []))
+        if not repeats((times[-1], mgs[-1]) if times else None, ts, mg):
+            times.append(ts)
+            mgs.append(mg)
+            sums.append(sums[-1] + mg if sums else mg)
+
+    def copy(self) -> "_Totals":
+        out = _Totals()
+        out.times = {pid: list(t) for pid, t in self.times.items()}
+        out.orders = {k: (list(t), list(m), list(s)) for k, (t, m, s) in self.orders.items()}
+        out.drugs = {pid: set(d) for pid, d in self.drugs.items()}
+        out.last_ts = self.last_ts
+        return out
+
+    def since(self, pid: str, ts: float) -> int:
+        return bisect_left(self.times.get(pid, ()), ts)
+
+    def ordered(self, pid: str, drug: str, start: float, end: float, pending_mg: Optional[float] = None) -> float:
+        times, mgs, sums = self.orders.get((pid, drug)) or ((), (), ())
+        i, j = bisect_right(times, start), bisect_right(times, end)
+        total = sums[j - 1] - (sums[i - 1] if i else 0.0) if j > i else 0.0
+        if pending_mg is not None and not repeats((times[-1], mgs[-1]) if times else None, end, pending_mg):
+            total += pending_mg
+        return total
+
+def _read_legacy(legacy_path: str) -> Iterable[Tuple[str, Dict[str, Any]]]:
+    with open(legacy_path, "r") as f:
+        state = json.load(f)
+    for pid, entries in state.get("patients", {}).items():
+        for entry in entries:
+            yield pid, entry
+
+
+class _Batch:
+    __slots__ = ("items", "done", "error")
+
+    def __init__(self):
+        self.items: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+
+
+class _GroupCommit:
+    # Concurrent writers queue their items; the first one in becomes the leader and flushes
+    # everything queued so far with a single write + fsync while the others wait on it.
+
+    def __init__(self, flush: Callable[[List[Any]], None]):
+        self._flush = flush
+        self._cond = threading.Condition()
+        self._open = _Batch()
+        self._flushing = False
+
+    def submit(self, items: List[Any], wait: bool = True) -> _Batch:
+        with self._cond:
+            batch = self._open
+            batch.items.extend(items)
+        if wait:
+            self.wait(batch)
+        return batch
+
+    def wait(self, batch: _Batch):
+        with self._cond:
+            while not batch.done:
+                if self._flushing:
+                    self._cond.wait()
+                    continue
+                self._flushing = True
+                flushing, self._open = self._open, _Batch()
+                self._cond.release()
+                try:
+                    self._flush(flushing.items)
+                except BaseException as e:
+                    flushing.error = e
+                finally:
+                    self._cond.acquire()
+                    self._flushing = False
+                    flushing.done = True
+                    self._cond.notify_all()
+        if batch.error is not None:
+            raise batch.error
+
+
+class JsonlRegimenStore:
+    # One JSON line per record plus an in-memory {patient_id: [(offset, length)]} index.
+    # Appends from every thread and process go through an advisory lock on `<path>.lock`;
+    # the index catches up on lines other processes appended before each read or write.
+    # Every `compact_every` appends a background thread regroups the log by patient.
+    # Lines are timestamped when flushed, never earlier than the last line in the file, and
+    # the same scan keeps a _Totals (times, drugs, mg running totals) beside the index.
+
+    def __init__(self, path: str, legacy_path: Optional[str] = None, compact_every: int = 10000, fsync: bool = True):
+        self.path = path
+        self.compact_every = compact_every
+        self.fsync = fsync
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._commits = _GroupCommit(self._flush)
+        self._index: Dict[str, List[Span]] = {}
+        self._totals = _Totals()
+        self._end = 0
+        self._ino = None
+        self._appends = 0
+        self._compacting = False
+        self._compactor: Optional[threading.Thread] = None
+        self._lockfh = open(path + ".lock", "a+b")
+        with flock(self._lockfh):
+            if legacy_path and not os.path.exists(path) and os.path.exists(legacy_path):
+                self._import_legacy(legacy_path)
+            self._open()
+            if os.path.getsize(self.path) > self._end:
+                self._wfh.truncate(self._end)
+
+    def _import_legacy(self, legacy_path: str):
+        tmp = f"{self.path}.import.{os.getpid()}"
+        with open(tmp, "wb") as out:
+            for pid, entry in _read_legacy(legacy_path):
+                out.write(_frame(pid, entry, 0.0))
+            out.flush()
+            os.fsync(out.fileno())
+        os.replace(tmp, self.path)
+
+    def _open(self, index: Optional[Dict[str, List[Span]]] = None, end: int = 0, totals: Optional[_Totals] = None):
+        self._wfh = open(self.path, "ab")
+        self._rfh = open(self.path, "rb")
+        self._ino = os.fstat(self._rfh.fileno()).st_ino
+        self._index = index if index is not None else {}
+        self._totals = totals if totals is not None else _Totals()
+        self._end = end
+        self._scan()
+
+    def _scan(self):
+        self._rfh.seek(self._end)
+        off = self._end
+        for line in self._rfh:
+            if not line.endswith(b"\n"):
+                break
+            rec = json.loads(line)
+            pid = rec["patient_id"]
+            self._index.setdefault(pid, []).append((off, len(line)))
+            self._totals.add(pid, rec.get("ts", 0.0), rec["entry"])
+            off += len(line)
+        self._end = off
+
+    def _refresh(self):
+        st = os.stat(self.path)
+        if st.st_ino != self._ino:
+            self._wfh.close()
+            self._rfh.close()
+            self._open()
+        elif st.st_size > self._end:
+            self._scan()
+
+    def _flush(self, items: List[Tuple[str, Dict[str, Any], Tuple[bytes, bytes]]]):
+        with self._lock, flock(self._lockfh):
+            self._refresh()
+            ts = max(time.time(), self._totals.last_ts)
+            stamp = repr(ts).encode()
+            lines = [head + stamp + tail for _, _, (head, tail) in items]
+            self._wfh.write(b"".join(lines))
+            self._wfh.flush()
+            if self.fsync:
+                os.fsync(self._wfh.fileno())
+            off = self._end
+            for (pid, entry, _), line in zip(items, lines):
+                self._index.setdefault(pid, []).append((off, len(line)))
+                self._totals.add(pid, ts, entry)
+                off += len(line)
+            self._end = off
+            self._appends += len(items)
+            if self._appends >= self.compact_every and not self._compacting:
+                self._appends = 0
+                self._compacting = True
+                self._compactor = threading.Thread(target=self._compact, daemon=True)
+                self._compactor.start()
+
+    def record(self, patient_id: str, entry: Dict[str, Any]):
+        self.record_many([(patient_id, entry)])
+
+    def record_many(self, items: Iterable[Tuple[str, Dict[str, Any]]]):
+        lines = [(pid, entry, _frame(pid, entry)) for pid, entry in items]
+        # Drugs are noted at submit time, so writes still queued in a batch() count too. Not
+        # under _lock, which a flush holds through its fsync; set.add is atomic on its own.
+        drugs = self._totals.drugs
+        for pid, entry, _ in lines:
+            if entry.get("drug"):
+                drugs.setdefault(pid, set()).add(entry["drug"])
+        if getattr(self._local, "depth", 0):
+            # a flush can close the open batch between submits, so keep every one this
+            # thread queued into; the last alone would hide an earlier batch's error
+            batch = self._commits.submit(lines, wait=False)
+            pending = getattr(self._local, "pending", None)
+            if pending is None:
+                pending = self._local.pending = []
+            if not pending or pending[-1] is not batch:
+                pending.append(batch)
+            queued = getattr(self._local, "queued", None)
+            if queued is None:
+                queued = self._local.queued = set()
+            queued.update((pid, entry.get("drug")) for pid, entry, _ in lines)
+        else:
+            self._commits.submit(lines)
+
+    def _drain(self):
+        pending = getattr(self._local, "pending", None)
+        if pending:
+            self._local.pending = None
+            self._local.queued = None
+            error = None
+            for batch in pending:
+                try:
+                    self._commits.wait(batch)
+                except BaseException as e:
+                    if error is None:
+                        error = e
+            if error is not None:
+                raise error
+
+    @contextmanager
+    def batch(self):
+        self._local.depth = getattr(self._local, "depth", 0) + 1
+        try:
+            yield self
+        finally:
+            self._local.depth -= 1
+            if not self._local.depth:
+                self._drain()
+
+    def report(self, patient_id: str, since: Optional[float] = None) -> List[Dict[str, Any]]:
+        # Entries in record order, each with its "ts"; since= keeps those recorded at or after it.
+        return self.page(patient_id, since)[0]
+
+    def page(self, patient_id: str, since: Optional[float] = None, cursor: Optional[str] = None,
+             offset: int = 0, limit: Optional[int] = None) -> Page:
+        # (entries, next cursor or None, entries in the window). Only the page's lines are read.
+        start = _uncursor(cursor) or 0
+        self._drain()
+        with self._lock:
+            self._refresh()
+            spans = self._index.get(patient_id, [])
+            first = self._totals.since(patient_id, since) if since is not None else 0
+            start = max(start, first) + offset
+            stop = len(spans) if limit is None else min(len(spans), start + limit)
+            chunks = []
+            for off, n in _coalesce(spans[start:stop]):
+                self._rfh.seek(off)
+                chunks.append(self._rfh.read(n))
+            total = len(spans) - first
+        return self._decode(chunks), (_cursor(stop) if stop < len(spans) else None), total
+
+    @staticmethod
+    def _decode(chunks: List[bytes]) -> List[Dict[str, Any]]:
+        out = []
+        for buf in chunks:
+            for line in buf.splitlines():
+                rec = json.loads(line)
+                out.append({**rec["entry"], "ts": rec.get("ts", 0.0)})
+        return out
+
+    def cumulative(self, patient_id: str, drug: str, start: float, end: float, pending_mg: Optional[float] = None) -> float:
+        # mg/day of the drug ordered after start up to end, each order counted once; with
+        # pending_mg, plus an order being placed at end unless it repeats the last one. Only
+        # this thread's own queued writes to the same patient and drug need a flush first.
+        if (patient_id, drug) in (getattr(self._local, "queued", None) or ()):
+            self._drain()
+        with self._lock:
+            self._refresh()
+            return self._totals.ordered(patient_id, drug, start, end, pending_mg)
+
+    def drugs(self, patient_id: str) -> List[str]:
+        with self._lock:
+            self._refresh()
+            return list(self._totals.drugs.get(patient_id, ()))
+
+    def patients(self) -> List[str]:
+        with self._lock:
+            self._refresh()
+            return list(self._index)
+
+    def compact(self):
+        with self._lock:
+            if self._compacting:
+                return
+            self._compacting = True
+        self._compact()
+
+    def _compact(self):
+        tmp = f"{self.path}.compact.{os.getpid()}"
+        try:
+            with self._lock:
+                self._refresh()
+                end, ino = self._end, self._ino
+                snapshot = {pid: list(spans) for pid, spans in self._index.items()}
+                totals = self._totals.copy()
+            index: Dict[str, List[Span]] = {}
+            pos = 0
+            with open(self.path, "rb") as src, open(tmp, "wb") as dst:
+                if os.fstat(src.fileno()).st_ino != ino:
+                    return
+                for pid, spans in snapshot.items():
+                    new = index[pid] = []
+                    for off, n in spans:
+                        new.append((pos, n))
+                        pos += n
+                    for off, n in _coalesce(spans):
+                        src.seek(off)
+                        dst.write(src.read(n))
+                with self._lock, flock(self._lockfh):
+                    if os.stat(self.path).st_ino != ino:
+                        return
+                    src.seek(end)
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                    os.replace(tmp, self.path)
+                    self._wfh.close()
+                    self._rfh.close()
+                    self._open(index, pos, totals)
+        finally:
+            self._compacting = False
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def close(self):
+        self._drain()
+        compactor = self._compactor
+        if compactor is not None and compactor is not threading.current_thread():
+            compactor.join()
+        with self._lock:
+            self._wfh.close()
+            self._rfh.close()
+            self._lockfh.close()
+
+
+_POOL: Dict[Tuple[str, int], sqlite3.Connection] = {}
+_POOL_LOCK = threading.Lock()
+
+def _connect(path: str) -> sqlite3.Connection:
+    key = (path, os.getpid())
+    conn = _POOL.get(key)
+    if conn is None:
+        with _POOL_LOCK:
+            conn = _POOL.get(key)
+            if conn is None:
+                conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=FULL")
+                conn.execute("PRAGMA busy_timeout=5000")
+                _POOL[key] = conn
+    return conn
+
+
+class SqliteRegimenStore:
+    # One pooled connection per (database, process); WAL mode so readers never block the writer.
+    # regimen_drugs keeps the distinct drugs per patient and dose_orders the counted orders with
+    # their running mg per (patient, drug), both written with the entries; a window total is
+    # two index seeks.
+
+    def __init__(self, path: str, legacy_path: Optional[str] = None):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._owner = None
+        self._commits = _GroupCommit(self._flush)
+        conn = _connect(path)
+        with self._lock:
+            conn.execute("CREATE TABLE IF NOT EXISTS regimens ("
+                         "id INTEGER PRIMARY KEY, patient_id TEXT NOT NULL, ts REAL NOT NULL, entry TEXT NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_regimens_patient_ts ON regimens(patient_id, ts)")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            conn.execute("CREATE TABLE IF NOT EXISTS regimen_drugs ("
+                         "patient_id TEXT NOT NULL, drug TEXT NOT NULL, PRIMARY KEY (patient_id, drug)) WITHOUT ROWID")
+            conn.execute("CREATE TABLE IF NOT EXISTS dose_orders ("
+                         "id INTEGER PRIMARY KEY, patient_id TEXT NOT NULL, drug TEXT NOT NULL, ts REAL NOT NULL, "
+                         "mg REAL NOT NULL, total REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_dose_orders ON dose_orders(patient_id, drug, ts)")
+        if legacy_path and os.path.exists(legacy_path):
+            self.migrate_json(legacy_path)
+
+    def _add_order(self, conn: sqlite3.Connection, pid: str, ts: float, entry: Dict[str, Any]):
+        mg = dose_mg(entry)
+        if mg is None or not entry.get("drug"):
+            return
+        last = conn.execute("SELECT ts, mg, total FROM dose_orders WHERE patient_id = ? AND drug = ? "
+                            "ORDER BY ts DESC, id DESC LIMIT 1", (pid, entry["drug"])).fetchone()
+        total = mg
+        if last is not None:
+            ts = max(ts, last[0])
+            if repeats(last[:2], ts, mg):
+                return
+            total += last[2]
+        conn.execute("INSERT INTO dose_orders (patient_id, drug, ts, mg, total) VALUES (?, ?, ?, ?, ?)",
+                     (pid, entry["drug"], ts, mg, total))
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        return _connect(self.path)
+
+    def migrate_json(self, legacy_path: str) -> int:
+        key = "migrated:" + os.path.abspath(legacy_path)
+        with self.batch() as store:
+            conn = store.conn
+            if conn.execute("SELECT 1 FROM meta WHERE key = ?", (key,)).fetchone():
+                return 0
+            rows = list(_read_legacy(legacy_path))
+            self._insert(conn, rows, 0.0)
+            conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)", (key, str(len(rows))))
+        return len(rows)
+
+    def _insert(self, conn: sqlite3.Connection, items: List[Tuple[str, Dict[str, Any]]], ts: float):
+        conn.executemany("INSERT INTO regimens (patient_id, ts, entry) VALUES (?, ?, ?)",
+                         [(pid, ts, json.dumps(entry, separators=(",", ":"))) for pid, entry in items])
+        conn.executemany("INSERT OR IGNORE INTO regimen_drugs (patient_id, drug) VALUES (?, ?)",
+                         [(pid, entry["drug"]) for pid, entry in items if entry.get("drug")])
+        for pid, entry in items:
+            self._add_order(conn, pid, ts, entry)
+
+    @contextmanager
+    def batch(self):
+        with self._lock:
+            conn = self.conn
+            if not self._depth:
+                conn.execute("BEGIN IMMEDIATE")
+                self._owner = threading.get_ident()
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._depth -= 1
+                if not self._depth:
+                    self._owner = None
+                    conn.execute("ROLLBACK")
+                raise
+            else:
+                self._depth -= 1
+                if not self._depth:
+                    self._owner = None
+                    conn.execute("COMMIT")
+
+    def record(self, patient_id: str, entry: Dict[str, Any]):
+        self.record_many([(patient_id, entry)])
+
+    def record_many(self, items: Iterable[Tuple[str, Dict[str, Any]]]):
+        items = list(items)
+        if self._owner == threading.get_ident():
+            self._insert(self.conn, items, time.time())
+        else:
+            self._commits.submit(items)
+
+    def _flush(self, items: List[Tuple[str, Dict[str, Any]]]):
+        with self.batch() as store:
+            self._insert(store.conn, items, time.time())
+
+    def report(self, patient_id: str, since: Optional[float] = None) -> List[Dict[str, Any]]:
+        return self.page(patient_id, since)[0]
+
+    def page(self, patient_id: str, since: Optional[float] = None, cursor: Optional[str] = None,
+             offset: int = 0, limit: Optional[int] = None) -> Page:
+        # Keyset paging on (ts, id): a cursor seeks straight to its row instead of counting an
+        # OFFSET. COUNT(*) walks the patient's index range, so cursor pages skip it (total None).
+        after = _uncursor(cursor)
+        where, args = "patient_id = ?", [patient_id]
+        if since is not None:
+            where += " AND ts >= ?"
+            args.append(since)
+        with self._lock:
+            conn = self.conn
+            total = None
+            if after is None:
+                total = conn.execute(f"SELECT COUNT(*) FROM regimens WHERE {where}", args).fetchone()[0]
+            else:
+                where += " AND (ts, id) > (SELECT ts, id FROM regimens WHERE id = ?)"
+                args.append(after)
+            rows = conn.execute(f"SELECT id, entry, ts FROM regimens WHERE {where} ORDER BY ts, id LIMIT ? OFFSET ?",
+                                (*args, -1 if limit is None else limit + 1, offset)).fetchall()
+        more = limit is not None and len(rows) > limit
+        rows = rows[:limit] if more else rows
+        return [{**json.loads(entry), "ts": ts} for _, entry, ts in rows], (_cursor(rows[-1][0]) if more else None), total
+
+    def cumulative(self, patient_id: str, drug: str, start: float, end: float, pending_mg: Optional[float] = None) -> float:
+        # the running totals of the last orders up to start and up to end
+        with self._lock:
+            conn = self.conn
+            before = conn.execute("SELECT total FROM dose_orders WHERE patient_id = ? AND drug = ? AND ts <= ? "
+                                  "ORDER BY ts DESC, id DESC LIMIT 1", (patient_id, drug, start)).fetchone()
+            last = conn.execute("SELECT ts, mg, total FROM dose_orders WHERE patient_id = ? AND drug = ? AND ts <= ? "
+                                "ORDER BY ts DESC, id DESC LIMIT 1", (patient_id, drug, end)).fetchone()
+        total = 0.0 if last is None or end < start else last[2] - (before[0] if before else 0.0)
+        if pending_mg is not None and not repeats(last and last[:2], end, pending_mg):
+            total += pending_mg
+        return total
+
+    def drugs(self, patient_id: str) -> List[str]:
+        with self._lock:
+            return [r[0] for r in self.conn.execute("SELECT drug FROM regimen_drugs WHERE patient_id = ?", (patient_id,))]
+
+    def patients(self) -> List[str]:
+        with self._lock:
+            return [r[0] for r in self.conn.execute("SELECT DISTINCT patient_id FROM regimens")]
+
+    def compact(self):
+        with self._lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def close(self):
+        with _POOL_LOCK:
+            conn = _POOL.pop((self.path, os.getpid()), None)
+        if conn is not None:
+            conn.close()
+
+
+BACKENDS = {"jsonl": JsonlRegimenStore, "sqlite": SqliteRegimenStore}
+
+def open_store(backend: str, path: str, legacy_path: Optional[str] = None):
+    cls = BACKENDS.get(backend)
+    if cls is None:
+        raise ExecutionError(f"Unknown regimen backend '{backend}' (expected one of {', '.join(BACKENDS)})")
+    return cls(path, legacy_path=legacy_path)
@@ -0,0 +1,39 @@
+import os, sys, time
+import pytest
+
+# The modules live flat in the repository root, the way the app and CLI import them.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import executor
+
+
+class Clock:
+    # time.time() under test control; starts in the past so nothing else's timestamps interfere.
+    def __init__(self, now: float = 1_700_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, hours: float):
+        self.now += hours * 3600
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    c = Clock()
+    monkeypatch.setattr(time, "time", c)
+    return c
+
+
+@pytest.fixture(params=["jsonl", "sqlite"])
+def backend(request, tmp_path, monkeypatch):
+    # A fresh store of each kind in tmp_path, with in-memory alert rules.
+    monkeypatch.chdir(tmp_path)
+    name = "regimens.jsonl" if request.param == "jsonl" else "regimens.db"
+    saved = executor.REGIMEN_BACKEND
+    executor.configure_store(request.param, str(tmp_path / name))
+    executor.configure_alerts(None)
+    yield request.param
+    executor.configure_store(saved, None)
+    executor.configure_alerts(None)
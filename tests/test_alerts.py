@@ -0,0 +1,62 @@
+import os
+import pytest
+from alerts import AlertRegistry
+from errors import ExecutionError
+from interpreter import run
+
+
+def test_reads_never_create_files(tmp_path):
+    reg = AlertRegistry(str(tmp_path / "alert_rules.json"))
+    assert reg.applicable("metformin", "p1") == []
+    assert reg.evaluate("metformin", "p1", 5000.0, 2000.0) == []
+    assert os.listdir(tmp_path) == []
+
+
+def test_unwritable_path_fails_only_on_add(tmp_path):
+    reg = AlertRegistry(str(tmp_path / "missing" / "alert_rules.json"))
+    assert reg.evaluate("metformin", None, 5000.0, 2000.0) == []
+    with pytest.raises(ExecutionError, match="could not save alert rules"):
+        reg.add("metformin", threshold_mg=1000.0)
+    assert reg.rules() == []
+
+
+def test_rules_apply_by_drug_and_patient():
+    reg = AlertRegistry()
+    everyone = reg.add("metformin", threshold_mg=1000.0)
+    p1_only = reg.add("metformin", patient_id="p1", percent=50.0)
+    any_drug = reg.add(patient_id="p2", threshold_mg=1.0)
+    assert reg.add("metformin", threshold_mg=1000.0) == everyone      # registered once
+    fired = lambda drug, pid, mg: [e.rule_id for e in reg.evaluate(drug, pid, mg, 2000.0)]
+    assert fired("metformin", None, 1200.0) == [everyone.id]
+    assert fired("metformin", "p1", 1200.0) == [p1_only.id, everyone.id]
+    assert fired("metformin", "p1", 900.0) == []
+    assert fired("ibuprofen", "p2", 5.0) == [any_drug.id]
+
+
+def test_window_rules_need_a_window_total():
+    reg = AlertRegistry()
+    rule = reg.add("metformin", threshold_mg=1500.0, window_hours=72)
+    assert reg.evaluate("metformin", None, 5000.0, 2000.0) == []
+    [event] = reg.evaluate("metformin", "p1", 500.0, 2000.0, window_total=lambda hours: 4600.0)
+    assert (event.rule_id, event.value_mg, event.limit_mg) == (rule.id, 4600.0, 4500.0)   # 1500 mg/day for 3 days
+    assert reg.evaluate("metformin", "p1", 500.0, 2000.0, window_total=lambda hours: 4500.0) == []
+
+
+def test_events_drain_oldest_first_and_overflow_is_counted():
+    reg = AlertRegistry(buffer=2)
+    reg.add("metformin", threshold_mg=0.0)
+    for mg in (1.0, 2.0, 3.0):
+        reg.evaluate("metformin", None, mg, 2000.0)
+    assert [e.value_mg for e in reg.drain()] == [2.0, 3.0]
+    assert reg.dropped == 1
+    assert reg.drain() == []
+
+
+def test_adjust_checks_window_rules_without_recording(backend, clock):
+    run("ALERT WHEN DOSE EXCEEDS SAFETY_LIMIT FOR drug=metformin, window=24h")
+    calculate = "CALCULATE DOSE FOR drug=metformin, condition=diabetes, weight=70kg, patient_id=p1"
+    adjust = "ADJUST DOSE FOR drug=metformin, condition=diabetes, weight=80kg, patient_id=p1"
+    assert "alerts" not in run(calculate)
+    assert [a["value_mg"] for a in run(adjust)["alerts"]] == [3000.0]
+    assert [a["value_mg"] for a in run(adjust)["alerts"]] == [3000.0]    # the ADJUST itself was not recorded
+    assert len(run("REPORT REGIMEN patient_id=p1")["entries"]) == 1
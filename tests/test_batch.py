@@ -0,0 +1,51 @@
+import itertools
+import pytest
+import executor
+import rules
+from batch import compute_doses, validate_prescriptions
+from interpreter import run
+
+DRUGS = sorted(rules.DRUG_RULES) + ["unknown", ""]
+
+
+@pytest.fixture(autouse=True)
+def no_alert_rules(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    executor.configure_alerts(None)
+
+
+def _outcome(fn, *args):
+    try:
+        return fn(*args), None
+    except Exception as e:
+        return None, (type(e), str(e))
+
+
+def _command(head: str, **params) -> str:
+    return head + " " + ", ".join(f"{k}={v}" for k, v in params.items() if v not in (None, ""))
+
+
+def test_compute_doses_matches_the_command():
+    rows = list(itertools.product(DRUGS, ["diabetes", "hypertension", "fever", None], [None, 3.5, 12, 70, 140],
+                                  [30, 70], ["normal", "impaired"]))
+    batch = compute_doses(*map(list, zip(*rows)))
+    assert len(batch) == len(rows)
+    for i, (drug, cond, weight, age, kidney) in enumerate(rows):
+        source = _command("CALCULATE DOSE FOR", drug=drug, condition=cond, weight=weight, age=age, kidney_function=kidney)
+        expected = _outcome(lambda: run(source)["result"])
+        assert _outcome(batch.result, i) == expected, source
+        if expected[1] is None:
+            assert bool(batch.alert[i]) == bool(expected[0]["alert"]), source
+
+
+def test_validate_prescriptions_matches_the_command():
+    rows = list(itertools.product(DRUGS, [None, 0.5, 250, 5000], [None, "mg", "g", "mg/kg/day", "mg/dose", "ml"],
+                                  [None, 40], [None, 3]))
+    batch = validate_prescriptions(*map(list, zip(*rows)))
+    messages = batch.messages()
+    for i, (drug, dose, unit, weight, per_day) in enumerate(rows):
+        amount = None if dose is None else f"{dose}{unit or ''}"
+        source = _command("VALIDATE PRESCRIPTION", drug=drug, dose=amount, weight=weight, doses_per_day=per_day)
+        expected = _outcome(lambda: run(source)["result"])
+        assert _outcome(batch.result, i) == expected, source
+        assert messages[i] == (expected[0]["message"] if expected[1] is None else expected[1][1]), source
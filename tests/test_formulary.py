@@ -0,0 +1,56 @@
+import json
+import pytest
+import formulary
+from errors import FormularyError
+
+
+@pytest.fixture
+def source(tmp_path):
+    path = tmp_path / "formulary.json"
+    path.write_text(json.dumps(formulary.export()))
+    return path
+
+
+def _snapshot(source):
+    return json.loads((source.parent / (source.name + ".snapshot")).read_text())
+
+
+def test_snapshot_is_plain_json_of_the_validated_spec(source):
+    table = formulary.load(str(source))
+    snap = _snapshot(source)
+    assert snap["format"] == formulary.SNAPSHOT_FORMAT
+    assert snap["spec"]["version"] == table.version
+    again = formulary.load(str(source))
+    assert again.version == table.version and sorted(again) == sorted(table)
+    assert again["metformin"].calculator({"weight_kg": 70.0})[0] == 1400.0
+
+
+def test_edited_source_is_parsed_again(source):
+    formulary.load(str(source))
+    data = json.loads(source.read_text())
+    data["drugs"]["metformin"]["safe_range"] = [500, 2500]
+    source.write_text(json.dumps(data))
+    assert formulary.load(str(source))["metformin"].safe_range == (500.0, 2500.0)
+    assert _snapshot(source)["spec"]["drugs"]["metformin"]["safe_range"] == [500.0, 2500.0]
+
+
+@pytest.mark.parametrize("junk", [b"\x80\x04\x95garbage", b"[]", b'{"format": 2, "source": "x"}', b""])
+def test_unusable_snapshot_falls_back_to_a_full_parse(source, junk):
+    (source.parent / (source.name + ".snapshot")).write_bytes(junk)
+    assert "metformin" in formulary.load(str(source))
+
+
+def test_snapshot_of_the_wrong_shape_falls_back(source):
+    formulary.load(str(source))
+    snap_path = source.parent / (source.name + ".snapshot")
+    snap = json.loads(snap_path.read_text())
+    snap["spec"]["drugs"]["metformin"]["calculator"]["kind"] = "no_such_kind"
+    snap_path.write_text(json.dumps(snap))
+    assert formulary.load(str(source))["metformin"].calculator.spec[0] == "per_kg_mg_day"
+
+
+def test_invalid_source_is_reported(tmp_path):
+    path = tmp_path / "formulary.json"
+    path.write_text("{not json")
+    with pytest.raises(FormularyError, match="invalid JSON"):
+        formulary.load(str(path))
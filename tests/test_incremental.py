@@ -0,0 +1,49 @@
+import random
+from incremental import IncrementalDocument
+from interpreter import parse_batch
+from lexer import lex
+
+SCRIPT = ("CALCULATE DOSE FOR drug=metformin, condition=diabetes, weight=70kg\n"
+          "CHECK INTERACTION BETWEEN warfarin AND\n  aspirin;\n"
+          "VALIDATE PRESCRIPTION drug=ibuprofen, dose=400mg/dose,\n  doses_per_day=3\n"
+          "REPORT REGIMEN patient_id=p1 SINCE 7d\n")
+PIECES = ["", " ", "\n", ";", ",", "=", "@", "drug", "AND", "70", "kg", "CALCULATE DOSE FOR ", "x\ny"]
+
+
+def _full(text: str):
+    errors = []
+    tokens = lex(text, errors)
+    problems = [p for _, found in parse_batch(text) for p in found]
+    return tokens, sorted(errors, key=lambda e: e.position), problems
+
+
+def _check(doc: IncrementalDocument):
+    tokens, lexical, problems = _full(doc.text)
+    assert doc.tokens() == tokens
+    assert doc.diagnostics() == problems
+    assert [e for e in doc.diagnostics() if e.kind == "lexical"] == lexical
+
+
+def test_edits_match_a_full_lex_and_parse():
+    rng = random.Random(7)
+    doc = IncrementalDocument(SCRIPT)
+    _check(doc)
+    for _ in range(400):
+        start = rng.randint(0, len(doc.text))
+        end = min(len(doc.text), start + rng.choice([0, 0, 1, 3, 12]))
+        doc.edit(start, end, rng.choice(PIECES))
+        _check(doc)
+
+
+def test_update_matches_a_full_lex():
+    doc = IncrementalDocument(SCRIPT)
+    text = SCRIPT.replace("weight=70kg", "weight=80kg,\n  age=70").replace("aspirin;", "aspirin")
+    doc.update(text)
+    assert doc.text == text
+    _check(doc)
+
+
+def test_an_edit_relexes_only_its_command():
+    doc = IncrementalDocument(SCRIPT * 20)
+    doc.edit(30, 31, "x")
+    assert doc.relexed == SCRIPT.index("\n") + 1
@@ -0,0 +1,50 @@
+import threading
+import instrument
+import metrics
+from interpreter import run
+
+
+def test_shards_of_ended_threads_are_folded():
+    counter = metrics.Counter("test_total", "test", ("drug",))
+    hist = metrics.Histogram("test_seconds", "test", buckets=(1.0,))
+    def work():
+        counter.inc("metformin")
+        hist.observe(value=0.5)
+    for _ in range(5):
+        threads = [threading.Thread(target=work) for _ in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        counter.collect()
+    assert counter.collect() == {("metformin",): 100.0}
+    assert hist.collect() == {(): [100, 0, 50.0, 100]}
+    assert len(counter._shards) == 0 and len(hist._shards) == 0
+    counter.inc("metformin")
+    assert counter.collect() == {("metformin",): 101.0}
+    counter.reset()
+    assert counter.collect() == {}
+
+
+def test_untyped_metric_renders_its_sums():
+    metric = metrics._Metric("test_value", "test", ("stage",))
+    metric._shard()[("lex",)] = 2.5
+    assert metric.render() == ["# HELP test_value test", "# TYPE test_value untyped", 'test_value{stage="lex"} 2.5']
+
+
+def test_disable_keeps_other_hooks():
+    seen = []
+    instrument.add_hook(seen.append)
+    instrument.enable()
+    metrics.enable()
+    try:
+        metrics.disable()
+        assert instrument.ENABLED and not metrics.ENABLED
+        run("CHECK INTERACTION BETWEEN warfarin AND aspirin")
+        assert [e.command for e in seen] == ["CHECK"]
+    finally:
+        instrument.remove_hook(seen.append)
+        instrument.disable()
+    metrics.enable()
+    metrics.disable()
+    assert not instrument.ENABLED
@@ -0,0 +1,44 @@
+import pytest
+from errors import ParseError
+from interpreter import run, run_script, parse_batch
+from lexer import lex, lex_iter
+from parser import Parser
+
+MULTILINE = ("CALCULATE DOSE FOR drug=metformin,\n  condition=diabetes, weight=70kg,\n"
+             "  age=45, kidney_function=normal")
+
+
+def test_single_command_may_span_lines():
+    assert run(MULTILINE)["result"]["recommended_mg_per_day"] == 1400.0
+    assert run("CALCULATE DOSE FOR drug=metformin\n, condition=diabetes, weight=70kg, age=45,\n"
+               "kidney_function=normal")["result"]["recommended_mg_per_day"] == 1400.0
+
+
+def test_single_command_rejects_a_second_command():
+    with pytest.raises(ParseError, match="run_script"):
+        run("REPORT REGIMEN patient_id=p1; REPORT REGIMEN patient_id=p2")
+
+
+def test_script_continues_after_a_trailing_comma():
+    out = run_script(MULTILINE + "\n\nCHECK INTERACTION BETWEEN warfarin AND\n  aspirin\n")
+    assert [r["type"] for r in out] == ["CALCULATE", "CHECK"]
+    assert out[0]["result"]["recommended_mg_per_day"] == 1400.0
+
+
+def test_script_newline_still_ends_a_command():
+    statements = parse_batch("REPORT REGIMEN patient_id=p1\nREPORT REGIMEN patient_id=p2")
+    assert [problems for _, problems in statements] == [[], []]
+    assert [node.params["PATIENT_ID"] for node, _ in statements] == ["p1", "p2"]
+
+
+def test_lex_iter_joins_lines_like_lex():
+    source = MULTILINE + "\nCHECK INTERACTION BETWEEN a AND\n\n b;\nREPORT REGIMEN\n"
+    assert list(lex_iter(source)) == lex(source)
+
+
+def test_recovering_parse_one_reports_a_second_command():
+    source = "REPORT REGIMEN patient_id=p1; REPORT REGIMEN patient_id=p2"
+    errors = []
+    assert Parser(lex(source), errors).parse_one() is None
+    assert [(e.kind, e.position) for e in errors] == [("parse", source.index("; ") + 2)]
+    assert "run_script" in errors[0].message
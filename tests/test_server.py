@@ -0,0 +1,51 @@
+import asyncio
+import json
+import pytest
+import server
+
+
+def dispatch(method: str, target: str, body=None, srv=None):
+    srv = srv or server.InterpreterServer(io_workers=1)
+    raw = b"" if body is None else (body if isinstance(body, bytes) else json.dumps(body).encode())
+    return asyncio.run(srv._dispatch(method, target, raw))
+
+
+DOSE = {"drug": "metformin", "condition": "diabetes", "weight": "70kg"}
+
+
+def test_dose_and_run():
+    assert dispatch("POST", "/dose", DOSE)[1]["result"]["recommended_mg_per_day"] == 1400.0
+    status, out = dispatch("POST", "/run", {"command": "CHECK INTERACTION BETWEEN warfarin AND aspirin"})
+    assert status == 200 and out["type"] == "CHECK"
+
+
+@pytest.mark.parametrize("path", ["/dose", "/run", "/batch"])
+@pytest.mark.parametrize("body", [5, "CALCULATE", None, True])
+def test_non_object_bodies_are_bad_requests(path, body):
+    status, out = dispatch("POST", path, json.dumps(body).encode())
+    assert status == 400 and out["status"] == "error"
+
+
+def test_non_object_items_in_a_dose_list_fail_alone():
+    status, out = dispatch("POST", "/dose", [DOSE, 7])
+    assert status == 200
+    assert [r["status"] for r in out["results"]] == ["success", "error"]
+
+
+@pytest.mark.parametrize("query", ["max=abc", "max=-1", "max=1.5"])
+def test_bad_alerts_max_is_a_bad_request(query):
+    status, out = dispatch("GET", "/alerts?" + query)
+    assert status == 400 and "max" in out["error"]
+
+
+def test_failed_batch_fails_every_request(monkeypatch):
+    def broken(*columns):
+        raise MemoryError("no room")
+    monkeypatch.setattr(server, "compute_doses", broken)
+    srv = server.InterpreterServer(io_workers=1)
+    srv.doses.min_vector = 1
+
+    async def go():
+        return await asyncio.wait_for(srv.route("POST", "/dose", {}, [DOSE] * 3), timeout=5)
+    out = asyncio.run(go())
+    assert [r["error_type"] for r in out[1]["results"]] == ["MemoryError"] * 3
@@ -0,0 +1,76 @@
+import threading
+import pytest
+from store import open_store, JsonlRegimenStore
+
+THREADS, EACH = 8, 25
+
+
+def _path(tmp_path, backend):
+    return str(tmp_path / ("regimens.jsonl" if backend == "jsonl" else "regimens.db"))
+
+
+def _write(store, worker: int, in_batch: bool):
+    for i in range(EACH):
+        entry = {"type": "dose", "drug": "metformin", "recommended_mg_per_day": 500.0, "worker": worker, "seq": i}
+        if in_batch and i % 5 == 0:
+            with store.batch():
+                store.record(f"p{worker % 3}", entry)
+                store.record(f"p{worker % 3}", {**entry, "seq": i + 0.5})
+        else:
+            store.record(f"p{worker % 3}", entry)
+
+
+def _hammer(stores, in_batch: bool):
+    threads = [threading.Thread(target=_write, args=(stores[w % len(stores)], w, in_batch)) for w in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+def _check(store, in_batch: bool):
+    extra = EACH // 5 if in_batch else 0
+    seen = 0
+    for pid in ("p0", "p1", "p2"):
+        entries = store.report(pid)
+        seen += len(entries)
+        stamps = [e["ts"] for e in entries]
+        assert stamps == sorted(stamps)
+        for w in {e["worker"] for e in entries}:
+            seqs = [e["seq"] for e in entries if e["worker"] == w]
+            assert seqs == sorted(seqs)             # each writer's records in the order it wrote them
+            assert len(seqs) == EACH + extra
+    assert seen == THREADS * (EACH + extra)
+
+
+@pytest.mark.parametrize("backend", ["jsonl", "sqlite"])
+@pytest.mark.parametrize("in_batch", [False, True])
+def test_concurrent_writers_lose_nothing(tmp_path, backend, in_batch):
+    path = _path(tmp_path, backend)
+    store = open_store(backend, path)
+    _hammer([store], in_batch)
+    _check(store, in_batch)
+    store.close()
+    # and it is all there for the next process
+    reopened = open_store(backend, path)
+    _check(reopened, in_batch)
+    reopened.close()
+
+
+def test_jsonl_stores_sharing_a_file_see_each_other(tmp_path):
+    # two stores on one file stand in for two worker processes; each only has the lock file
+    path = _path(tmp_path, "jsonl")
+    stores = [JsonlRegimenStore(path, fsync=False), JsonlRegimenStore(path, fsync=False)]
+    _hammer(stores, in_batch=True)
+    for store in stores:
+        _check(store, in_batch=True)
+        store.close()
+
+
+@pytest.mark.parametrize("backend", ["jsonl", "sqlite"])
+def test_failed_batch_surfaces_its_error(tmp_path, backend):
+    store = open_store(backend, _path(tmp_path, backend))
+    with pytest.raises(TypeError):
+        with store.batch():
+            store.record("p1", {"drug": "metformin", "bad": object()})
+    store.close()
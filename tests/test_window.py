@@ -0,0 +1,57 @@
+from interpreter import run
+
+def calculate(weight: int, pid: str = "p1", drug: str = "metformin") -> dict:
+    # metformin is 20 mg/kg/day, capped at 2000 mg/day
+    return run(f"CALCULATE DOSE FOR drug={drug}, condition=diabetes, weight={weight}kg, age=45, "
+               f"kidney_function=normal, patient_id={pid}")
+
+
+def test_recalculating_the_same_order_counts_once(backend, clock):
+    for _ in range(3):
+        out = calculate(70)
+        clock.advance(1)
+    assert out["cumulative"]["total_mg"] == 1400
+    assert out["cumulative"]["alert"] is None
+
+
+def test_repeated_orders_in_the_window_trip_the_limit(backend, clock):
+    assert calculate(70)["cumulative"]["alert"] is None
+    clock.advance(2)
+    out = calculate(80)
+    assert out["cumulative"]["total_mg"] == 3000
+    assert out["cumulative"]["limit_mg"] == 2000
+    assert "exceeds 2000 mg" in out["cumulative"]["alert"]
+
+
+def test_same_order_a_day_later_is_a_new_order(backend, clock):
+    calculate(70)
+    clock.advance(24)
+    out = calculate(70)
+    assert out["cumulative"]["total_mg"] == 1400  # the first order left the 24h window
+    report = run("REPORT REGIMEN patient_id=p1 SINCE 48h")
+    assert report["totals"][0]["total_mg"] == 2800
+    assert report["totals"][0]["limit_mg"] == 4000
+    assert report["totals"][0]["alert"] is None
+
+
+def test_report_totals_right_after_orders(backend, clock):
+    calculate(70)
+    calculate(90)
+    totals = run("REPORT REGIMEN patient_id=p1 SINCE 24h")["totals"]
+    assert [(t["drug"], t["total_mg"]) for t in totals] == [("metformin", 3200)]
+    assert totals[0]["alert"]
+
+
+def test_window_totals_are_per_patient_and_drug(backend, clock):
+    calculate(70, pid="p1")
+    out = calculate(80, pid="p2")
+    assert out["cumulative"]["total_mg"] == 1600
+
+
+def test_window_alert_rule_fires_on_the_sum(backend, clock):
+    run("ALERT WHEN DOSE EXCEEDS 1200mg FOR drug=metformin, window=48h")
+    assert "alerts" not in calculate(70)
+    clock.advance(30)
+    out = calculate(70)
+    assert [a["value_mg"] for a in out["alerts"]] == [2800]
+    assert "over a 48h window" in out["alerts"][0]["message"]
@@ -1,5 +1,5 @@
-from dataclasses import dataclass
 from enum import Enum, auto
+from typing import NamedTuple
 
 class TokenType(Enum):
     EQUALS = auto()
@@ -9,10 +9,13 @@ class TokenType(Enum):
     IDENT = auto()
     KEYWORD = auto()
     AND = auto()
+    PARAM = auto()
+    SEMI = auto()
     EOF = auto()
 
-@dataclass
-class Token:
+class Token(NamedTuple):
+    # A tuple rather than a class with __init__: cheap to build, and immutable, so the lexer
+    # hands the same Token objects to every command that has them at the same place.
     type: TokenType
     lexeme: str
     pos: int